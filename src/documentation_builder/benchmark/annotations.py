@@ -0,0 +1,116 @@
+#!/usr/bin/env python2
+"""
+Benchmark parsing pan annotations XML, streamed versus as a whole tree.
+
+Generates a large annotations file resembling a metaconfig schema and
+times get_content_from_annotations against parsing the complete tree with
+validate_annotations and the parse_* functions. Every mode runs in a
+forked process, so its peak memory use can be reported as well.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+from tempfile import mkdtemp
+from vsc.utils.generaloption import simple_option
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import panhandler
+
+TYPE = """    <type name="type%(index)s" source-range="1.1-1.2">
+        <documentation>
+            <desc>Type number %(index)s, used for
+            the configuration of service %(index)s.</desc>
+        </documentation>
+        <basetype source-range="1.1-1.2" extensible="false">
+%(fields)s
+        </basetype>
+    </type>
+"""
+
+FIELD = """            <field name="field%(index)s" source-range="1.1-1.2" required="true">
+                <desc>Field number %(index)s.</desc>
+                <basetype name="long" source-range="1.1-1.2" extensible="false" range="0..%(index)s"/>
+                <default source-range="1.1-1.2" text="%(index)s"/>
+            </field>"""
+
+
+def write_annotations(path, types, fields):
+    """Write an annotations file with types that each have fields."""
+    fieldsxml = "\n".join([FIELD % {'index': index} for index in xrange(fields)])
+    with open(path, 'w') as fih:
+        fih.write('<?xml version="1.0" encoding="UTF-8"?>'
+                  '<template xmlns="http://quattor.org/pan/annotations" name="schema" type="DECLARATION">\n')
+        for index in xrange(types):
+            fih.write(TYPE % {'index': index, 'fields': fieldsxml})
+        fih.write('</template>\n')
+
+
+def parse_tree(path):
+    """Parse the annotations as a complete tree."""
+    content = {}
+    root = panhandler.validate_annotations(path)
+    types, functions, variables = panhandler.get_types_and_functions(root)
+    content['types'] = [panhandler.parse_type(ptype) for ptype in types]
+    content['functions'] = [panhandler.parse_function(function) for function in functions]
+    content['variables'] = [panhandler.parse_variable(pvar) for pvar in variables]
+    return content
+
+
+MODES = {
+    'stream': panhandler.get_content_from_annotations,
+    'tree': parse_tree,
+}
+
+
+def run_mode(mode, path):
+    """Time a mode in a forked process, return its result."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        start = time.time()
+        content = MODES[mode](path)
+        seconds = time.time() - start
+        os.write(write, json.dumps({'seconds': seconds, 'types': len(content['types'])}))
+        os._exit(0)
+    os.close(write)
+    result = json.loads(os.fdopen(read).read())
+    _, status, rusage = os.wait4(pid, 0)
+    result.update({'mode': mode, 'success': status == 0, 'maxrss_kb': rusage.ru_maxrss})
+    return result
+
+
+def main(options):
+    """Run the benchmark."""
+    workdir = mkdtemp()
+    try:
+        path = os.path.join(workdir, 'schema.pan.annotation.xml')
+        write_annotations(path, options.types, options.fields)
+        size = os.path.getsize(path)
+        results = []
+        for _ in xrange(options.repeat):
+            for mode in options.modes:
+                results.append(run_mode(mode, path))
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        'benchmark': 'annotations',
+        'parameters': {'types': options.types, 'fields': options.fields, 'bytes': size},
+        'results': results,
+    }
+    print json.dumps(report, indent=2, sort_keys=True)
+    return 0 if all([result['success'] for result in results]) else 1
+
+
+if __name__ == '__main__':
+    OPTIONS = {
+        'types': ('Number of types to generate.', 'int', 'store', 2000, 't'),
+        'fields': ('Number of fields per type.', 'int', 'store', 50, 'f'),
+        'modes': ('Parse modes to time.', 'strlist', 'store', ['stream', 'tree']),
+        'repeat': ('Number of times every mode is timed.', 'int', 'store', 1),
+    }
+    GO = simple_option(OPTIONS)
+    sys.exit(main(GO.options))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python2
+"""
+Benchmark the rst cleanup pipeline against the former recursive cleaners.
+
+Generates a large page resembling pod2rst output and checks that both
+implementations produce the same content.
+"""
+
+import os
+import re
+import sys
+import time
+import random
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import rsthandler
+
+LEGACYPATHREGEX = re.compile(r'(\s+)((?:/[\w{}]+)+\.?\w*)(\s*)')
+LEGACYCODETAGREGEX = re.compile(r'\\ ``(.*?)``\\ ')
+
+LINES = [
+    "The configuration is written to /etc/ncm-component/config.conf by default.",
+    "Report bugs to developer%s@quattor.org or see //mail@web.site for details.",
+    "Use \\ ``ncm-ncd --configure component``\\  to run the component.",
+    "Paths like /var/lib/{component}/state and /tmp/x are codified, / is not.",
+    "Send an email to username@example.com to subscribe.",
+    "",
+]
+
+
+def legacy_remove_emails(rst):
+    """Former implementation of rsthandler.remove_emails."""
+    for email in re.findall(rsthandler.MAILREGEX, rst):
+        replace = not email[0].startswith('//')
+        for ignoremail in rsthandler.EXAMPLEMAILS:
+            if ignoremail in email[0]:
+                replace = False
+        if replace:
+            rst = rst.replace(email[0], '')
+    return rst
+
+
+def legacy_codify_paths(rst):
+    """Former implementation of rsthandler.codify_paths."""
+    rst, counter = LEGACYPATHREGEX.subn(r'\1`\2`\3', rst)
+    if counter > 0:
+        rst = legacy_codify_paths(rst)
+    return rst
+
+
+def legacy_clean_code_tags(rst):
+    """Former implementation of rsthandler.clean_code_tags."""
+    rst, counter = LEGACYCODETAGREGEX.subn(r'``\1``', rst)
+    if counter > 0:
+        rst = legacy_clean_code_tags(rst)
+    return rst
+
+
+def legacy_cleanup(rst):
+    """Run the former cleaners after each other."""
+    return legacy_clean_code_tags(legacy_codify_paths(legacy_remove_emails(rst)))
+
+
+def make_page(lines):
+    """Return a page with the given number of lines, every email address is unique."""
+    random.seed(42)
+    page = []
+    for index in xrange(lines):
+        line = random.choice(LINES)
+        if '%s' in line:
+            line = line % index
+        page.append(line)
+    return "\n".join(page)
+
+
+def timeit(func, content, repeat):
+    """Return the best wall time of repeat runs of func on content, and its result."""
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = func(content)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best, result
+
+
+def main(lines=20000, repeat=3):
+    """Run the benchmark."""
+    # the recursive cleaners need a frame per pass
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    content = make_page(lines)
+    legacytime, legacy = timeit(legacy_cleanup, content, repeat)
+    pipelinetime, pipeline = timeit(lambda rst: rsthandler.run_cleaners(rst, rsthandler.CLEANERS), content, repeat)
+    print "page of %s lines, %s bytes" % (lines, len(content))
+    print "legacy cleaners: %.3fs" % legacytime
+    print "cleanup pipeline: %.3fs (%.1fx)" % (pipelinetime, legacytime / max(pipelinetime, 1e-9))
+    if legacy != pipeline:
+        print "ERROR: outputs differ"
+        return 1
+    print "outputs are identical"
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python2
+"""
+Benchmark source discovery on a synthetic repository.
+
+Compares the former full walk with list based duplicate handling with the
+pruned, dictionary indexed discovery of sourcehandler.list_source_files.
+"""
+
+import os
+import sys
+import time
+import shutil
+from tempfile import mkdtemp
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import repo, sourcehandler
+
+
+def make_tree(location, modules):
+    """
+    Create a repository with a pm file per module, every other module also has a pod file.
+
+    Every module also has a file in target/classes and .git, which don't need to be walked.
+    """
+    for index in xrange(modules):
+        subdir = os.path.join('NCM', 'Component%s' % (index % 100))
+        for kind, ext in [('lib/perl', '.pm'), ('doc/pod', '.pod'), ('classes', '.class'), ('../.git', '.obj')]:
+            if ext == '.pod' and index % 2:
+                continue
+            path = os.path.join(location, 'target', kind, subdir)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            with open(os.path.join(path, 'module%s%s' % (index, ext)), 'w') as fih:
+                fih.write("test\n")
+
+
+def legacy_handle_duplicates(filename, path, fulllist):
+    """Former duplicate handling of the discovery, pod takes preference over pm."""
+    if "doc/pod" in path:
+        duplicate = path.replace('doc/pod', 'lib/perl')
+        if filename.endswith('.pod'):
+            duplicate = duplicate.replace(".pod", ".pm")
+            if duplicate in fulllist:
+                fulllist[fulllist.index(duplicate)] = path
+                return fulllist
+
+    if "lib/perl" in path:
+        duplicate = path.replace('lib/perl', 'doc/pod')
+        if filename.endswith('.pm'):
+            duplicate = duplicate.replace(".pm", ".pod")
+            if duplicate not in fulllist:
+                fulllist.append(path)
+                return fulllist
+            else:
+                return fulllist
+    fulllist.append(path)
+    return fulllist
+
+
+def legacy_list_source_files(repository):
+    """Former implementation of sourcehandler.list_source_files."""
+    finallist = []
+    for sourcepath in repository.sourcepaths:
+        for path, _, files in os.walk(sourcepath):
+            if not sourcehandler.is_wanted_dir(path, repository.wanted_dirs):
+                continue
+            for sfile in files:
+                if sourcehandler.is_wanted_file(path, sfile, repository.wanted_extensions):
+                    finallist = legacy_handle_duplicates(sfile, os.path.join(path, sfile), finallist)
+    return finallist
+
+
+def timeit(func, repository):
+    """Return the wall time of func on repository, and its result."""
+    start = time.time()
+    result = func(repository)
+    return time.time() - start, result
+
+
+def main(modules=30000):
+    """Run the benchmark."""
+    location = mkdtemp()
+    try:
+        make_tree(location, modules)
+        repository = repo.Repo('CAF', location)
+        legacytime, legacy = timeit(legacy_list_source_files, repository)
+        newtime, new = timeit(sourcehandler.list_source_files, repository)
+    finally:
+        shutil.rmtree(location)
+
+    print "%s modules, %s source files" % (modules, len(new))
+    print "former discovery: %.3fs" % legacytime
+    print "current discovery: %.3fs (%.1fx)" % (newtime, legacytime / max(newtime, 1e-9))
+    if sorted(legacy) != new:
+        print "ERROR: results differ"
+        return 1
+    print "results are identical"
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
@@ -0,0 +1,245 @@
+#!/usr/bin/env python2
+"""
+Offline end-to-end benchmark of build_documentation.
+
+Generates synthetic repositories shaped like the layouts of Repo.configure_*,
+puts stub mvn, pod2rst and panc-annotations executables with a configurable
+latency on PATH and times build_documentation single threaded and in a pool.
+The sharded mode runs a shard process per shard on this machine and merges their outputs.
+The results are written as JSON.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+from tempfile import mkdtemp
+from vsc.utils.generaloption import simple_option
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import builder
+
+BUILDER = os.path.abspath(os.path.join(os.path.dirname(__file__), '../bin/quattor-documentation-builder'))
+
+MVNSTUB = """#!%(python)s
+import time
+time.sleep(%(latency)s)
+"""
+
+POD2RSTSTUB = """#!%(python)s
+# usage: pod2rst --infile F --title T
+import sys
+import time
+time.sleep(%(latency)s)
+infile, title = sys.argv[2], sys.argv[4]
+sys.stdout.write("%%s\\n%%s\\n%%s\\n\\n" %% ('#' * len(title), title, '#' * len(title)))
+sys.stdout.write(open(infile).read())
+"""
+
+PANCSTUB = """#!%(python)s
+# usage: panc-annotations --output-dir D --base-dir B FILE...
+import os
+import re
+import sys
+import time
+time.sleep(%(latency)s)
+outputdir, basedir, pfiles = sys.argv[2], sys.argv[4], sys.argv[5:]
+for pfile in pfiles:
+    content = open(os.path.join(basedir, pfile)).read()
+    name = re.search(r'template\\s+([\\w/-]+)', content).group(1)
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+           '<template xmlns="http://quattor.org/pan/annotations" name="%%s" type="DECLARATION">' %% name]
+    for desc, typename in re.findall(r'@documentation\\{([^}]*)\\}\\s*type\\s+(\\w+)', content):
+        xml.append('<type name="%%s"><documentation><desc>%%s</desc></documentation>'
+                   '<basetype extensible="false"><field name="debug" required="true"><desc>%%s</desc>'
+                   '<basetype name="long" extensible="false"/></field></basetype></type>' %% (typename, desc, desc))
+    xml.append('</template>')
+    annotationfile = os.path.join(outputdir, "%%s.annotation.xml" %% pfile)
+    if not os.path.exists(os.path.dirname(annotationfile)):
+        os.makedirs(os.path.dirname(annotationfile))
+    open(annotationfile, 'w').write('\\n'.join(xml))
+"""
+
+TEXT = ("Configuration is written to /etc/component/config.conf and documented by "
+        "developer@quattor.org, see \\ ``ncm-ncd --configure``\\  for details.")
+
+
+def write_file(path, content):
+    """Write content to path, creating its directory."""
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fih:
+        fih.write(content)
+
+
+def make_stubs(bindir, latency):
+    """Write the stub tools to bindir."""
+    for name, template in [('mvn', MVNSTUB), ('pod2rst', POD2RSTSTUB), ('panc-annotations', PANCSTUB)]:
+        path = os.path.join(bindir, name)
+        write_file(path, template % {'python': sys.executable, 'latency': latency})
+        os.chmod(path, 0o755)
+
+
+def pod_content(name, size):
+    """Return a pod file with size paragraphs."""
+    paragraphs = ["=head1 NAME\n\n%s - synthetic module" % name, "=head1 DESCRIPTION"]
+    paragraphs.extend([TEXT] * size)
+    return "\n\n".join(paragraphs) + "\n"
+
+
+def pan_content(template, size):
+    """Return a declaration template with size documented types."""
+    parts = ["declaration template %s;" % template]
+    for index in xrange(size):
+        parts.append("@documentation{type number %s}\ntype type%s = {\n    'debug' : long(0..1) = 0\n};" % (index, index))
+    return "\n\n".join(parts) + "\n"
+
+
+def make_repositories(location, pods, pans, size):
+    """
+    Create synthetic repositories in location.
+
+    The pod files are spread over CAF, CCM, ncm-ncd and configuration-modules-core,
+    the pan files over configuration-modules-core and template-library-core.
+    """
+    for index in xrange(pods):
+        kind = index % 4
+        if kind == 0:
+            path = 'CAF/target/doc/pod/CAF/Module%s.pod' % index
+        elif kind == 1:
+            path = 'CCM/target/doc/pod/EDG/WP4/CCM/Module%s.pod' % index
+        elif kind == 2:
+            path = 'ncm-ncd/target/doc/pod/NCD/Module%s.pod' % index
+        else:
+            path = 'configuration-modules-core/ncm-comp%s/target/doc/pod/NCM/Component/comp%s.pod' % (index, index)
+        write_file(os.path.join(location, path), pod_content('Module%s' % index, size))
+
+    for index in xrange(pans):
+        if index % 2:
+            template = 'components/comp%s/schema' % index
+            path = 'configuration-modules-core/ncm-comp%s/target/pan/%s.pan' % (index, template)
+        else:
+            template = 'quattor/functions/module%s' % index
+            path = 'template-library-core/%s.pan' % template
+        write_file(os.path.join(location, path), pan_content(template, size))
+
+    for subdir in ['pan', 'quattor']:
+        path = os.path.join(location, 'template-library-core', subdir)
+        if not os.path.exists(path):
+            os.makedirs(path)
+    metaconfig = os.path.join(location, 'configuration-modules-core/ncm-metaconfig/src/main/metaconfig')
+    if not os.path.exists(metaconfig):
+        os.makedirs(metaconfig)
+
+
+def count_pages(location):
+    """Return the number of pages written to location."""
+    return sum([len([name for name in files if name.endswith('.rst')]) for _, _, files in os.walk(location)])
+
+
+def run_build(sources, workdir, singlet):
+    """Time a single build_documentation run, return its result."""
+    output = mkdtemp(dir=workdir)
+    del builder.RESULTS[:]
+    start = time.time()
+    try:
+        success = builder.build_documentation(sources, output, singlet=singlet)
+    except SystemExit:
+        success = False
+    seconds = time.time() - start
+    pages = count_pages(output)
+    shutil.rmtree(output)
+    return {
+        'mode': 'single' if singlet else 'pool',
+        'success': success,
+        'seconds': seconds,
+        'pages': pages,
+        'pages_per_second': pages / seconds if seconds else None,
+    }
+
+
+def run_sharded(sources, workdir, shards):
+    """Time building all shards at once with a process per shard and merging them, return its result."""
+    locations = [mkdtemp(dir=workdir) for _ in xrange(shards)]
+    output = mkdtemp(dir=workdir)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    del builder.RESULTS[:]
+    start = time.time()
+    processes = [subprocess.Popen([sys.executable, BUILDER, '-m', sources, '-o', location,
+                                   '--shard', '%s/%s' % (index + 1, shards)], env=env)
+                 for index, location in enumerate(locations)]
+    success = all([process.wait() == 0 for process in processes])
+    built = time.time() - start
+    success = builder.merge_shards(locations, output) and success
+    seconds = time.time() - start
+    pages = count_pages(os.path.join(output, 'docs'))
+    for location in locations + [output]:
+        shutil.rmtree(location)
+    return {
+        'mode': 'sharded',
+        'shards': shards,
+        'success': success,
+        'seconds': seconds,
+        'merge_seconds': seconds - built,
+        'pages': pages,
+        'pages_per_second': pages / seconds if seconds else None,
+    }
+
+
+def main(options):
+    """Run the benchmark."""
+    workdir = mkdtemp()
+    try:
+        bindir = os.path.join(workdir, 'bin')
+        make_stubs(bindir, options.latency)
+        os.environ['PATH'] = "%s:%s" % (bindir, os.environ.get('PATH', ''))
+        sources = os.path.join(workdir, 'src')
+        make_repositories(sources, options.pod_files, options.pan_files, options.size)
+
+        results = []
+        for _ in xrange(options.repeat):
+            for mode in options.modes:
+                if mode == 'sharded':
+                    results.append(run_sharded(sources, workdir, options.shards))
+                else:
+                    results.append(run_build(sources, workdir, mode == 'single'))
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        'benchmark': 'endtoend',
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'parameters': {
+            'pod_files': options.pod_files,
+            'pan_files': options.pan_files,
+            'size': options.size,
+            'latency': options.latency,
+            'repeat': options.repeat,
+            'shards': options.shards,
+        },
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as fih:
+            json.dump(report, fih, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+    return 0 if all([result['success'] for result in results]) else 1
+
+
+if __name__ == '__main__':
+    OPTIONS = {
+        'pod_files': ('Number of pod files to generate.', 'int', 'store', 200, 'n'),
+        'pan_files': ('Number of pan files to generate.', 'int', 'store', 100, 'p'),
+        'size': ('Number of paragraphs per pod file and types per pan file.', 'int', 'store', 20),
+        'latency': ('Seconds every stub tool invocation takes.', 'float', 'store', 0.0),
+        'modes': ('Build modes to time: single, pool or sharded.', 'strlist', 'store', ['single', 'pool']),
+        'shards': ('Number of shard processes of the sharded mode.', 'int', 'store', 2),
+        'repeat': ('Number of times every mode is timed.', 'int', 'store', 1),
+        'output': ('File to write the JSON results to, instead of stdout.', None, 'store', None),
+    }
+    GO = simple_option(OPTIONS)
+    sys.exit(main(GO.options))
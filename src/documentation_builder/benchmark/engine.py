@@ -0,0 +1,72 @@
+#!/usr/bin/env python2
+"""
+Benchmark running many short external commands, one after the other versus concurrently.
+
+Every command is a perl one-liner starting an interpreter and writing some output,
+like a single pod2rst conversion. The commands are run with asyncloop, which
+blocks on every command, and with an Engine at several concurrencies.
+"""
+
+import os
+import sys
+import json
+import time
+from vsc.utils.generaloption import simple_option
+from vsc.utils.run import asyncloop
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild.engine import Engine
+
+# sleeps like a conversion waiting on file system access, then prints a page
+COMMAND = ['perl', '-e', 'select(undef, undef, undef, %s); print "line of a page\\n" x %s;']
+
+
+def run_asyncloop(commands):
+    """Run the commands with asyncloop, return the total output length."""
+    return sum([len(asyncloop(command)[1]) for command in commands])
+
+
+def run_engine(commands, concurrency):
+    """Run the commands with an engine, return the total output length."""
+    sizes = []
+    engine = Engine('pod2rst', concurrency)
+    for command in commands:
+        engine.submit(command, lambda errc, output: sizes.append(len(output)))
+    engine.run()
+    return sum(sizes)
+
+
+def timed(func, *args):
+    """Return the seconds func takes and its result."""
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main(options):
+    """Run the benchmark."""
+    command = COMMAND[:2] + [COMMAND[2] % (options.sleep, options.lines)]
+    commands = [command] * options.commands
+    seconds, size = timed(run_asyncloop, commands)
+    results = [{'mode': 'asyncloop', 'seconds': seconds, 'output_bytes': size}]
+    for concurrency in options.concurrency:
+        seconds, size = timed(run_engine, commands, int(concurrency))
+        results.append({'mode': 'engine', 'concurrency': int(concurrency), 'seconds': seconds, 'output_bytes': size})
+
+    report = {
+        'benchmark': 'engine',
+        'parameters': {'commands': options.commands, 'sleep': options.sleep, 'lines': options.lines},
+        'results': results,
+    }
+    print json.dumps(report, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    OPTIONS = {
+        'commands': ('Number of commands to run.', 'int', 'store', 200),
+        'sleep': ('Seconds every command sleeps.', 'float', 'store', 0.01),
+        'lines': ('Number of lines every command prints.', 'int', 'store', 2000),
+        'concurrency': ('Engine concurrencies to compare.', 'strlist', 'store', ['1', '4', '16']),
+    }
+    GO = simple_option(OPTIONS)
+    sys.exit(main(GO.options))
@@ -0,0 +1,321 @@
+#!/usr/bin/env python2
+"""
+Micro-benchmarks of the hot functions of panhandler, rsthandler and sourcehandler.
+
+Generates large fixtures: annotations XML of types with hundreds of fields and functions
+with many arguments, the content rendered from them, a page resembling pod2rst output
+of several thousand lines and the source paths of a large repository.
+Every benchmark runs in a forked process, which reports the calls per second and the
+peak memory, in total and on top of the fixtures.
+
+The report can be saved as a baseline and compared with a later run, so optimisations
+of these functions can be measured: a speedup above 1 means the function got faster.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import resource
+import platform
+from tempfile import mkdtemp
+from vsc.utils.generaloption import simple_option
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import panhandler, rsthandler, sourcehandler
+from quattordocbuild.repo import Repo, Sourcepage
+
+TYPE = """    <type name="type%(index)s" source-range="1.1-1.2">
+        <documentation>
+            <desc>Type number %(index)s, used for
+            the configuration of service %(index)s.</desc>
+        </documentation>
+        <basetype source-range="1.1-1.2" extensible="false">
+%(fields)s
+        </basetype>
+    </type>
+"""
+
+FIELD = """            <field name="field%(index)s" source-range="1.1-1.2" required="%(required)s">
+                <desc>Field number %(index)s, see /etc/service/field%(index)s.conf.</desc>
+                <basetype name="%(basetype)s" source-range="1.1-1.2" extensible="false" range="0..%(index)s"/>
+                <default source-range="1.1-1.2" text="%(index)s"/>
+            </field>"""
+
+FUNCTION = """    <function name="function%(index)s" source-range="1.1-1.2">
+        <documentation>
+            <desc>Function number %(index)s, returns the value of its arguments.</desc>
+%(args)s
+        </documentation>
+    </function>
+"""
+
+LINES = [
+    "The configuration is written to /etc/ncm-component/config.conf by default.",
+    "Report bugs to developer%s@quattor.org or see //mail@web.site for details.",
+    "Use \\ ``ncm-ncd --configure component``\\  to run the component.",
+    "Paths like /var/lib/{component}/state and /tmp/x are codified, / is not.",
+    "Send an email to username@example.com to subscribe.",
+]
+
+SOURCEDIRS = ['target/doc/pod/NCM/Component', 'target/lib/perl/NCM/Component', 'target/pan/components']
+
+
+def annotations_xml(types, fields, functions, args):
+    """Return annotations XML with types that each have fields and functions that each have args."""
+    fieldsxml = "\n".join([FIELD % {'index': index, 'required': ['true', 'false'][index % 2],
+                                    'basetype': ['long', 'string', 'boolean'][index % 3]}
+                           for index in xrange(fields)])
+    argsxml = "\n".join(["            <arg>argument %s of the function</arg>" % index for index in xrange(args)])
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<template xmlns="http://quattor.org/pan/annotations" name="schema" type="DECLARATION">']
+    parts.extend([TYPE % {'index': index, 'fields': fieldsxml} for index in xrange(types)])
+    parts.extend([FUNCTION % {'index': index, 'args': argsxml} for index in xrange(functions)])
+    parts.append('</template>')
+    return "\n".join(parts)
+
+
+def perl_page(lines):
+    """Return a page resembling pod2rst output with about the given number of lines."""
+    random.seed(42)
+    page = ["#" * 20, "NCM\\::Component\\::bench", "#" * 20, ""]
+    index = 0
+    while len(page) < lines:
+        index += 1
+        # a too short underline, like pod2rst writes for titles with escapes
+        page.extend(["", "Section %s" % index, "=" * 8, ""])
+        for _ in xrange(8):
+            line = random.choice(LINES)
+            if '%s' in line:
+                line = line % len(page)
+            page.append(line)
+        page.extend(["", "- an item of section %s" % index, "- another item", "", "Example::", "",
+                     "    my $value = $self->{config}->getValue('/software/components/bench');", ""])
+    return "\n".join(page) + "\n"
+
+
+def source_paths(sources):
+    """Return the repository and the paths of its sources, like configuration-modules-core."""
+    repository = Repo('configuration-modules-core', '/src/configuration-modules-core')
+    paths = []
+    for index in xrange(sources):
+        component = 'ncm-comp%s' % (index // len(SOURCEDIRS))
+        sourcedir = SOURCEDIRS[index % len(SOURCEDIRS)]
+        if sourcedir.startswith('target/pan'):
+            name = 'comp%s/schema.pan' % index
+        else:
+            name = 'comp%s.pod' % index
+        paths.append(os.path.join(repository.path, component, sourcedir, name))
+    return repository, paths
+
+
+def cycle(func, items):
+    """Return a call running func on the next item of items every time."""
+    state = {'index': 0}
+
+    def call():
+        """Run func on the next item."""
+        item = items[state['index'] % len(items)]
+        state['index'] += 1
+        return func(item)
+    return call
+
+
+def annotation_elements(workdir, options):
+    """Write the annotations fixture, return its types and functions."""
+    path = os.path.join(workdir, 'schema.pan.annotation.xml')
+    with open(path, 'w') as fih:
+        fih.write(annotations_xml(options.types, options.fields, options.functions, options.args))
+    types, functions, _ = panhandler.get_types_and_functions(panhandler.validate_annotations(path))
+    return types, functions
+
+
+def setup_parse_type(workdir, options):
+    """parse_type of a type with options.fields fields."""
+    return cycle(panhandler.parse_type, annotation_elements(workdir, options)[0])
+
+
+def setup_parse_function(workdir, options):
+    """parse_function of a function with options.args arguments."""
+    return cycle(panhandler.parse_function, annotation_elements(workdir, options)[1])
+
+
+def setup_render_template(workdir, options):
+    """render_template of all types and functions of the annotations."""
+    types, functions = annotation_elements(workdir, options)
+    content = {
+        'types': [panhandler.parse_type(ptype) for ptype in types],
+        'functions': [panhandler.parse_function(function) for function in functions],
+        'variables': [],
+    }
+    return lambda: panhandler.render_template(content, '/software/components/bench/', 'bench')
+
+
+def setup_remove_emails(workdir, options):
+    """remove_emails of a perl page."""
+    page = perl_page(options.lines)
+    return lambda: rsthandler.remove_emails(page)
+
+
+def setup_codify_paths(workdir, options):
+    """codify_paths of a perl page."""
+    page = perl_page(options.lines)
+    return lambda: rsthandler.codify_paths(page)
+
+
+def setup_clean_code_tags(workdir, options):
+    """clean_code_tags of a perl page."""
+    page = perl_page(options.lines)
+    return lambda: rsthandler.clean_code_tags(page)
+
+
+def setup_lint_content(workdir, options):
+    """lint_content of a cleaned up perl page."""
+    page = rsthandler.run_cleaners(perl_page(options.lines), rsthandler.CLEANERS)
+
+    def call():
+        """Lint a new page with the content."""
+        sourcepage = Sourcepage('NCM\\::Component\\::bench', '/src/bench.pod', None, False)
+        sourcepage.rstcontent = page
+        return rsthandler.lint_content(sourcepage)
+    return call
+
+
+def setup_make_title_from_source(workdir, options):
+    """make_title_from_source of a source of a large repository."""
+    repository, paths = source_paths(options.sources)
+    return cycle(lambda path: sourcehandler.make_title_from_source(path, repository), paths)
+
+
+BENCHMARKS = [
+    ('parse_type', setup_parse_type),
+    ('parse_function', setup_parse_function),
+    ('render_template', setup_render_template),
+    ('remove_emails', setup_remove_emails),
+    ('codify_paths', setup_codify_paths),
+    ('clean_code_tags', setup_clean_code_tags),
+    ('lint_content', setup_lint_content),
+    ('make_title_from_source', setup_make_title_from_source),
+]
+
+
+def measure(setup, options):
+    """Set up and time a benchmark in this process, return its result."""
+    workdir = mkdtemp()
+    try:
+        call = setup(workdir, options)
+        fixture_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # the first call is not timed, it fills the caches (e.g. compiled templates and regexes)
+        call()
+        calls = 0
+        start = time.time()
+        while True:
+            call()
+            calls += 1
+            seconds = time.time() - start
+            if seconds >= options.min_time and calls >= options.min_calls:
+                break
+    finally:
+        shutil.rmtree(workdir)
+    maxrss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'calls': calls,
+        'seconds': seconds,
+        'ops_per_second': calls / seconds,
+        'maxrss_kb': maxrss_kb,
+        'peak_above_fixtures_kb': maxrss_kb - fixture_kb,
+    }
+
+
+def run_benchmark(name, setup, options):
+    """Run a benchmark in a forked process, return its result."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        os.write(write, json.dumps(measure(setup, options)))
+        os._exit(0)
+    os.close(write)
+    output = os.fdopen(read).read()
+    _, status = os.waitpid(pid, 0)
+    result = {'name': name, 'description': setup.__doc__, 'success': status == 0 and bool(output)}
+    if output:
+        result.update(json.loads(output))
+    return result
+
+
+def compare(results, baseline):
+    """Add the speedup and memory ratio against the results of baseline, a previous report."""
+    previous = dict([(result['name'], result) for result in baseline['results'] if result['success']])
+    for result in results:
+        if result['success'] and result['name'] in previous:
+            old = previous[result['name']]
+            result['speedup'] = result['ops_per_second'] / old['ops_per_second']
+            result['maxrss_ratio'] = float(result['maxrss_kb']) / old['maxrss_kb']
+
+
+def main(options):
+    """Run the benchmarks."""
+    known = [name for name, _ in BENCHMARKS]
+    selected = options.benchmarks or known
+    unknown = [name for name in selected if name not in known]
+    if unknown:
+        print "Unknown benchmarks %s, known are %s." % (', '.join(unknown), ', '.join(known))
+        return 1
+    results = [run_benchmark(name, setup, options) for name, setup in BENCHMARKS if name in selected]
+
+    report = {
+        'benchmark': 'hotfunctions',
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'host': platform.node(),
+        'parameters': {
+            'types': options.types,
+            'fields': options.fields,
+            'functions': options.functions,
+            'args': options.args,
+            'lines': options.lines,
+            'sources': options.sources,
+            'min_time': options.min_time,
+        },
+        'results': results,
+    }
+    if options.baseline:
+        with open(options.baseline) as fih:
+            baseline = json.load(fih)
+        if baseline['parameters'] != report['parameters']:
+            print "Warning: the baseline was made with other parameters %s." % baseline['parameters']
+        compare(results, baseline)
+    if options.output:
+        with open(options.output, 'w') as fih:
+            json.dump(report, fih, indent=2, sort_keys=True)
+
+    for result in results:
+        if not result['success']:
+            print "%-24s failed" % result['name']
+            continue
+        line = "%-24s %12.1f ops/s %10s KB peak %10s KB above fixtures" % (
+            result['name'], result['ops_per_second'], result['maxrss_kb'], result['peak_above_fixtures_kb'])
+        if 'speedup' in result:
+            line += "  %.2fx speed, %.2fx memory" % (result['speedup'], result['maxrss_ratio'])
+        print line
+    return 0 if all([result['success'] for result in results]) else 1
+
+
+if __name__ == '__main__':
+    OPTIONS = {
+        'benchmarks': ('Benchmarks to run, all by default.', 'strlist', 'store', []),
+        'types': ('Number of types in the annotations.', 'int', 'store', 5),
+        'fields': ('Number of fields per type.', 'int', 'store', 400),
+        'functions': ('Number of functions in the annotations.', 'int', 'store', 20),
+        'args': ('Number of arguments per function.', 'int', 'store', 50),
+        'lines': ('Number of lines of the perl page.', 'int', 'store', 5000),
+        'sources': ('Number of sources of the repository.', 'int', 'store', 3000),
+        'min_time': ('Minimum seconds every benchmark is timed.', 'float', 'store', 2.0),
+        'min_calls': ('Minimum number of timed calls of every benchmark.', 'int', 'store', 3),
+        'output': ('File to save the JSON report to, to use as a baseline later.', None, 'store', None),
+        'baseline': ('JSON report of a previous run to compare with.', None, 'store', None),
+    }
+    GO = simple_option(OPTIONS)
+    sys.exit(main(GO.options))
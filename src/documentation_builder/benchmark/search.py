@@ -0,0 +1,124 @@
+#!/usr/bin/env python2
+"""
+Benchmark the search index on a synthetic documentation site.
+
+Generates perl and pan pages shaped like the pages of the builder, writes the
+index and reports its size and, per query, the time search takes and the bytes
+of the shards a client has to load.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+from tempfile import mkdtemp
+from vsc.utils.generaloption import simple_option
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import search
+from quattordocbuild.panhandler import render_template
+
+WORDS = ("configuration component profile service daemon restart file directory path option value default "
+         "network interface address module template schema type field function variable timeout retry "
+         "certificate server client package install update repository user group permission log level").split()
+
+QUERIES = ['configuration', 'restart daemon', 'certificate timeout', 'component network interface',
+           'nonexistent', 'type7 field3']
+
+
+def perl_page(name, paragraphs):
+    """Return a page resembling pod2rst output."""
+    lines = ["#" * len(name), name, "#" * len(name), "", "NAME", "====", "", "%s - module" % name, ""]
+    for _ in xrange(paragraphs):
+        lines.append(" ".join(random.choice(WORDS) for _ in xrange(40)))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def pan_page(name, types, fields):
+    """Return a page rendered with the pan template."""
+    content = {'types': [], 'functions': [], 'variables': []}
+    for tindex in xrange(types):
+        content['types'].append({
+            'name': 'type%s' % tindex,
+            'desc': " ".join(random.choice(WORDS) for _ in xrange(10)),
+            'fields': [{'name': 'field%s' % findex, 'required': 'true', 'type': 'string',
+                        'desc': " ".join(random.choice(WORDS) for _ in xrange(8))} for findex in xrange(fields)],
+        })
+    content['functions'].append({'name': '%s_function' % name, 'args': [], 'desc': 'a function'})
+    return render_template(content, 'components/%s/' % name, name)
+
+
+def directory_size(location):
+    """Return the number of files and bytes in location."""
+    files = [os.path.join(location, name) for name in os.listdir(location)]
+    return len(files), sum([os.path.getsize(path) for path in files])
+
+
+def main(options):
+    """Run the benchmark."""
+    random.seed(42)
+    workdir = mkdtemp()
+    try:
+        location = os.path.join(workdir, search.SEARCHDIR)
+        pages = []
+        for number in xrange(options.perl_pages):
+            name = 'Module%s' % number
+            pages.append(('CAF/%s.rst' % name, 'CAF::%s' % name, perl_page(name, options.paragraphs)))
+        for number in xrange(options.pan_pages):
+            name = 'comp%s' % number
+            pages.append(('components/%s.rst' % name, name, pan_page(name, options.types, options.fields)))
+
+        start = time.time()
+        index = search.new_index()
+        for path, title, content in pages:
+            search.add_page(index, path, title, content)
+        search.write_index(index, location)
+        seconds = time.time() - start
+        files, size = directory_size(location)
+
+        queries = []
+        for query in QUERIES:
+            start = time.time()
+            for _ in xrange(options.repeat):
+                results = search.search(location, query)
+            shards = set([search.shard_name(term) for term in search.terms(query)])
+            shardbytes = sum([os.path.getsize(os.path.join(location, '%s.json' % shard)) for shard in shards
+                              if os.path.exists(os.path.join(location, '%s.json' % shard))])
+            queries.append({
+                'query': query,
+                'results': len(results),
+                'milliseconds': (time.time() - start) * 1000 / options.repeat,
+                'shard_bytes': shardbytes,
+            })
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        'benchmark': 'search',
+        'parameters': {
+            'perl_pages': options.perl_pages,
+            'pan_pages': options.pan_pages,
+            'paragraphs': options.paragraphs,
+            'types': options.types,
+            'fields': options.fields,
+        },
+        'index': {'seconds': seconds, 'files': files, 'bytes': size, 'terms': len(index['postings'])},
+        'queries': queries,
+    }
+    print json.dumps(report, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    OPTIONS = {
+        'perl_pages': ('Number of perl pages to generate.', 'int', 'store', 1000),
+        'pan_pages': ('Number of pan pages to generate.', 'int', 'store', 300),
+        'paragraphs': ('Number of paragraphs per perl page.', 'int', 'store', 10),
+        'types': ('Number of types per pan page.', 'int', 'store', 10),
+        'fields': ('Number of fields per type.', 'int', 'store', 10),
+        'repeat': ('Number of times every query is timed.', 'int', 'store', 5),
+    }
+    GO = simple_option(OPTIONS)
+    sys.exit(main(GO.options))
@@ -3,55 +3,530 @@
 import os
 import sys
 import re
+import errno
 import codecs
-from multiprocessing import Pool
+import copy
+import json
+import hashlib
+import shutil
+import time
+import datetime
+import tempfile
+from multiprocessing import Pool, cpu_count
+from multiprocessing.queues import SimpleQueue
 from vsc.utils import fancylogger
-from sourcehandler import get_source_files
-from rsthandler import generate_rst_from_repository
+from sourcehandler import get_source_files, maven_reactor_compile
+from rsthandler import generate_rst_from_repository, split_cached_pages, annotate_pages, generate_page
+from rsthandler import rst_from_perl_batch
 from config import build_repository_map
+from schedule import load_durations, save_durations, estimate_costs, order_longest_first, estimate_makespan
+from tracing import traced, enable_tracing, set_context, read_spans, write_chrome_trace, summarize
+from limits import parse_limits, configure_limits
+from journal import Journal, JOURNALDIR
+from search import SEARCHDIR, new_index, add_page, write_index
+from shard import parse_shard, shard_repositories, select_shard, write_shard, read_shards, find_collisions
 
 logger = fancylogger.getLogger()
 RESULTS = []
+CHANGESFILE = '.changes.json'
+CPANS = "https://metacpan.org/pod/"
+# seconds between checks of the units running in the pool
+POOL_POLL = 0.05
+# queue the pool workers report the units they start on, set by init_worker
+STARTED = {}
 
-def build_documentation(repository_location, output_location, singlet=False):
-    """Build the whole documentation from quattor repositories."""
-    if not check_input(repository_location, output_location):
+
+class PageFailed(Exception):
+    """The tool generating a page failed or timed out."""
+
+
+def build_documentation(repository_location, output_location, singlet=False, cache_location=None,
+                        maven_reactor=False, maven_threads='1C', maven_offline=False, pod2rst_processes=0,
+                        movefiles_mode='hardlink', state_location=None, trace_location=None, in_place=False,
+                        changes_file=None, tool_limits=None, resume=False, search_index=False, shard=None):
+    """
+    Build the whole documentation from quattor repositories.
+
+    If cache_location is set, generated pages are cached there and reused for unchanged sources.
+    With maven_reactor, all repositories are compiled in a single maven reactor build
+    using maven_threads threads, in offline mode if maven_offline is set.
+    With pod2rst_processes, perl sources are converted by long-lived pod2rst converters:
+    that many per repository when running single threaded, one per worker otherwise.
+    movefiles_mode sets how the movefiles of the repositories are staged, see sourcehandler.stage_files.
+    If state_location is set, the durations of every repository are recorded there, and used to
+    schedule the longest repositories first on the next run.
+    If trace_location is set, the time and resources spent per stage are written there as a Chrome trace.
+    With in_place, output_location may contain a previous build: only changed pages are rewritten
+    and stale pages are removed. The added, changed and removed pages are listed in changes_file,
+    .changes.json in output_location by default.
+    tool_limits is a list of limits like maven:concurrency=2 for the external tools, see limits.parse_limits.
+    Completed pages and repositories and failures are recorded in a journal in output_location.
+    With resume, the pages and repositories completed by a previous failed or interrupted build
+    are taken from its journal and only the others are built.
+    Return False if some pages or repositories failed, the journal is kept for a resumed build then.
+    With search_index, a search index of all pages is written to the docs, see search.py.
+    With shard, a shard like 2/4, only the repositories and pages of that shard are built and written with
+    a manifest to output_location instead of the site, see merge_shards and shard.py.
+    """
+    if not check_input(repository_location, output_location, in_place or resume):
         sys.exit(1)
     if not check_commands():
         sys.exit(1)
+    overrides = parse_limits(tool_limits)
+    if overrides is None:
+        sys.exit(1)
+    if shard is not None:
+        shard = parse_shard(shard)
+        if shard is None:
+            sys.exit(1)
+    configure_limits(overrides)
     repository_map = build_repository_map(repository_location)
     if not repository_map:
         sys.exit(1)
+    tracedir = start_tracing(trace_location)
+    for repository in repository_map:
+        repository.movefiles_mode = movefiles_mode
+    journal = Journal(os.path.join(output_location, JOURNALDIR), resume)
+    repository_map = shard_repositories(repository_map, shard)
+    repository_map = resume_repositories(repository_map, journal)
+    if maven_reactor:
+        compiled = compile_repositories(repository_map, maven_threads, maven_offline)
+        for repository in repository_map:
+            if repository not in compiled:
+                journal.repository_failed(repository.name, "maven reactor build failed")
+        repository_map = compiled
+    if state_location:
+        repository_map = schedule_repositories(repository_map, state_location, 1 if singlet else cpu_count())
 
+    timings = {}
     if singlet:
         for repository in repository_map:
-            repository = build_docs(repository)
-            RESULTS.append(repository)
+            RESULTS.extend(build_docs(repository, journal.spooldir, cache_location, pod2rst_processes, timings,
+                                      journal, shard))
     else:
-        pool = Pool()
-        for repository in repository_map:
-            logger.debug("Starting worker for %s.", repository.name)
-            pool.apply_async(build_docs, args=(repository, ), callback=log_result)
-        pool.close()
-        pool.join()
-
-    site_pages = build_site_structure(RESULTS)
-    # site_pages = make_interlinks(site_pages) # disabled for now
-    write_site(site_pages, output_location, "docs")
+        RESULTS.extend(build_in_pool(repository_map, journal.spooldir, cache_location, pod2rst_processes, timings,
+                                     journal, shard))
+    if state_location:
+        save_durations(state_location, timings)
+
+    set_context(repository=None)
+    if shard is not None:
+        write_shard(RESULTS, output_location, shard, len(journal.failures))
+    else:
+        site_pages = build_site_structure(RESULTS)
+        # the pages of failed units are kept until a resumed build completes them
+        changes = write_site(site_pages, output_location, "docs", remove_stale=not journal.failures,
+                             search_index=search_index)
+        write_changes(changes, changes_file or os.path.join(output_location, CHANGESFILE))
+    if tracedir:
+        finish_tracing(tracedir, trace_location)
+    if journal.failures:
+        logger.error(journal.summary())
+        journal.close()
+        return False
+    journal.remove()
+    return True
+
+
+def merge_shards(shard_locations, output_location, in_place=False, changes_file=None, search_index=False):
+    """
+    Merge the outputs of all shards of a build into the site in output_location.
+
+    The site-wide steps, interlinking and the search index, are done on the pages of all shards,
+    in_place, changes_file and search_index are as for build_documentation.
+    Return False if shards are missing, pages of different sources collide or some shards had failures.
+    """
+    if not output_location or not os.path.exists(output_location):
+        logger.error("Output location %s does not exist", output_location)
+        return False
+    if not in_place and not os.listdir(output_location) == []:
+        logger.error("Output location %s is not empty.", output_location)
+        return False
+    shards = read_shards(shard_locations)
+    if shards is None:
+        return False
+    collisions = find_collisions(shards)
+    for sitesection, filename, sources in collisions:
+        logger.error("Pages of %s would all be written to %s/%s.", ', '.join(sources), sitesection, filename)
+    if collisions:
+        return False
+
+    manifests = [page for shard in shards for page in shard['pages']]
+    failures = [str(shard['index']) for shard in shards if shard['failures']]
+    logger.info("Merging %s pages of %s shards.", len(manifests), len(shards))
+    changes = write_site(build_site_structure(manifests), output_location, "docs", remove_stale=not failures,
+                         search_index=search_index)
+    write_changes(changes, changes_file or os.path.join(output_location, CHANGESFILE))
+    if failures:
+        logger.error("Shards %s had failures, resume them before merging again.", ', '.join(failures))
+        return False
+    return True
+
+
+def resume_repositories(repository_map, journal):
+    """Add the pages of the repositories completed according to the journal to RESULTS, return the others."""
+    completed = set(journal.completed())
+    for repository in repository_map:
+        if repository.name in completed:
+            RESULTS.extend(journal.manifests(repository.name))
+    if completed:
+        logger.info("Skipping completed repositories %s.", ', '.join(sorted(completed)))
+    return [repository for repository in repository_map if repository.name not in completed]
+
+
+def start_tracing(trace_location):
+    """Enable tracing if trace_location is set, return the directory the processes write their spans to."""
+    if not trace_location:
+        return None
+    if not os.path.exists(trace_location):
+        os.makedirs(trace_location)
+    tracedir = tempfile.mkdtemp(dir=trace_location, prefix='.spans')
+    enable_tracing(tracedir)
+    return tracedir
+
+
+def finish_tracing(tracedir, trace_location):
+    """Merge the spans of all processes into a Chrome trace file in trace_location and log a summary."""
+    enable_tracing(None)
+    spans = read_spans(tracedir)
+    tracefile = os.path.join(trace_location, 'trace-%s.json' % time.strftime('%Y%m%d-%H%M%S'))
+    write_chrome_trace(spans, tracefile)
+    shutil.rmtree(tracedir)
+    logger.info("Wrote %s spans to %s.", len(spans), tracefile)
+    logger.info(summarize(spans))
+    return tracefile
+
+
+def schedule_repositories(repository_map, state_location, workers):
+    """Return the repositories ordered longest first, and log the estimated completion time."""
+    costs = estimate_costs(repository_map, load_durations(state_location))
+    repository_map = order_longest_first(repository_map, costs)
+    logger.info("Scheduling repositories: %s.",
+                ', '.join(["%s (%.0fs)" % (repository.name, costs[repository.name]) for repository in repository_map]))
+    makespan = estimate_makespan(costs.values(), workers)
+    finish = datetime.datetime.now() + datetime.timedelta(seconds=makespan)
+    logger.info("Estimated completion in %.0fs, around %s.", makespan, finish.strftime('%H:%M:%S'))
+    return repository_map
+
+
+def init_worker(started):
+    """Initialize a pool worker, it reports the units it starts on the started queue."""
+    STARTED['queue'] = started
+
+
+def run_unit(unit):
+    """
+    Run a unit of work (name, function, args) in a worker.
+
+    Return its name, result, the seconds it took and the error it raised (None if it succeeded),
+    so a failing unit is reported instead of breaking the pool.
+    """
+    name, func, args = unit
+    if 'queue' in STARTED:
+        STARTED['queue'].put((os.getpid(), name))
+    start = time.time()
+    try:
+        result, error = func(*args), None
+    except Exception as err:  # pylint: disable=broad-except
+        result, error = None, "%s: %s" % (err.__class__.__name__, err)
+    return name, result, time.time() - start, error
+
+
+def is_alive(pid):
+    """Check if process pid exists."""
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
     return True
 
-def log_result(repository):
-    """Catch results given by subprocesses."""
-    logger.info('Received %s from worker.', repository.name)
-    RESULTS.append(repository)
 
-def build_docs(repository):
+def wait_for_units(units, started):
+    """
+    Wait for the units of a pool and handle their results as soon as they are available.
+
+    units maps the name of every unit to its AsyncResult and a handler, which is called with
+    the result of run_unit and may add units. The workers report the units they start on the started
+    queue, the unit of a worker that died (e.g. killed for lack of memory) fails instead of being waited for.
+    """
+    running = {}
+    while units:
+        while not started.empty():
+            pid, name = started.get()
+            running[pid] = name
+        for name, (result, handle) in units.items():
+            if result.ready():
+                del units[name]
+                try:
+                    unit = result.get()
+                except Exception as err:  # pylint: disable=broad-except
+                    # results that could not be returned from the worker
+                    unit = (name, None, 0, "%s: %s" % (err.__class__.__name__, err))
+                handle(unit)
+        for pid, name in running.items():
+            if not is_alive(pid):
+                del running[pid]
+                if name in units and not units[name][0].ready():
+                    handle = units.pop(name)[1]
+                    handle((name, None, 0, "its worker %s died" % pid))
+        if units:
+            time.sleep(POOL_POLL)
+
+
+def compile_repositories(repository_map, threads, offline):
+    """
+    Compile all repositories in a single maven reactor build.
+
+    Repositories which failed to build are dropped, the others don't need their own maven run anymore.
+    If failures can't be mapped to repositories, every repository falls back to its own maven run.
+    """
+    failed = maven_reactor_compile(repository_map, threads, offline)
+    if failed is None:
+        logger.warning("Falling back to a maven run per repository.")
+        return repository_map
+
+    compiled = []
+    for repository in repository_map:
+        if repository.name in failed:
+            logger.error("Skipping %s, maven failed.", repository.name)
+            continue
+        repository.mvncompile = False
+        compiled.append(repository)
+    return compiled
+
+
+def build_in_pool(repository_map, spooldir, cache_location=None, pod2rst_processes=0, timings=None, journal=None,
+                  shard=None):
+    """
+    Build the documentation of all repositories in a shared worker pool.
+
+    Every repository is prepared first (maven, source discovery and pan annotations),
+    after which each page that still has to be generated is a separate unit of work,
+    so small repositories don't leave workers idle while the largest one is processed.
+    Pages are written to spooldir by the workers, only their manifests are returned.
+    Repositories are handed to the workers in the order of repository_map.
+    If timings is given, the seconds spent per stage and the number of sources are added per repository name.
+    Generated pages, completed repositories and failures are recorded in journal as soon as they are known,
+    pages it already has are not generated again. A unit whose worker died is recorded as a failure.
+    With shard (index, count), only the pages of that shard are generated.
+    """
+    if timings is None:
+        timings = {}
+    if journal is None:
+        journal = Journal()
+    workdir = tempfile.mkdtemp()
+    started = SimpleQueue()
+    pool = Pool(initializer=init_worker, initargs=(started,))
+    units = {}
+    manifests = []
+    remaining = {}
+    failed = set()
+
+    def page_finished(unit):
+        """Record a finished page, the repository is complete once all its pages are."""
+        (name, path), manifest, duration, error = unit
+        timings[name]['pages'] += duration
+        if error is None:
+            manifests.append(manifest)
+            journal.page_done(name, path, manifest)
+        else:
+            failed.add(name)
+            journal.page_failed(name, path, error)
+        remaining[name] -= 1
+        if not remaining[name] and name not in failed:
+            journal.repository_done(name)
+
+    def repository_prepared(unit):
+        """Submit the pages of a prepared repository."""
+        name, prepared, duration, error = unit
+        if error is not None or prepared[0] is None:
+            journal.repository_failed(name, error or "its sources could not be prepared")
+            return
+        settings, cached, pending = prepared
+        done = journal.done_pages(name)
+        todo = [(sourcepage, annotations) for sourcepage, annotations in pending if sourcepage.path not in done]
+        logger.info('Received %s from worker, submitting %s pages.', name, len(todo))
+        timings[name] = {'prepare': duration, 'pages': 0, 'sources': len(cached) + len(pending)}
+        for manifest in cached:
+            journal.page_done(name, manifest['source'], manifest)
+        manifests.extend(cached)
+        manifests.extend([done[sourcepage.path] for sourcepage, _ in pending if sourcepage.path in done])
+        remaining[name] = len(todo)
+        if not todo:
+            journal.repository_done(name)
+        for sourcepage, annotations in todo:
+            page = (name, sourcepage.path)
+            args = (sourcepage, settings, annotations, cache_location, spooldir, pod2rst_processes)
+            units[page] = (pool.apply_async(run_unit, args=((page, build_page, args),)), page_finished)
+
+    for repository in repository_map:
+        task = (repository, cache_location, workdir, spooldir, shard)
+        result = pool.apply_async(run_unit, args=((repository.name, prepare_repository, (task,)),))
+        units[repository.name] = (result, repository_prepared)
+    wait_for_units(units, started)
+    pool.close()
+    pool.join()
+
+    for name in sorted(failed):
+        journal.repository_failed(name, "some of its pages failed")
+    shutil.rmtree(workdir)
+
+    return [manifest for manifest in manifests if manifest]
+
+
+def prepare_repository(task):
+    """
+    Prepare a repository for page level processing in a worker.
+
+    task is a tuple (repository, cache_location, workdir, spooldir, shard).
+    Return the repository settings (without its sources), the manifests of the cached pages
+    and a list with every page that still needs to be generated and its batch built pan annotations.
+    """
+    repository, cache_location, workdir, spooldir, shard = task
+    logger.info("Preparing documentation for %s.", repository.name)
+    set_context(repository=repository.name)
+    repository = get_source_files(repository)
+    if repository is None:
+        logger.error("Skipping %s, its sources could not be prepared.", task[0].name)
+        return None, None, None
+    repository = select_shard(repository, shard)
+    pending = split_cached_pages(repository, cache_location)
+    annotationdir = os.path.join(workdir, repository.name)
+    os.makedirs(annotationdir)
+    annotations = annotate_pages(pending, annotationdir)
+
+    pendingpaths = set([sourcepage.path for sourcepage in pending])
+    cached = [spool_page(sourcepage, repository.sitesection, spooldir)
+              for sourcepage in repository.sources if sourcepage.path not in pendingpaths and sourcepage.rstcontent]
+    pages = []
+    for sourcepage in pending:
+        pageannotations = {}
+        if sourcepage.path in annotations:
+            pageannotations[sourcepage.path] = annotations[sourcepage.path]
+        pages.append((sourcepage, pageannotations))
+
+    settings = copy.copy(repository)
+    settings.sources = []
+    return settings, cached, pages
+
+
+def build_page(sourcepage, repository, annotations, cache_location, spooldir, pod2rst_processes=0):
+    """
+    Generate a single page of a repository in a worker and return its manifest.
+
+    Raises PageFailed if the tool generating the page failed.
+    If pod2rst_processes is set, a perl source is converted by the long-lived converter of the worker.
+    """
+    set_context(repository=repository.name)
+    perlrst = None
+    if pod2rst_processes:
+        perlrst = rst_from_perl_batch([sourcepage], 1)
+    sourcepage = generate_page(sourcepage, repository, annotations, cache_location, perlrst)
+    return spool_page(sourcepage, repository.sitesection, spooldir)
+
+
+def build_docs(repository, spooldir, cache_location=None, pod2rst_processes=0, timings=None, journal=None,
+               shard=None):
+    """
+    Find the sources of a repository, generate their rst pages and return their manifests.
+
+    If timings is given, the seconds spent per stage and the number of sources are added for the repository.
+    The pages and the repository are recorded in journal once they are generated,
+    pages it already has are not generated again. A failure is recorded instead of raised,
+    a page whose tool failed is recorded as a failure instead of as a page without content.
+    With shard (index, count), only the pages of that shard are generated.
+    """
     logger.info("Building documentation for %s.", repository.name)
     logger.debug(repository)
-    repository = get_source_files(repository)
-    logger.debug("Repository: %s", repository)
-    repository = generate_rst_from_repository(repository)
-    return repository
+    name = repository.name
+    if journal is None:
+        journal = Journal()
+    set_context(repository=name)
+    start = time.time()
+    try:
+        repository = get_source_files(repository)
+        if repository is None:
+            journal.repository_failed(name, "its sources could not be prepared")
+            return []
+        repository = select_shard(repository, shard)
+        logger.debug("Repository: %s", repository)
+        prepared = time.time()
+        sources = len(repository.sources)
+        done = journal.done_pages(name)
+        manifests = [done[sourcepage.path] for sourcepage in repository.sources if sourcepage.path in done]
+        repository.sources = [sourcepage for sourcepage in repository.sources if sourcepage.path not in done]
+        repository = generate_rst_from_repository(repository, cache_location, pod2rst_processes)
+        failed = False
+        for sourcepage in repository.sources:
+            try:
+                manifests.append(spool_page(sourcepage, repository.sitesection, spooldir))
+            except PageFailed as err:
+                failed = True
+                journal.page_failed(name, sourcepage.path, "%s: %s" % (err.__class__.__name__, err))
+                continue
+            journal.page_done(name, sourcepage.path, manifests[-1])
+    except Exception as err:  # pylint: disable=broad-except
+        journal.repository_failed(name, "%s: %s" % (err.__class__.__name__, err))
+        return []
+    if failed:
+        journal.repository_failed(name, "some of its pages failed")
+    else:
+        journal.repository_done(name)
+    if timings is not None:
+        timings[name] = {'prepare': prepared - start, 'pages': time.time() - prepared, 'sources': sources}
+    return [manifest for manifest in manifests if manifest]
+
+
+def page_filename(title):
+    """Return the filename of a page on the website."""
+    filename = '%s.rst' % title
+    filename = filename.replace('\::', '_')
+    filename = filename.replace(' - ', '_')
+    logger.debug("filename will be: %s", filename)
+    return filename
+
+
+def encode_content(content):
+    """Return the content of a page as utf-8 encoded bytes."""
+    if isinstance(content, unicode):
+        return content.encode('utf-8')
+    return content
+
+
+def spool_page(sourcepage, sitesection, spooldir):
+    """
+    Write a generated page to the spool directory.
+
+    Return the manifest of the page, or None if the page has no content.
+    Raises PageFailed if the tool generating the page failed, so it is not taken for a page without content.
+    """
+    if sourcepage.failed:
+        raise PageFailed("the tool generating %s failed or timed out" % sourcepage.path)
+    if not sourcepage.rstcontent:
+        return None
+    filename = page_filename(sourcepage.title)
+    spoolsubdir = os.path.join(spooldir, sitesection)
+    if not os.path.exists(spoolsubdir):
+        try:
+            os.makedirs(spoolsubdir)
+        except OSError:
+            # created by another worker in the meantime
+            pass
+    content = encode_content(sourcepage.rstcontent)
+    handle, spoolfile = tempfile.mkstemp(dir=spoolsubdir, suffix='.rst')
+    with os.fdopen(handle, 'wb') as fih:
+        fih.write(content)
+
+    return {
+        'sitesection': sitesection,
+        'title': sourcepage.title,
+        'filename': filename,
+        'spool': spoolfile,
+        'source': sourcepage.path,
+        'hash': hashlib.sha256(content).hexdigest(),
+        'size': len(content),
+    }
+
 
 def which(command):
     """Check if given command is available for the current user on this system."""
@@ -63,8 +538,8 @@ def which(command):
     return found
 
 
-def check_input(sourceloc, outputloc):
-    """Check input and locations."""
+def check_input(sourceloc, outputloc, in_place=False):
+    """Check input and locations, the output location has to be empty unless building in place."""
     logger.info("Checking if the given paths exist.")
     if not sourceloc:
         logger.error("Repo location not specified.")
@@ -78,7 +553,7 @@ def check_input(sourceloc, outputloc):
     if not os.path.exists(outputloc):
         logger.error("Output location %s does not exist", outputloc)
         return False
-    if not os.listdir(outputloc) == []:
+    if not in_place and not os.listdir(outputloc) == []:
         logger.error("Output location %s is not empty.", outputloc)
         return False
     return True
@@ -95,17 +570,16 @@ def check_commands():
     return True
 
 
-def build_site_structure(repository_map):
-    """Make a mapping of files with their new names for the website."""
+def build_site_structure(manifests):
+    """Make a mapping of sitesections with the manifests of their pages by filename for the website."""
     sitepages = {}
-    for repo in repository_map:
-        sitepages[repo.sitesection] = {}
-        for sourcepage in repo.sources:
-            filename = '%s.rst' % sourcepage.title
-            filename = filename.replace('\::', '_')
-            filename = filename.replace(' - ', '_')
-            logger.debug("filename will be: %s", filename)
-            sitepages[repo.sitesection][filename] = sourcepage.rstcontent
+    for manifest in manifests:
+        pages = sitepages.setdefault(manifest['sitesection'], {})
+        if manifest['filename'] in pages:
+            logger.warning("Duplicate page %s in %s, keeping %s.", manifest['filename'],
+                           manifest['sitesection'], pages[manifest['filename']]['title'])
+            continue
+        pages[manifest['filename']] = manifest
 
     logger.debug("sitepages: %s", sitepages)
     return sitepages
@@ -114,50 +588,181 @@ def build_site_structure(repository_map):
 def make_interlinks(pages):
     """Make links in the content based on pagenames."""
     logger.info("Creating interlinks.")
-    newpages = pages
+    linkregex, targets = compile_interlinks(pages)
     for subdir in pages:
         for page in pages[subdir]:
-            basename = os.path.splitext(page)[0]
-            link = '../%s/%s' % (subdir, page)
-            regxs = []
-            regxs.append("`%s`" % basename)
-            regxs.append("`%s::%s`" % (subdir, basename))
+            pages[subdir][page] = interlink_content(pages[subdir][page], page, linkregex, targets)
 
-            cpans = "https://metacpan.org/pod/"
+    return pages
 
-            if subdir == 'CCM':
-                regxs.append(r"\[{2}::{0}\]\({1}{2}::{0}\)".format(basename, cpans, "EDG::WP4::CCM"))
-            if subdir == 'Unittest':
-                regxs.append(r"\[{2}::{0}\]\({1}{2}::{0}\)".format(basename, cpans, "Test"))
-            if subdir in ['components', 'components-grid']:
-                regxs.append(r"\[{2}::{0}\]\({1}{2}::{0}\)".format(basename, cpans, "NCM::Component"))
-                regxs.append(r"`ncm-%s`" % basename)
-                regxs.append(r"ncm-%s" % basename)
 
-            for regex in regxs:
-                newpages = replace_regex_link(newpages, regex, basename, link)
+def link_texts(subdir, basename):
+    """Return all texts which refer to page basename in subdir."""
+    texts = ["`%s`" % basename, "`%s::%s`" % (subdir, basename)]
 
-    return newpages
+    if subdir == 'CCM':
+        texts.append("[{2}::{0}]({1}{2}::{0})".format(basename, CPANS, "EDG::WP4::CCM"))
+    if subdir == 'Unittest':
+        texts.append("[{2}::{0}]({1}{2}::{0})".format(basename, CPANS, "Test"))
+    if subdir in ['components', 'components-grid']:
+        texts.append("[{2}::{0}]({1}{2}::{0})".format(basename, CPANS, "NCM::Component"))
+        texts.append("`ncm-%s`" % basename)
+        texts.append("ncm-%s" % basename)
 
+    return texts
 
-def replace_regex_link(pages, regex, basename, link):
-    """Replace links in a bunch of pages based on a regex."""
-    regex = r'( |^|\n)%s([,. $])' % regex
+
+def compile_interlinks(pages):
+    """
+    Compile the link targets of all pages into a single regex.
+
+    pages maps each subdir to its pagenames. Return the compiled regex and a dictionary
+    with the basename and link of every text the regex can match.
+    The regex is built from a trie of all texts, so matching it doesn't slow down
+    with the number of pages. It is None if there are no pages.
+    """
+    targets = {}
     for subdir in pages:
         for page in pages[subdir]:
-            content = pages[subdir][page]
-            if (basename not in page or basename == "Quattor") and basename in content:
-                content = re.sub(regex, r"\g<1>[%s](%s)\g<2>" % (basename, link), content)
-                pages[subdir][page] = content
-    return pages
+            basename = os.path.splitext(page)[0]
+            link = '../%s/%s' % (subdir, page)
+            for text in link_texts(subdir, basename):
+                # the first page claiming a text gets the link
+                targets.setdefault(text, (basename, link))
+
+    if not targets:
+        return None, targets
+    # the delimiter after a text is not consumed, it can precede the next text
+    linkregex = re.compile(r'( |^|\n)(%s)(?=[,. $])' % trie_regex(targets.keys()))
+    return linkregex, targets
+
+
+def interlink_content(content, pagename, linkregex, targets):
+    """Replace all link texts in the content of a page in one pass, except links to the page itself."""
+    if linkregex is None:
+        return content
+
+    def replace(match):
+        """Return the replacement for a single link text."""
+        basename, link = targets[match.group(2)]
+        if basename in pagename and basename != "Quattor":
+            return match.group(0)
+        return "%s[%s](%s)" % (match.group(1), basename, link)
+
+    return linkregex.sub(replace, content)
+
+
+def trie_regex(texts):
+    """Return a regex pattern matching any of the given texts, structured as a trie."""
+    trie = {}
+    for text in texts:
+        node = trie
+        for char in text:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return trie_pattern(trie)
 
 
-def write_site(sitepages, location, docsdir):
-    """Write the pages for the website to disk."""
+def trie_pattern(node):
+    """Return the regex pattern for a node of a trie built by trie_regex."""
+    alternatives = [re.escape(char) + trie_pattern(node[char]) for char in sorted(node) if char]
+    if not alternatives:
+        return ''
+    if len(alternatives) == 1 and '' not in node:
+        return alternatives[0]
+    pattern = '(?:%s)' % '|'.join(alternatives)
+    if '' in node:
+        pattern += '?'
+    return pattern
+
+
+@traced('write_site', lambda sitepages, *args: {'pages': sum([len(pages) for pages in sitepages.values()])})
+def write_site(sitepages, location, docsdir, remove_stale=True, search_index=False):
+    """
+    Write the pages for the website to disk.
+
+    sitepages is the mapping made by build_site_structure, every page is read from the spool,
+    interlinked with all other pages and written to its place in docsdir, one page at a time.
+    Pages with unchanged content are not rewritten and, with remove_stale, pages in docsdir
+    which are not in sitepages are removed.
+    With search_index, a search index of all pages is written to the SEARCHDIR of docsdir.
+    Return a dictionary with the added, changed and removed pages (relative to location)
+    and the number of unchanged pages.
+    """
+    changes = {'added': [], 'changed': [], 'removed': [], 'unchanged': 0}
+    docslocation = os.path.join(location, docsdir)
+    linkregex, targets = compile_interlinks(sitepages)
+    index = new_index()
     for subdir, pages in sitepages.iteritems():
-        fullsubdir = os.path.join(location, docsdir, subdir)
-        if not os.path.exists(fullsubdir):
-            os.makedirs(fullsubdir)
-        for pagename, content in pages.iteritems():
-            with codecs.open(os.path.join(fullsubdir, pagename), 'w', encoding='utf-8') as fih:
-                fih.write(content)
+        for pagename, manifest in pages.iteritems():
+            with codecs.open(manifest['spool'], 'r', encoding='utf-8') as fih:
+                content = fih.read()
+            if search_index:
+                add_page(index, '%s/%s' % (subdir, pagename), manifest['title'].replace('\\::', '::'), content)
+            pagefile = os.path.join(docsdir, subdir, pagename)
+            existed = os.path.exists(os.path.join(location, pagefile))
+            if not write_page(content, subdir, pagename, docslocation, linkregex, targets):
+                changes['unchanged'] += 1
+            elif existed:
+                changes['changed'].append(pagefile)
+            else:
+                changes['added'].append(pagefile)
+
+    if remove_stale:
+        changes['removed'] = [os.path.join(docsdir, pagefile)
+                              for pagefile in remove_stale_pages(sitepages, docslocation)]
+    if search_index:
+        write_index(index, os.path.join(docslocation, SEARCHDIR))
+    for kind in ['added', 'changed', 'removed']:
+        changes[kind].sort()
+    logger.info("Wrote %s new and %s changed pages, removed %s stale pages, %s pages were unchanged.",
+                len(changes['added']), len(changes['changed']), len(changes['removed']), changes['unchanged'])
+    return changes
+
+
+def remove_stale_pages(sitepages, docslocation):
+    """Remove the pages in docslocation which are not in sitepages, return them relative to docslocation."""
+    removed = []
+    if not os.path.exists(docslocation):
+        return removed
+    for root, _, files in os.walk(docslocation, topdown=False):
+        subdir = os.path.relpath(root, docslocation)
+        for pagename in files:
+            if pagename.endswith('.rst') and pagename not in sitepages.get(subdir, {}):
+                os.remove(os.path.join(root, pagename))
+                removed.append(os.path.join(subdir, pagename))
+        if root != docslocation and not os.listdir(root):
+            os.rmdir(root)
+    return removed
+
+
+def write_changes(changes, changes_file):
+    """Write the changes made by write_site to changes_file, for the deploy step."""
+    handle, tempname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(changes_file)))
+    with os.fdopen(handle, 'w') as fih:
+        json.dump(changes, fih, indent=2, sort_keys=True)
+    os.rename(tempname, changes_file)
+
+
+def write_page(content, subdir, pagename, docslocation, linkregex, targets):
+    """
+    Interlink the content of a single page and write it to subdir in docslocation.
+
+    The page is only written if its content changed, return True if it was written.
+    """
+    fullsubdir = os.path.join(docslocation, subdir)
+    if not os.path.exists(fullsubdir):
+        os.makedirs(fullsubdir)
+    content = encode_content(interlink_content(content, pagename, linkregex, targets))
+    pagefile = os.path.join(fullsubdir, pagename)
+    if os.path.exists(pagefile) and os.path.getsize(pagefile) == len(content):
+        with open(pagefile, 'rb') as fih:
+            if fih.read() == content:
+                return False
+    # replace the page at once, so a deploy running at the same time never sees a partial page
+    handle, tempname = tempfile.mkstemp(dir=fullsubdir, prefix='.%s' % pagename)
+    with os.fdopen(handle, 'wb') as fih:
+        fih.write(content)
+    os.chmod(tempname, 0o644)
+    os.rename(tempname, pagefile)
+    return True
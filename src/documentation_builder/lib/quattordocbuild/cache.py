@@ -0,0 +1,131 @@
+"""
+Content-addressed cache for generated rst pages.
+
+A page is stored under a key made from the hash of its source file,
+the repository settings that influence the output and the versions of
+the tools and code used to generate it, so an unchanged page can reuse
+its already cleaned up and linted content.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+from distutils.spawn import find_executable
+from vsc.utils import fancylogger
+from engine import run_tool
+
+logger = fancylogger.getLogger()
+
+# bump when the layout of cache entries changes
+CACHE_VERSION = 1
+TOOLS = ['pod2rst', 'panc-annotations', 'perl']
+# perl modules converting the perl documentation, identified by their version and location
+PERLMODULES = ['Pod::POM', 'Pod::POM::View::Restructured']
+CODEDIR = os.path.dirname(os.path.abspath(__file__))
+CODEFILES = ['panhandler.py', 'rsthandler.py', 'perlhandler.py', 'perl/pod2rst-batch.pl', 'jinja/pan.j2']
+
+_TOOL_VERSIONS = {}
+
+
+def hash_file(path):
+    """Return the sha256 hexdigest of a file."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fih:
+        for block in iter(lambda: fih.read(65536), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def perl_module_version(module):
+    """Return the version and location of a perl module, None if it can't be loaded."""
+    if not find_executable('perl'):
+        return None
+    modulefile = "%s.pm" % module.replace('::', '/')
+    errc, output = run_tool('pod2rst', ['perl', '-M%s' % module, '-e',
+                                        'print "$%s::VERSION:$INC{\'%s\'}"' % (module, modulefile)])
+    if errc != 0:
+        logger.debug("Can't load perl module %s: %s", module, output)
+        return None
+    return output
+
+
+def tool_versions():
+    """
+    Return a description of the versions of the tools and code generating the pages.
+
+    External tools are identified by the size and modification time of their executable,
+    which change whenever they are upgraded, perl modules by their version and location.
+    The result is computed once per process.
+    """
+    if not _TOOL_VERSIONS:
+        for tool in TOOLS:
+            executable = find_executable(tool)
+            if executable:
+                stat = os.stat(os.path.realpath(executable))
+                _TOOL_VERSIONS[tool] = "%s:%s:%s" % (executable, stat.st_size, int(stat.st_mtime))
+            else:
+                _TOOL_VERSIONS[tool] = None
+        for module in PERLMODULES:
+            _TOOL_VERSIONS[module] = perl_module_version(module)
+        for codefile in CODEFILES:
+            _TOOL_VERSIONS[codefile] = hash_file(os.path.join(CODEDIR, codefile))
+        logger.debug("Tool versions: %s", _TOOL_VERSIONS)
+    return _TOOL_VERSIONS
+
+
+def cache_key(sourcepage, repository):
+    """Return the cache key for a sourcepage of a repository."""
+    settings = {
+        'title': sourcepage.title,
+        'path': sourcepage.path,
+        'pan_path_prefix': sourcepage.pan_path_prefix,
+        'pan_guess_basename': sourcepage.pan_guess_basename,
+        'title_prefix': repository.title_prefix,
+        'title_pan_prefix': repository.title_pan_prefix,
+        'title_remove': repository.title_remove,
+        'remove_emails': repository.remove_emails,
+        'codify_paths': repository.codify_paths,
+        'clean_code_tags': repository.clean_code_tags,
+    }
+    keydata = json.dumps([CACHE_VERSION, hash_file(sourcepage.path), settings, tool_versions()], sort_keys=True)
+    return hashlib.sha256(keydata).hexdigest()
+
+
+def cache_file(cachedir, key):
+    """Return the location of a cache entry."""
+    return os.path.join(cachedir, key[:2], "%s.json" % key)
+
+
+def load_page(cachedir, key):
+    """
+    Look up a page in the cache.
+
+    Return a tuple (found, rstcontent), rstcontent is None for pages that had no usable content.
+    """
+    entry = cache_file(cachedir, key)
+    if not os.path.exists(entry):
+        return False, None
+    try:
+        with open(entry) as fih:
+            return True, json.load(fih)['rstcontent']
+    except (IOError, ValueError, KeyError):
+        logger.warning("Ignoring unreadable cache entry %s.", entry)
+        return False, None
+
+
+def store_page(cachedir, key, rstcontent):
+    """Store the content of a page in the cache."""
+    entry = cache_file(cachedir, key)
+    entrydir = os.path.dirname(entry)
+    if not os.path.exists(entrydir):
+        try:
+            os.makedirs(entrydir)
+        except OSError:
+            # created by another worker in the meantime
+            pass
+    # write to a temporary file first, so concurrent readers never see a partial entry
+    handle, tempname = tempfile.mkstemp(dir=entrydir)
+    with os.fdopen(handle, 'w') as fih:
+        json.dump({'rstcontent': rstcontent}, fih)
+    os.rename(tempname, entry)
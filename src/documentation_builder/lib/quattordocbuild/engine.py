@@ -0,0 +1,226 @@
+"""
+Run many external tool invocations at once from a single process.
+
+An Engine starts up to a bounded number of commands of a tool class and multiplexes
+their output with select: it is read in chunks as soon as it arrives, so no command
+blocks on a full pipe and the process never waits idle on a single child.
+The callback of a command is called as soon as it exits, while the others keep running.
+
+Every running command holds a slot of its tool class (see limits), so the limits
+shared by all build processes still apply. Commands run in their own process group,
+so a timeout also kills the processes they started.
+"""
+
+import os
+import time
+import errno
+import signal
+import select
+from collections import deque
+from subprocess import Popen, PIPE, STDOUT
+from vsc.utils import fancylogger
+from vsc.utils.run import RUNRUN_TIMEOUT_EXITCODE
+from limits import acquire_slot, release_slot, tool_slots, tool_timeout
+from tracing import add_child_usage, record_process
+
+logger = fancylogger.getLogger()
+
+READSIZE = 65536
+# seconds between attempts to get a slot held by other processes, or to reap a killed command
+SLOT_POLL = 0.05
+
+
+class Job(object):
+    """A queued or running command."""
+
+    __slots__ = ['command', 'callback', 'startpath', 'span', 'process', 'chunks', 'start', 'deadline', 'killed']
+
+    def __init__(self, command, callback, startpath=None, span=None):
+        """Initialize the job."""
+        self.command = command
+        self.callback = callback
+        self.startpath = startpath
+        self.span = span
+        self.process = None
+        self.start = None
+        self.chunks = []
+        self.deadline = None
+        self.killed = False
+
+
+class Engine(object):
+    """Run the commands of a tool class, with at most concurrency of them in flight."""
+
+    def __init__(self, tool, concurrency=None):
+        """Initialize the engine, concurrency defaults to the slots of the tool class."""
+        self.tool = tool
+        self.concurrency = max(1, concurrency or tool_slots(tool))
+        self.timeout = tool_timeout(tool)
+        self.queue = deque()
+        # running jobs per output file descriptor
+        self.running = {}
+
+    def submit(self, command, callback, startpath=None, span=None):
+        """
+        Queue command, callback(errc, output) is called once it exited.
+
+        With span (name, args), the command is traced as a span of its own, see tracing.record_process.
+        """
+        self.queue.append(Job(command, callback, startpath, span))
+
+    def run(self):
+        """
+        Run all queued commands, return once all of them exited.
+
+        An OSError is raised if a command can not be started, like asyncloop does.
+        """
+        try:
+            while self.queue or self.running:
+                self.fill()
+                if not self.running:
+                    continue
+                try:
+                    readable = select.select(list(self.running), [], [], self.wait_time())[0]
+                except select.error as err:
+                    if err.args[0] != errno.EINTR:
+                        raise
+                    readable = []
+                for fd in readable:
+                    self.read(fd)
+                self.kill_expired()
+                self.reap_killed()
+        finally:
+            self.abort()
+
+    def fill(self):
+        """Start queued commands while there are free slots, wait for one if nothing runs."""
+        while self.queue and len(self.running) < self.concurrency:
+            if not acquire_slot(self.tool, block=not self.running):
+                break
+            job = self.queue.popleft()
+            try:
+                with open(os.devnull) as devnull:
+                    job.process = Popen(job.command, stdin=devnull, stdout=PIPE, stderr=STDOUT,
+                                        cwd=job.startpath, close_fds=True, preexec_fn=os.setsid)
+            except OSError as err:
+                release_slot(self.tool)
+                logger.error("Could not start %s: %s.", job.command, err)
+                raise
+            job.start = time.time()
+            if self.timeout is not None:
+                job.deadline = job.start + self.timeout
+            self.running[job.process.stdout.fileno()] = job
+
+    def wait_time(self):
+        """Return the seconds select may wait, None to wait for output."""
+        waits = [job.deadline - time.time() for job in self.running.values()
+                 if job.deadline is not None and not job.killed]
+        if self.queue and len(self.running) < self.concurrency:
+            waits.append(SLOT_POLL)
+        if [job for job in self.running.values() if job.killed]:
+            waits.append(SLOT_POLL)
+        if not waits:
+            return None
+        return max(0, min(waits))
+
+    def read(self, fd):
+        """Read the available output of a job, finish it at the end of its output."""
+        job = self.running[fd]
+        try:
+            data = os.read(fd, READSIZE)
+        except OSError as err:
+            if err.errno in [errno.EINTR, errno.EAGAIN]:
+                return
+            raise
+        if data:
+            job.chunks.append(data)
+        else:
+            self.finish(fd)
+
+    def finish(self, fd):
+        """Reap a job and call its callback."""
+        job = self.running.pop(fd)
+        job.process.stdout.close()
+        errc = reap(job.process, span=job.span, start=job.start)
+        release_slot(self.tool)
+        if job.killed:
+            logger.warning("%s did not finish within %ss and was killed.", job.command[0], self.timeout)
+            errc = RUNRUN_TIMEOUT_EXITCODE
+        job.callback(errc, ''.join(job.chunks))
+
+    def kill_expired(self):
+        """Kill the process groups of the jobs running past their deadline."""
+        now = time.time()
+        for job in self.running.values():
+            if job.deadline is not None and not job.killed and now >= job.deadline:
+                job.killed = True
+                kill_group(job.process)
+
+    def reap_killed(self):
+        """
+        Finish the killed jobs as soon as they are reaped.
+
+        A process that left its process group may still hold the output open,
+        so the end of the output is not waited for.
+        """
+        for fd, job in self.running.items():
+            if job.killed and reap(job.process, block=False) is not None:
+                self.finish(fd)
+
+    def abort(self):
+        """Kill and reap the jobs still running, after a command could not be started or a callback failed."""
+        for fd in list(self.running):
+            job = self.running.pop(fd)
+            kill_group(job.process)
+            job.process.stdout.close()
+            reap(job.process)
+            release_slot(self.tool)
+        self.queue.clear()
+
+
+def reap(process, block=True, span=None, start=None):
+    """
+    Wait for process like Popen.wait, or check if it exited like Popen.poll if not block.
+
+    The resource usage of the process is added to the open spans, see tracing,
+    with span (name, args) it is also recorded as a span since start.
+    Return its exit code, None if it is still running.
+    """
+    while process.returncode is None:
+        try:
+            pid, status, usage = os.wait4(process.pid, 0 if block else os.WNOHANG)
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                continue
+            raise
+        if not pid:
+            return None
+        add_child_usage(usage)
+        if span is not None:
+            record_process(span[0], start, usage, span[1])
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+    return process.returncode
+
+
+def kill_group(process):
+    """Kill the process group of a command started by an engine."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def run_tool(tool, command, startpath=None):
+    """
+    Run command as an invocation of tool class, within its limits.
+
+    Return the exit code and output (stdout and stderr), like asyncloop.
+    """
+    results = []
+    engine = Engine(tool, 1)
+    engine.submit(command, lambda errc, output: results.append((errc, output)), startpath)
+    engine.run()
+    return results[0]
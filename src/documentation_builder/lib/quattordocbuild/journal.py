@@ -0,0 +1,147 @@
+"""
+Checkpoint journal of a documentation build.
+
+Every generated page, completed repository and failure is appended to a JSON lines
+file as soon as it is known, next to the spool with the generated pages.
+A resumed build takes the completed pages and repositories from the journal
+and only redoes the missing and failed ones.
+"""
+
+import os
+import json
+import shutil
+import threading
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger()
+
+JOURNALDIR = '.journal'
+JOURNALFILE = 'journal.jsonl'
+
+
+class Journal(object):
+    """
+    The journal of a build.
+
+    Without a location, nothing is written and only the failures of the run are kept.
+    """
+
+    def __init__(self, location=None, resume=False):
+        """Open the journal in location, replaying its previous entries when resuming."""
+        self.location = location
+        self.lock = threading.Lock()
+        # status of every repository, done or failed
+        self.repositories = {}
+        # manifest of every completed page per repository, by source path
+        self.pages = {}
+        # (repository, source, error) of every failure in this run, source is None for a repository
+        self.failures = []
+        self.handle = None
+        if location is None:
+            return
+
+        path = os.path.join(location, JOURNALFILE)
+        if resume and os.path.exists(path):
+            self.replay(path)
+        elif os.path.exists(location):
+            shutil.rmtree(location)
+        if not os.path.exists(self.spooldir):
+            os.makedirs(self.spooldir)
+        self.handle = open(path, 'a')
+
+    @property
+    def spooldir(self):
+        """The directory with the generated pages, None without location."""
+        if self.location is None:
+            return None
+        return os.path.join(self.location, 'spool')
+
+    def replay(self, path):
+        """Restore the completed pages and repositories from the journal file."""
+        with open(path) as fih:
+            for line in fih:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last entry of an interrupted build may be incomplete
+                    logger.debug("Skipping incomplete journal entry %s.", line)
+                    continue
+                name = entry['repository']
+                if entry['unit'] == 'repository':
+                    self.repositories[name] = entry['status']
+                elif entry['status'] == 'done':
+                    self.pages.setdefault(name, {})[entry['source']] = entry['manifest']
+                else:
+                    self.pages.setdefault(name, {}).pop(entry['source'], None)
+
+        for name, pages in self.pages.items():
+            for source, manifest in pages.items():
+                if manifest and not os.path.exists(manifest['spool']):
+                    logger.warning("Spooled page of %s is missing, it will be generated again.", source)
+                    del pages[source]
+                    self.repositories.pop(name, None)
+        logger.info("Resuming from %s: %s repositories and %s pages were completed before.", path,
+                    len(self.completed()), sum([len(pages) for pages in self.pages.values()]))
+
+    def record(self, **entry):
+        """Append an entry to the journal file."""
+        if self.handle is None:
+            return
+        with self.lock:
+            self.handle.write("%s\n" % json.dumps(entry, sort_keys=True))
+            self.handle.flush()
+
+    def page_done(self, repository, source, manifest):
+        """Record a generated page, manifest is None if it has no content."""
+        self.pages.setdefault(repository, {})[source] = manifest
+        self.record(unit='page', repository=repository, source=source, status='done', manifest=manifest)
+
+    def page_failed(self, repository, source, error):
+        """Record a page which could not be generated."""
+        logger.error("Generating %s of %s failed: %s", source, repository, error)
+        self.failures.append((repository, source, error))
+        self.record(unit='page', repository=repository, source=source, status='failed', error=error)
+
+    def repository_done(self, repository):
+        """Record a repository of which all pages are generated."""
+        self.repositories[repository] = 'done'
+        self.record(unit='repository', repository=repository, status='done')
+
+    def repository_failed(self, repository, error):
+        """Record a repository which could not be (completely) built."""
+        logger.error("Building %s failed: %s", repository, error)
+        self.repositories[repository] = 'failed'
+        self.failures.append((repository, None, error))
+        self.record(unit='repository', repository=repository, status='failed', error=error)
+
+    def completed(self):
+        """Return the names of the completed repositories."""
+        return sorted([name for name, status in self.repositories.items() if status == 'done'])
+
+    def done_pages(self, repository):
+        """Return the manifests of the generated pages of a repository by source path."""
+        return dict(self.pages.get(repository, {}))
+
+    def manifests(self, repository):
+        """Return the manifests of the generated pages with content of a repository."""
+        return [manifest for manifest in self.pages.get(repository, {}).values() if manifest]
+
+    def summary(self):
+        """Return a report of the failures of this run."""
+        lines = ["%s units failed, run again with --resume to redo them:" % len(self.failures)]
+        for repository, source, error in self.failures:
+            lines.append("  %s%s: %s" % (repository, " %s" % source if source else '', error))
+        return "\n".join(lines)
+
+    def close(self):
+        """Close the journal file."""
+        if self.handle is not None:
+            os.fsync(self.handle.fileno())
+            self.handle.close()
+            self.handle = None
+
+    def remove(self):
+        """Close and remove the journal and its spool, once the build is complete."""
+        self.close()
+        if self.location is not None and os.path.exists(self.location):
+            shutil.rmtree(self.location)
@@ -0,0 +1,121 @@
+/*
+ * Client for the search index written by quattordocbuild/search.py.
+ *
+ * The tokenizer, stemmer and ranking are the same as in search.py.
+ * Usage: var index = new QuattorSearch('_search/');
+ *        index.search('configure ccm').then(function (results) { ... });
+ * Every result is {path: ..., title: ..., rank: ...}.
+ */
+(function (root) {
+    'use strict';
+
+    var STOPWORDS = ['an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'if', 'in', 'is', 'it', 'of',
+                     'on', 'or', 'that', 'the', 'this', 'to', 'with'];
+    var STEMSUFFIXES = [
+        [['sses', 'ss'], ['ies', 'y'], ['ss', 'ss'], ['us', 'us'], ['s', '']],
+        [['ing', ''], ['ed', '']],
+        [['e', '']]
+    ];
+    var MIN_STEM = 3;
+
+    function endsWith(term, suffix) {
+        return term.length >= suffix.length && term.slice(term.length - suffix.length) === suffix;
+    }
+
+    function stem(term) {
+        if (/^[0-9]+$/.test(term)) {
+            return term;
+        }
+        STEMSUFFIXES.forEach(function (suffixes) {
+            for (var i = 0; i < suffixes.length; i++) {
+                var suffix = suffixes[i][0], replacement = suffixes[i][1];
+                if (endsWith(term, suffix)) {
+                    if (term.length - suffix.length + replacement.length >= MIN_STEM) {
+                        term = term.slice(0, term.length - suffix.length) + replacement;
+                    }
+                    break;
+                }
+            }
+        });
+        return term;
+    }
+
+    function terms(text) {
+        var tokens = text.toLowerCase().match(/[a-z0-9]+/g) || [];
+        return tokens.filter(function (token) {
+            return token.length > 1 && STOPWORDS.indexOf(token) < 0;
+        }).map(stem);
+    }
+
+    function getJSON(url) {
+        return fetch(url).then(function (response) {
+            return response.ok ? response.json() : {};
+        });
+    }
+
+    function QuattorSearch(location) {
+        this.location = location;
+        this.shards = {};
+        this.meta = getJSON(location + 'meta.json');
+        this.pages = null;
+    }
+
+    QuattorSearch.prototype.shard = function (name) {
+        if (!(name in this.shards)) {
+            this.shards[name] = getJSON(this.location + name + '.json');
+        }
+        return this.shards[name];
+    };
+
+    QuattorSearch.prototype.search = function (query, limit) {
+        var self = this;
+        limit = limit || 10;
+        var unique = terms(query).filter(function (term, index, all) {
+            return all.indexOf(term) === index;
+        });
+        return this.meta.then(function (meta) {
+            return Promise.all(unique.map(function (term) {
+                return self.shard(term.slice(0, meta.shard_prefix)).then(function (shard) {
+                    return shard[term] || [];
+                });
+            })).then(function (allPostings) {
+                var ranks = null;
+                allPostings.forEach(function (postings) {
+                    var idf = Math.log(1 + meta.pages / Math.max(1, postings.length));
+                    var termRanks = {};
+                    postings.forEach(function (posting) {
+                        termRanks[posting[0]] = Math.log(1 + posting[1]) * idf;
+                    });
+                    if (ranks === null) {
+                        ranks = termRanks;
+                    } else {
+                        var combined = {};
+                        Object.keys(ranks).forEach(function (pageid) {
+                            if (pageid in termRanks) {
+                                combined[pageid] = ranks[pageid] + termRanks[pageid];
+                            }
+                        });
+                        ranks = combined;
+                    }
+                });
+                if (!ranks || !Object.keys(ranks).length) {
+                    return [];
+                }
+                if (self.pages === null) {
+                    self.pages = getJSON(self.location + 'pages.json');
+                }
+                return self.pages.then(function (pages) {
+                    return Object.keys(ranks).map(Number).sort(function (a, b) {
+                        return ranks[b] - ranks[a] || a - b;
+                    }).slice(0, limit).map(function (pageid) {
+                        return {path: pages[pageid][0], title: pages[pageid][1], rank: ranks[pageid]};
+                    });
+                });
+            });
+        });
+    };
+
+    QuattorSearch.terms = terms;
+    QuattorSearch.stem = stem;
+    root.QuattorSearch = QuattorSearch;
+}(typeof window !== 'undefined' ? window : this));
@@ -0,0 +1,134 @@
+"""
+Concurrency, memory and time limits for the external tools.
+
+Every class of tools has its own limits, shared by all build processes:
+ - concurrency: the maximum number of invocations running at the same time
+ - memory: the expected peak memory of an invocation in MB
+ - memory_budget: the memory in MB all running invocations of the class may use together, None for no budget
+ - timeout: seconds after which an invocation is killed, None for no timeout
+
+The number of slots of a class is the smallest of its concurrency and memory_budget // memory.
+The slots are semaphores created by configure_limits before the build pool is started,
+so the workers inherit them. Without configure_limits, only the timeouts apply.
+"""
+
+import time
+from contextlib import contextmanager
+from multiprocessing import BoundedSemaphore, cpu_count
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger()
+
+LIMITKEYS = ['concurrency', 'memory', 'memory_budget', 'timeout']
+# maven has no default timeout: a reactor build compiles every repository in a single run
+DEFAULT_LIMITS = {
+    'maven': {'concurrency': max(1, cpu_count() // 8), 'memory': 1024, 'memory_budget': None, 'timeout': None},
+    'panc': {'concurrency': max(1, cpu_count() // 4), 'memory': 512, 'memory_budget': None, 'timeout': 900},
+    'pod2rst': {'concurrency': cpu_count(), 'memory': 64, 'memory_budget': None, 'timeout': 300},
+}
+# limits and semaphore per tool class, set by configure_limits
+SLOTS = {}
+
+
+def parse_limits(specs):
+    """
+    Parse a list of limits like maven:concurrency=2 or panc:memory_budget=4096.
+
+    Return a dictionary with the limits per tool class, None if a limit is invalid.
+    The value none removes a budget or timeout.
+    """
+    limits = {}
+    for spec in specs or []:
+        try:
+            tool, setting = spec.split(':', 1)
+            key, value = setting.split('=', 1)
+        except ValueError:
+            logger.error("Invalid tool limit %s, expected tool:limit=value.", spec)
+            return None
+        if tool not in DEFAULT_LIMITS or key not in LIMITKEYS:
+            logger.error("Invalid tool limit %s, tools are %s and limits are %s.", spec,
+                         ', '.join(sorted(DEFAULT_LIMITS)), ', '.join(LIMITKEYS))
+            return None
+        if value.lower() == 'none' and key in ['memory_budget', 'timeout']:
+            value = None
+        else:
+            try:
+                value = float(value) if key == 'timeout' else int(value)
+            except ValueError:
+                logger.error("Invalid value for tool limit %s.", spec)
+                return None
+            if value <= 0:
+                logger.error("Tool limit %s must be positive.", spec)
+                return None
+        limits.setdefault(tool, {})[key] = value
+    return limits
+
+
+def tool_limits(tool, overrides=None):
+    """Return the limits of a tool class, with the overrides of parse_limits applied."""
+    limits = dict(DEFAULT_LIMITS[tool])
+    limits.update((overrides or {}).get(tool, {}))
+    slots = limits['concurrency']
+    if limits['memory_budget'] is not None:
+        slots = min(slots, max(1, limits['memory_budget'] // limits['memory']))
+    limits['slots'] = slots
+    return limits
+
+
+def configure_limits(overrides=None):
+    """Create the slots of every tool class, must be called before worker processes are started."""
+    SLOTS.clear()
+    for tool in sorted(DEFAULT_LIMITS):
+        limits = tool_limits(tool, overrides)
+        limits['semaphore'] = BoundedSemaphore(limits['slots'])
+        SLOTS[tool] = limits
+        timeout = 'no timeout' if limits['timeout'] is None else 'timeout %ss' % limits['timeout']
+        logger.info("Running at most %s %s jobs at once (%s).", limits['slots'], tool, timeout)
+
+
+def tool_timeout(tool):
+    """Return the timeout of an invocation of tool."""
+    if tool in SLOTS:
+        return SLOTS[tool]['timeout']
+    return DEFAULT_LIMITS[tool]['timeout']
+
+
+def tool_slots(tool):
+    """Return the number of invocations of tool that may run at once."""
+    if tool in SLOTS:
+        return SLOTS[tool]['slots']
+    return tool_limits(tool)['slots']
+
+
+def acquire_slot(tool, block=True):
+    """
+    Take a slot of tool class, waiting for one to be free if block is set.
+
+    Return False if no slot was free and block is not set.
+    """
+    semaphore = SLOTS.get(tool, {}).get('semaphore')
+    if semaphore is None or semaphore.acquire(False):
+        return True
+    if not block:
+        return False
+    start = time.time()
+    semaphore.acquire()
+    logger.debug("Waited %.2fs for a %s slot.", time.time() - start, tool)
+    return True
+
+
+def release_slot(tool):
+    """Give back a slot of tool class."""
+    semaphore = SLOTS.get(tool, {}).get('semaphore')
+    if semaphore is not None:
+        semaphore.release()
+
+
+@contextmanager
+def tool_slot(tool):
+    """Hold a slot of tool class while running an invocation, waiting for one to be free."""
+    acquire_slot(tool)
+    try:
+        yield
+    finally:
+        release_slot(tool)
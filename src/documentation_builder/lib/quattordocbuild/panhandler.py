@@ -6,72 +6,187 @@ import tempfile
 import shutil
 import jinja2
 from vsc.utils import fancylogger
-from vsc.utils.run import asyncloop
 from lxml import etree
+from tracing import traced
+from engine import run_tool
 
 logger = fancylogger.getLogger()
 namespace = "{http://quattor.org/pan/annotations}"
+# maximum number of pan files passed to a single panc-annotations run
+BATCH_SIZE = 250
+JINJADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jinja')
+# jinja environment of this process, created on first use
+JINJA = {}
+# lines of pan.j2 with the names of types, fields, functions and variables, per section
+KEYWORDREGEXES = {
+    'Types': [('type', re.compile(r'^ - \*\*(?:.*/)?([^/*]+)\*\*$')),
+              ('field', re.compile(r'^    - \*(?:.*/)?([^/*]+)\*$'))],
+    'Functions': [('function', re.compile(r'^ - (\S+)$'))],
+    'Variables': [('variable', re.compile(r'^ - (\S+)$'))],
+}
+
+# tags and precompiled searches used to make records from the annotations
+NAMESPACES = {'a': namespace[1:-1]}
+BASETYPE = '%sbasetype' % namespace
+DEFAULT = '%sdefault' % namespace
+DESC = '%sdesc' % namespace
+DOCUMENTATION = '%sdocumentation' % namespace
+DOCDESCXPATH = etree.XPath('a:documentation/a:desc', namespaces=NAMESPACES)
+DESCXPATH = etree.XPath('a:desc', namespaces=NAMESPACES)
+FIELDXPATH = etree.XPath('.//a:field', namespaces=NAMESPACES)
+BASETYPEXPATH = etree.XPath('(.//a:basetype)[1]', namespaces=NAMESPACES)
+DEFAULTXPATH = etree.XPath('a:default', namespaces=NAMESPACES)
+VALUESXPATH = etree.XPath('(.//a:values)[1]', namespaces=NAMESPACES)
+ARGXPATH = etree.XPath('.//a:arg', namespaces=NAMESPACES)
+
+
+def rst_from_pan(panfile, title, path_prefix, guess_basename, annotationfile=None):
+    """
+    Make reStructuredText from a pan annotated file.
 
-
-def rst_from_pan(panfile, title, path_prefix, guess_basename):
-    """Make reStructuredText from a pan annotated file."""
+    If annotationfile is given, it is used instead of running panc-annotations on panfile.
+    Return None if panc-annotations failed.
+    """
     logger.info("Making rst from pan: %s.", panfile)
-    content = get_content_from_pan(panfile)
+    content = get_content_from_pan(panfile, annotationfile)
     logger.debug(content)
+    if content is None:
+        return None
     basename = ''
     if guess_basename:
         basename = get_basename(panfile)
     if path_prefix:
         basename = '%s%s/' % (path_prefix, basename)
-    output = render_template(content, basename, title)
-    if not output:
-        output = None
-    return output
+    return render_template(content, basename, title)
+
+
+def get_jinja_environment():
+    """
+    Return the jinja environment of this process.
+
+    It is created once per process, compiled templates are kept in a bytecode cache on disk
+    so other processes don't have to parse them again.
+    """
+    if 'environment' not in JINJA:
+        loader = jinja2.FileSystemLoader(JINJADIR)
+        JINJA['environment'] = jinja2.Environment(loader=loader, trim_blocks=True, lstrip_blocks=True,
+                                                  bytecode_cache=jinja2.FileSystemBytecodeCache())
+    return JINJA['environment']
 
 
 def render_template(content, basename, title):
     """Render the template."""
-    loader = jinja2.FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jinja'))
-    jenv = jinja2.Environment(loader=loader, trim_blocks=True, lstrip_blocks=True)
-    template = jenv.get_template('pan.j2')
+    template = get_jinja_environment().get_template('pan.j2')
     output = template.render(content=content, basename=basename, title=title)
     return output
 
 
-def get_content_from_pan(panfile):
-    """Return the information of all types and functions from a pan annotated file."""
-    content = {}
+def get_content_from_pan(panfile, annotationfile=None):
+    """
+    Return the information of all types and functions from a pan annotated file.
+
+    Without a (batch built) annotationfile, panc-annotations is run on panfile alone,
+    None is returned if that fails.
+    """
+    if annotationfile is not None and os.path.exists(annotationfile):
+        return get_content_from_annotations(annotationfile)
+
+    content = None
     tempdir = tempfile.mkdtemp()
     directory, filename = os.path.split(panfile)
     built = build_annotations(filename, directory, tempdir)
     if built:
-        xmlroot = validate_annotations(os.path.join(tempdir, "%s.annotation.xml" % filename))
-        if xmlroot is not None:
-            types, functions, variables = get_types_and_functions(xmlroot)
-            if types is not None:
-                content['types'] = []
-                for ptype in types:
-                    content['types'].append(parse_type(ptype))
-
-            if functions is not None:
-                content['functions'] = []
-                for function in functions:
-                    content['functions'].append(parse_function(function))
-
-            if variables is not None:
-                content['variables'] = []
-                for variable in variables:
-                    content['variables'].append(parse_variable(variable))
+        content = get_content_from_annotations(os.path.join(tempdir, "%s.annotation.xml" % filename))
     shutil.rmtree(tempdir)
     return content
 
 
+def get_content_from_annotations(annotationfile):
+    """Return the information of all types and functions from a pan annotations XML file."""
+    content = {'types': [], 'functions': [], 'variables': []}
+    for record in iter_annotations(annotationfile):
+        content[record.kind].append(record.as_dict())
+
+    if not any(content.values()):
+        logger.debug("%s has no usable content, skipping it.", annotationfile)
+        return {}
+    return content
+
+
+def iter_annotations(annotationfile):
+    """
+    Yield a record for every type, function and variable of a pan annotations XML file.
+
+    The file is parsed incrementally, every top level element is cleared once its record is made,
+    so memory use is bounded by the largest type instead of the whole file.
+    """
+    parser = etree.iterparse(annotationfile, events=('end',), tag=RECORDS.keys(), remove_blank_text=True,
+                             remove_comments=True)
+    for _, element in parser:
+        parent = element.getparent()
+        if parent is None or parent.getparent() is not None:
+            # nested element, handled with its top level element
+            continue
+        yield RECORDS[element.tag].from_element(element)
+        element.clear()
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def annotate_pan_files(panfiles, outputdir):
+    """
+    Build pan annotations for a list of pan files with as few panc-annotations runs as possible.
+
+    All files are passed relative to their common base directory.
+    Returns a dictionary with the annotation file of every pan file that was annotated successfully,
+    files missing from it should fall back to get_content_from_pan on their own.
+    """
+    if not panfiles:
+        return {}
+    basedir = os.path.commonprefix([os.path.dirname(panfile) + os.sep for panfile in panfiles])
+    basedir = basedir[:basedir.rfind(os.sep) + 1] or os.sep
+    relfiles = [os.path.relpath(panfile, basedir) for panfile in panfiles]
+
+    annotations = {}
+    for index in xrange(0, len(relfiles), BATCH_SIZE):
+        for relfile, annotationfile in build_annotations_batch(relfiles[index:index + BATCH_SIZE],
+                                                               basedir, outputdir).iteritems():
+            annotations[os.path.join(basedir, relfile)] = annotationfile
+
+    logger.info("Batch annotated %s of %s pan files in %s.", len(annotations), len(panfiles), basedir)
+    return annotations
+
+
+@traced('build_annotations', lambda pfiles, basedir, outputdir: {'files': len(pfiles)})
+def build_annotations_batch(pfiles, basedir, outputdir):
+    """
+    Build pan annotations for several files in one panc-annotations run.
+
+    Return a dictionary mapping each file for which an annotation file was built to that file.
+    """
+    panccommand = ["panc-annotations", "--output-dir", outputdir, "--base-dir", basedir]
+    panccommand.extend(pfiles)
+    logger.debug("Running %s.", panccommand)
+    errc, output = run_tool('panc', panccommand)
+    logger.debug(output)
+    if errc != 0:
+        logger.warning("panc-annotations batch run in %s exited with %s.", basedir, errc)
+
+    annotations = {}
+    for pfile in pfiles:
+        annotationfile = os.path.join(outputdir, "%s.annotation.xml" % pfile)
+        if os.path.exists(annotationfile):
+            annotations[pfile] = annotationfile
+    return annotations
+
+
+@traced('build_annotations', lambda pfile, basedir, outputdir: {'page': pfile})
 def build_annotations(pfile, basedir, outputdir):
     """Build pan annotations."""
     panccommand = ["panc-annotations", "--output-dir", outputdir, "--base-dir", basedir]
     panccommand.append(pfile)
     logger.debug("Running %s.", panccommand)
-    errc, output = output = asyncloop(panccommand)
+    errc, output = run_tool('panc', panccommand)
     logger.debug(output)
     if errc == 0 and os.path.exists(os.path.join(outputdir, "%s.annotation.xml" % pfile)):
         return True
@@ -116,84 +231,223 @@ def get_types_and_functions(root):
 
 def find_description(element):
     """Search for the desc tag, even if it is in documentation tag."""
-    desc = element.find("./%sdocumentation/%sdesc" % (namespace, namespace))
+    desc = first(DOCDESCXPATH(element))
     if desc is None:
-        desc = element.find("./%sdesc" % namespace)
+        desc = first(DESCXPATH(element))
     return desc
 
+
+def first(elements):
+    """Return the first of a list of elements, None if it is empty."""
+    if elements:
+        return elements[0]
+    return None
+
+
 def cleanup_description(desc):
     """Clean up a multiline description."""
     return " ".join(desc.replace('\n', ' ').replace('\r', ' ').split())
 
-def parse_type(ptype):
-    """Parse a type from an XML Element Tree."""
-    typeinfo = {}
-    typeinfo['name'] = ptype.get('name')
-    desc = find_description(ptype)
-    if desc is not None:
-        typeinfo['desc'] = cleanup_description(desc.text)
-
-    typeinfo['fields'] = []
-
-    for field in ptype.findall(".//%sfield" % namespace):
-        fieldinfo = {}
-        fieldinfo['name'] = field.get('name')
-        desc = find_description(field)
-        if desc is not None:
-            fieldinfo['desc'] = cleanup_description(desc.text)
 
-        fieldinfo['required'] = field.get('required')
-        basetype = field.find(".//%sbasetype" % namespace)
+def element_description(element):
+    """Return the cleaned up description of an element, None if it has none."""
+    desc = find_description(element)
+    if desc is None:
+        return None
+    return cleanup_description(desc.text)
+
+
+def escape_default(default):
+    """Escape the characters of a default value which have a meaning in reStructuredText."""
+    if '`' in default:
+        default = default.replace('`', '\\`')
+    if default.endswith('_'):
+        default = default.replace('_', '\\_')
+    return default
+
+
+class AnnotationRecord(object):
+    """Base class of the records made from pan annotations."""
+
+    __slots__ = ()
+    # attributes which are always in the dictionary, the others only when they are set
+    always = ()
+
+    def as_dict(self):
+        """Return the record as a dictionary, without the optional attributes that are not set."""
+        info = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None or name in self.always:
+                info[name] = value
+        return info
+
+    def __repr__(self):
+        """Return a representation of the record."""
+        return "%s(%s)" % (self.__class__.__name__, self.as_dict())
+
+
+class Field(AnnotationRecord):
+    """A field of a pan type."""
+
+    __slots__ = ('name', 'desc', 'required', 'type', 'range', 'default')
+    always = ('name', 'required', 'type')
+
+    def __init__(self, name, desc=None, required=None, fieldtype=None, fieldrange=None, default=None):
+        """Initialize the field."""
+        self.name = name
+        self.desc = desc
+        self.required = required
+        self.type = fieldtype
+        self.range = fieldrange
+        self.default = default
+
+    @classmethod
+    def from_element(cls, field):
+        """Make a field from its XML element."""
+        # a single pass over the children, fields are by far the most common elements
+        children = {}
+        for child in field:
+            children.setdefault(child.tag, child)
+        basetype = children.get(BASETYPE)
+        if basetype is None:
+            basetype = first(BASETYPEXPATH(field))
         fieldtype = basetype.get('name')
-        fieldinfo['type'] = fieldtype
-        if fieldtype == "long" and basetype.get('range'):
-            fieldinfo['range'] = basetype.get('range')
-
-        fielddefault = field.find(".//%sdefault" % namespace)
-        if fielddefault is not None:
-            fielddeftext = fielddefault.get('text')
-            if '`' in fielddeftext:
-                fielddeftext = fielddeftext.replace('`', '\`')
-
-            if fielddeftext.endswith('_'):
-                fielddeftext = fielddeftext.replace('_', '\_')
+        fieldrange = None
+        if fieldtype == "long":
+            fieldrange = basetype.get('range') or None
+        default = children.get(DEFAULT)
+        if default is not None:
+            default = escape_default(default.get('text'))
+        desc = children.get(DOCUMENTATION)
+        if desc is not None:
+            desc = desc.find(DESC)
+        if desc is None:
+            desc = children.get(DESC)
+        if desc is not None:
+            desc = cleanup_description(desc.text)
+        return cls(field.get('name'), desc, field.get('required'), fieldtype, fieldrange, default)
+
+
+class Type(AnnotationRecord):
+    """A pan type."""
+
+    __slots__ = ('name', 'desc', 'fields')
+    always = ('name', 'fields')
+    kind = 'types'
+
+    def __init__(self, name, desc=None, fields=None):
+        """Initialize the type."""
+        self.name = name
+        self.desc = desc
+        self.fields = fields or []
+
+    @classmethod
+    def from_element(cls, ptype):
+        """Make a type from its XML element."""
+        fields = [Field.from_element(field) for field in FIELDXPATH(ptype)]
+        return cls(ptype.get('name'), element_description(ptype), fields)
+
+    def as_dict(self):
+        """Return the type as a dictionary, with its fields as dictionaries."""
+        info = AnnotationRecord.as_dict(self)
+        info['fields'] = [field.as_dict() for field in self.fields]
+        return info
+
+
+class Function(AnnotationRecord):
+    """A pan function."""
+
+    __slots__ = ('name', 'desc', 'args')
+    always = ('name', 'args')
+    kind = 'functions'
+
+    def __init__(self, name, desc=None, args=None):
+        """Initialize the function."""
+        self.name = name
+        self.desc = desc
+        self.args = args or []
+
+    @classmethod
+    def from_element(cls, function):
+        """Make a function from its XML element."""
+        args = [cleanup_description(arg.text) for arg in ARGXPATH(function)]
+        return cls(function.get('name'), element_description(function), args)
+
+    def as_dict(self):
+        """Return the function as a dictionary."""
+        info = AnnotationRecord.as_dict(self)
+        info['args'] = list(self.args)
+        return info
+
+
+class Variable(AnnotationRecord):
+    """A pan variable."""
+
+    __slots__ = ('name', 'desc', 'default', 'varvalues')
+    always = ('name',)
+    kind = 'variables'
+
+    def __init__(self, name, desc=None, default=None, varvalues=None):
+        """Initialize the variable."""
+        self.name = name
+        self.desc = desc
+        self.default = default
+        self.varvalues = varvalues
+
+    @classmethod
+    def from_element(cls, pvar):
+        """Make a variable from its XML element."""
+        default = first(DEFAULTXPATH(pvar))
+        if default is not None:
+            default = default.get('text')
+        varvalues = first(VALUESXPATH(pvar))
+        if varvalues is not None:
+            varvalues = varvalues.get('text')
+        return cls(pvar.get('name'), element_description(pvar), default, varvalues)
+
+
+RECORDS = {
+    '%stype' % namespace: Type,
+    '%sfunction' % namespace: Function,
+    '%svariable' % namespace: Variable,
+}
 
-            fieldinfo['default'] = fielddeftext
-        typeinfo['fields'].append(fieldinfo)
 
-    return typeinfo
+def parse_type(ptype):
+    """Parse a type from an XML Element Tree."""
+    return Type.from_element(ptype).as_dict()
 
 
 def parse_function(function):
     """Parse a function from an XML Element Tree."""
-    functinfo = {}
-    functinfo['name'] = function.get('name')
-    desc = find_description(function)
-    if desc is not None:
-        functinfo['desc'] = cleanup_description(desc.text)
-    functinfo['args'] = []
-    for arg in function.findall(".//%sarg" % namespace):
-        functinfo['args'].append(cleanup_description(arg.text))
+    return Function.from_element(function).as_dict()
 
-    return functinfo
 
 def parse_variable(pvar):
-    """Parse a type from an XML Element Tree."""
-    varinfo = {}
-    varinfo['name'] = pvar.get('name')
-    desc = find_description(pvar)
-    if desc is not None:
-        varinfo['desc'] = cleanup_description(desc.text)
+    """Parse a variable from an XML Element Tree."""
+    return Variable.from_element(pvar).as_dict()
 
-    vardefault = pvar.get('default')
-    if vardefault is not None:
-        varinfo['default'] = vardefault.get('text')
 
-    varvalues = pvar.find(".//%svalues" % namespace)
-    if varvalues is not None:
-        varinfo['varvalues'] = varvalues.get('text')
+def pan_keywords(rst):
+    """
+    Return the names of the types, fields, functions and variables documented in a page rendered with pan.j2.
 
-    return varinfo
+    The result maps type, field, function and variable to a list of names.
+    """
+    keywords = {}
+    regexes = []
+    previous = None
+    for line in rst.splitlines():
+        if line.startswith('---') and previous is not None:
+            regexes = KEYWORDREGEXES.get(previous.strip(), [])
+        for kind, regex in regexes:
+            match = regex.match(line)
+            if match:
+                keywords.setdefault(kind, []).append(match.group(1))
+                break
+        previous = line
+    return keywords
 
 
 def get_basename(path):
@@ -0,0 +1,36 @@
+#!/usr/bin/perl
+#
+# Convert many pod files to reStructuredText in a single perl process,
+# the same way pod2rst does for a single file.
+#
+# Reads lines "<infile>\t<title>" on stdin. For each line it writes
+# "<status> <length>\n" to stdout, followed by <length> bytes of
+# reStructuredText. A non-zero status means the conversion failed.
+
+use strict;
+use warnings;
+
+use Encode qw(encode_utf8);
+use Pod::POM::View::Restructured;
+
+$| = 1;
+binmode STDOUT;
+
+while (my $line = <STDIN>) {
+    chomp $line;
+    my ($infile, $title) = split /\t/, $line, 2;
+
+    my $content = eval {
+        my $conv = Pod::POM::View::Restructured->new();
+        my $rv = $conv->convert_file($infile, $title);
+        $rv ? $rv->{content} : undef;
+    };
+    warn "pod2rst-batch: conversion of $infile failed: $@" if $@;
+
+    if (defined $content) {
+        $content = encode_utf8($content) if utf8::is_utf8($content);
+        print "0 ", length($content), "\n", $content;
+    } else {
+        print "1 0\n";
+    }
+}
@@ -0,0 +1,124 @@
+"""
+Convert perl documentation with long-lived pod2rst converters.
+
+Instead of starting a perl interpreter per file, a converter process
+(perl/pod2rst-batch.pl) reads many (infile, title) pairs on stdin and
+writes the reStructuredText of every file back on stdout.
+"""
+
+import os
+import threading
+import Queue
+from subprocess import Popen, PIPE
+from vsc.utils import fancylogger
+from tracing import traced
+from limits import tool_slot, tool_timeout
+
+logger = fancylogger.getLogger()
+
+POD2RST_BATCH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perl', 'pod2rst-batch.pl')
+# converter of this process, created on first use
+CONVERTERS = {}
+
+
+class Pod2rst(object):
+    """A long-lived pod2rst converter process."""
+
+    def __init__(self, command=None):
+        """Initialize the converter, the process is started on the first conversion."""
+        self.command = command or ['perl', POD2RST_BATCH]
+        self.process = None
+
+    def start(self):
+        """Start the converter process."""
+        logger.debug("Starting pod2rst converter %s.", self.command)
+        with open(os.devnull, 'w') as devnull:
+            self.process = Popen(self.command, stdin=PIPE, stdout=PIPE, stderr=devnull)
+
+    def convert(self, podfile, title):
+        """Convert a single file, return its reStructuredText or None if the conversion failed."""
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        timeout = tool_timeout('pod2rst')
+        # a converter stuck on a file is killed, and restarted for the next one
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, self.process.kill)
+        try:
+            with tool_slot('pod2rst'):
+                if timer is not None:
+                    timer.start()
+                self.process.stdin.write("%s\t%s\n" % (podfile, title))
+                self.process.stdin.flush()
+                header = self.process.stdout.readline().split()
+                status, length = int(header[0]), int(header[1])
+                output = self.process.stdout.read(length)
+        except (IOError, IndexError, ValueError):
+            logger.warning("pod2rst converter died while converting %s.", podfile)
+            self.close()
+            return None
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        if status != 0 or len(output) != length:
+            return None
+        return output.decode('utf-8', 'replace')
+
+    def close(self):
+        """Stop the converter process."""
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except IOError:
+                pass
+            self.process.wait()
+            self.process = None
+
+
+def get_converter():
+    """Return the converter of this process."""
+    if 'converter' not in CONVERTERS:
+        CONVERTERS['converter'] = Pod2rst()
+    return CONVERTERS['converter']
+
+
+@traced('rst_from_perl', lambda pairs, *args, **kwargs: {'files': len(pairs)})
+def convert_perl_files(pairs, processes=1, command=None):
+    """
+    Convert a list of (podfile, title) pairs to reStructuredText.
+
+    With a single process, the converter of this process is used (and kept for later calls),
+    otherwise up to processes converters running command work through the files in parallel.
+    Return a dictionary with the output per podfile, which is None if the conversion failed.
+    """
+    results = {}
+    if processes <= 1:
+        converter = get_converter()
+        for podfile, title in pairs:
+            results[podfile] = converter.convert(podfile, title)
+        return results
+
+    todo = Queue.Queue()
+    for pair in pairs:
+        todo.put(pair)
+
+    def work():
+        """Convert files from the queue until it is empty."""
+        converter = Pod2rst(command)
+        try:
+            while True:
+                try:
+                    podfile, title = todo.get_nowait()
+                except Queue.Empty:
+                    break
+                results[podfile] = converter.convert(podfile, title)
+        finally:
+            converter.close()
+
+    workers = [threading.Thread(target=work) for _ in xrange(min(processes, len(pairs)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
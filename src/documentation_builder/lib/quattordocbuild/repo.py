@@ -45,6 +45,10 @@ class Repo(object):
         self.sources = []
         # a list of files to move [source, destination, ignore_patterns]
         self.movefiles = []
+        # how movefiles are staged: 'copy', 'hardlink' or 'symlink'
+        self.movefiles_mode = 'hardlink'
+        # spread the pages over all shards instead of building the repository in a single shard
+        self.shard_pages = False
 
         self.configure()
         self.create_paths()
@@ -169,6 +173,7 @@ class Repo(object):
         self.title_pan_prefix = '/NCM/Component/'
         self.pan_path_prefix = '/software/components/'
         self.pan_guess_basename = True
+        self.shard_pages = True
         self.movefiles.append(
             ['ncm-metaconfig/src/main/metaconfig/',
              'ncm-metaconfig/target/pan/metaconfig/metaconfig',
@@ -193,6 +198,8 @@ class Sourcepage(object):
         self.pan_path_prefix = pan_path_prefix
         self.pan_guess_basename = pan_guess_basename
         self.rstcontent = None
+        # set when the tool generating the content failed, as opposed to a source without content
+        self.failed = False
         filetype = os.path.splitext(path)[1].lstrip('.')
         if filetype in ['pm', 'pl', 'pod']:
             filetype = 'perl'
@@ -1,10 +1,15 @@
 """Module to handle rst operations."""
 
 import re
+import shutil
+import tempfile
 
 from vsc.utils import fancylogger
-from vsc.utils.run import asyncloop
-from panhandler import rst_from_pan
+from panhandler import rst_from_pan, annotate_pan_files
+from perlhandler import convert_perl_files
+from cache import cache_key, load_page, store_page
+from tracing import traced
+from engine import Engine, run_tool
 import restructuredtext_lint
 
 logger = fancylogger.getLogger()
@@ -12,157 +17,360 @@ logger = fancylogger.getLogger()
 MAILREGEX = re.compile(("([a-zA-Z0-9!#$%&'*+\/=?^_`{|}~-]+(?:\.[a-zA-Z0-9!#$%&'*+\/=?^_`"
                         "{|}~-]+)*(@|\sat\s)(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]*[a-zA-Z0-9])?(\.|"
                         "\sdot\s))+[a-zA-Z0-9](?:[a-zA-Z0-9-]*[a-zA-Z0-9])?)"))
-PATHREGEX = re.compile(r'(\s+)((?:/[\w{}]+)+\.?\w*)(\s*)')
+PATHREGEX = re.compile(r'(\s+)((?:/[\w{}]+)+\.?\w*)')
+CODETAGREGEX = re.compile(r'\\ ``(.*?)``\\ ')
 EXAMPLEMAILS = ["example", "username", "system.admin"]
+MAX_CLEANUP_PASSES = 10
+MAX_LINT_PASSES = 10
 
 
-def generate_rst(sourcepage):
-    """Generate rst."""
+def generate_rst(sourcepage, annotations=None, perlrst=None):
+    """
+    Generate rst.
+
+    annotations is an optional dictionary of batch built pan annotation files per source path,
+    perlrst an optional dictionary with the batch converted rst of perl sources.
+    """
     logger.debug("Parsing %s.", sourcepage)
     rst = None
     if sourcepage.path.endswith(".pan"):
+        annotationfile = None
+        if annotations:
+            annotationfile = annotations.get(sourcepage.path)
         rst = rst_from_pan(sourcepage.path, sourcepage.title, sourcepage.pan_path_prefix,
-                           sourcepage.pan_guess_basename)
+                           sourcepage.pan_guess_basename, annotationfile)
+    elif perlrst and sourcepage.path in perlrst:
+        rst = perlrst[sourcepage.path]
     else:
         rst = rst_from_perl(sourcepage.path, sourcepage.title)
 
-    # contains more than a title
+    return set_rst(sourcepage, rst)
+
+
+def set_rst(sourcepage, rst):
+    """
+    Set the generated rst as content of sourcepage, if it contains more than a title.
+
+    rst is None if the tool generating it failed, sourcepage is then marked as failed.
+    """
+    sourcepage.failed = rst is None
     if rst is not None and rst.count('\n') > 6:
         sourcepage.rstcontent = rst
-
     return sourcepage
 
 
-def rst_from_perl(podfile, title):
-    """Take a perl file and converts it to a reStructuredText with the help of pod2rst."""
-    logger.info("Making rst from perl: %s.", podfile)
-    errc, output = asyncloop(["pod2rst", "--infile", podfile, "--title", title])
+def pod2rst_command(podfile, title):
+    """Return the pod2rst command converting a single perl file."""
+    return ["pod2rst", "--infile", podfile, "--title", title]
+
+
+def perl_rst(podfile, errc, output):
+    """Return the rst of a finished pod2rst command, None if it failed."""
     logger.debug(output)
-    if errc != 0 or output == "\n":
+    if errc != 0:
         logger.warning("pod2rst failed on %s.", podfile)
-        output = None
+        return None
+    if output == "\n":
+        logger.debug("pod2rst found no documentation in %s.", podfile)
     return output
 
 
+@traced('rst_from_perl', lambda podfile, title: {'page': podfile})
+def rst_from_perl(podfile, title):
+    """Take a perl file and converts it to a reStructuredText with the help of pod2rst."""
+    logger.info("Making rst from perl: %s.", podfile)
+    errc, output = run_tool('pod2rst', pod2rst_command(podfile, title))
+    return perl_rst(podfile, errc, output)
+
+
+def rst_from_perl_concurrent(pairs, callback, concurrency=None):
+    """
+    Convert (podfile, title) pairs with concurrent pod2rst processes.
+
+    At most concurrency conversions run at once, by default the pod2rst slots.
+    callback(podfile, rst) is called as soon as a file is converted, while the others keep running.
+    Every conversion is traced as a span of its own, which ends before its callback runs.
+    """
+    if not pairs:
+        return
+    logger.info("Making rst from %s perl files with concurrent pod2rst processes.", len(pairs))
+    engine = Engine('pod2rst', concurrency)
+    for podfile, title in pairs:
+        engine.submit(pod2rst_command(podfile, title),
+                      lambda errc, output, podfile=podfile: callback(podfile, perl_rst(podfile, errc, output)),
+                      span=('rst_from_perl', {'page': podfile}))
+    engine.run()
+
+
+def rst_from_perl_batch(sourcepages, processes):
+    """
+    Convert the perl sources among sourcepages with long-lived pod2rst converters.
+
+    Files which fail in the batch run are retried on their own with pod2rst.
+    Return a dictionary with the rst per source path.
+    """
+    pairs = [(sourcepage.path, sourcepage.title) for sourcepage in sourcepages
+             if not sourcepage.path.endswith('.pan')]
+    if not pairs:
+        return {}
+    logger.info("Making rst from %s perl files with %s pod2rst converters.", len(pairs), processes)
+    perlrst = convert_perl_files(pairs, processes)
+    failed = [(podfile, title) for podfile, title in pairs if perlrst.get(podfile) in [None, "\n"]]
+    if failed:
+        logger.debug("Retrying %s files on their own.", len(failed))
+        rst_from_perl_concurrent(failed, perlrst.__setitem__)
+    return perlrst
+
+
+@traced('cleanup_content', lambda sourcepage, *args: {'page': sourcepage.path})
 def cleanup_content(sourcepage, remove_emails, codify_paths, clean_code_tags):
     """Run several cleaners on the content we get from perl files."""
-
-    content = sourcepage.rstcontent
     if not sourcepage.path.endswith('.pan'):
-        for func in ['remove_emails', 'codify_paths', 'clean_code_tags']:
-            if func:
-                content = globals()[func](content)
-
-    sourcepage.rstcontent = content
+        enabled = {
+            'remove_emails': remove_emails,
+            'codify_paths': codify_paths,
+            'clean_code_tags': clean_code_tags,
+        }
+        sourcepage.rstcontent = run_cleaners(sourcepage.rstcontent, [name for name in CLEANERS if enabled[name]])
 
     return sourcepage
 
 
+def run_cleaners(rst, names):
+    """
+    Run the named cleaners of the cleanup pipeline on rst, in pipeline order.
+
+    Every cleaner is a compiled regex with its replacement, applied until nothing changes
+    anymore or its maximum number of passes is reached.
+    """
+    for name in CLEANERS:
+        if name in names:
+            regex, replacement, passes = CLEANUP_PIPELINE[name]
+            for _ in xrange(passes):
+                rst, counter = regex.subn(replacement, rst)
+                if not counter:
+                    break
+    return rst
+
+
+def replace_email(match):
+    """Return the replacement for an email address, example and url-like addresses are kept."""
+    email = match.group(0)
+    logger.debug("Found %s.", email)
+    if email.startswith('//') or [ignoremail for ignoremail in EXAMPLEMAILS if ignoremail in email]:
+        return email
+    logger.debug("Removed it from line.")
+    return ''
+
+
 def remove_emails(rst):
     """Remove email adresses from rst."""
-    replace = False
-    for email in re.findall(MAILREGEX, rst):
-        logger.debug("Found %s.", email[0])
-        replace = True
-        if email[0].startswith('//'):
-            replace = False
-        for ignoremail in EXAMPLEMAILS:
-            if ignoremail in email[0]:
-                replace = False
-
-        if replace:
-            logger.debug("Removed it from line.")
-            rst = rst.replace(email[0], '')
-
-    return rst
+    return run_cleaners(rst, ['remove_emails'])
 
 
 def codify_paths(rst):
     """Put paths into code tags."""
-    rst, counter = PATHREGEX.subn(r'\1`\2`\3', rst)
-    if counter > 0:
-        rst = codify_paths(rst)
-    return rst
+    return run_cleaners(rst, ['codify_paths'])
 
 
 def clean_code_tags(rst):
-    regex = r'\\ ``(.*?)``\\ '
-    regex = re.compile(regex)
-    rst, counter = regex.subn(r'``\1``', rst)
-    if counter > 0:
-        rst = clean_code_tags(rst)
-    return rst
+    """Replace escaped code tags by clean code tags."""
+    return run_cleaners(rst, ['clean_code_tags'])
+
+
+# order in which the cleaners run
+CLEANERS = ['remove_emails', 'codify_paths', 'clean_code_tags']
+# name: (regex, replacement, maximum number of passes)
+# codify_paths doesn't consume the whitespace after a path, so adjacent paths are found in one pass;
+# a clean code tag can expose another escaped one (e.g. '\\ \\ ``a``\\ \\ '), so that takes several.
+CLEANUP_PIPELINE = {
+    'remove_emails': (MAILREGEX, replace_email, 1),
+    'codify_paths': (PATHREGEX, r'\1`\2`', 1),
+    'clean_code_tags': (CODETAGREGEX, r'``\1``', MAX_CLEANUP_PASSES),
+}
 
 
+@traced('lint_content', lambda sourcepage: {'page': sourcepage.path})
 def lint_content(sourcepage):
-    errors = restructuredtext_lint.lint(sourcepage.rstcontent)
-    if errors:
-        for error in errors:
-            if 'Title overline too short' in error.message:
-                logger.debug("Fixing 'Title overline too short'.")
-                splitlines = sourcepage.rstcontent.splitlines()
-                chartoadd = splitlines[error.line - 1][:1]
-                while len(splitlines[error.line - 1]) < len(splitlines[error.line]):
-                    splitlines[error.line - 1] = chartoadd + splitlines[error.line - 1]
-
-                sourcepage.rstcontent = '\n'.join(splitlines)
-                sourcepage = lint_content(sourcepage)
-                break
+    """
+    Lint the rst of a sourcepage and fix the errors we know how to fix.
+
+    All fixable errors of one lint run are fixed at once, starting from the bottom of the page
+    so the line numbers of the remaining errors stay valid. Fixes touching the same lines are
+    left for the next run, at most MAX_LINT_PASSES runs are done.
+    """
+    for _ in xrange(MAX_LINT_PASSES):
+        errors = restructuredtext_lint.lint(sourcepage.rstcontent)
+        fixes = fixable_errors(errors)
+        if not fixes:
+            break
+        sourcepage.rstcontent = apply_fixes(sourcepage.rstcontent, fixes)
+    else:
+        errors = restructuredtext_lint.lint(sourcepage.rstcontent)
+
+    splitlines = sourcepage.rstcontent.splitlines()
+    for error in errors:
+        # don't log info
+        if error.level > 1:
+            logger.error('%s contains a problem on line %s: %s', sourcepage.title, error.line - 1, error.message)
+            for linenumber in xrange(error.line - 5, error.line + 5):
+                try:
+                    logger.warning('%s - %s', linenumber, splitlines[linenumber])
+                except IndexError:
+                    # hit the end of the page
+                    pass
+
+    return sourcepage
 
-            if 'Title underline too short' in error.message:
-                logger.debug("Fixing 'Title underline too short'.")
-                splitlines = sourcepage.rstcontent.splitlines()
-                chartoadd = splitlines[error.line - 1][:1]
-                while len(splitlines[error.line - 1]) < len(splitlines[error.line - 2]):
-                    splitlines[error.line - 1] = chartoadd + splitlines[error.line - 1]
 
-                sourcepage.rstcontent = '\n'.join(splitlines)
-                sourcepage = lint_content(sourcepage)
+def fixable_errors(errors):
+    """Return a list of (line, fixer) for the errors a LINTFIXERS entry knows how to fix."""
+    fixes = []
+    for error in errors:
+        if error.line is None:
+            continue
+        for message, fixer in LINTFIXERS:
+            if message in error.message:
+                fixes.append((error.line, fixer))
                 break
+    return fixes
 
-            if 'Title overline & underline mismatch' in error.message:
-                logger.debug("Fixing 'Title underline too short'.")
-                splitlines = sourcepage.rstcontent.splitlines()
-                chartoadd = splitlines[error.line - 1][:1]
-                while len(splitlines[error.line + 1]) < len(splitlines[error.line - 1]):
-                    splitlines[error.line + 1] = chartoadd + splitlines[error.line + 1]
 
-                sourcepage.rstcontent = '\n'.join(splitlines)
-                sourcepage = lint_content(sourcepage)
-                break
+def apply_fixes(rst, fixes):
+    """Apply the fixes bottom-up, skipping fixes that overlap with an already applied one."""
+    splitlines = rst.splitlines()
+    touched = set()
+    for line, fixer in sorted(fixes, key=lambda fix: fix[0], reverse=True):
+        first, last = LINTFIXRANGES[fixer]
+        lines = set(xrange(line + first, line + last + 1))
+        if lines & touched or line + first < 0 or line + last >= len(splitlines):
+            continue
+        logger.debug("Fixing %s on line %s.", fixer.__name__, line)
+        fixer(splitlines, line)
+        touched.update(lines)
+    return '\n'.join(splitlines)
 
-            if 'Bullet list ends without a blank line; unexpected unindent' in error.message:
-                logger.debug("Fixing 'Bullet list ends without a blank line'.")
-                splitlines = sourcepage.rstcontent.splitlines()
-                splitlines[error.line - 2] = '%s %s' %(splitlines[error.line - 2], splitlines[error.line - 1])
-                del splitlines[error.line - 1]
-                sourcepage.rstcontent = '\n'.join(splitlines)
-                sourcepage = lint_content(sourcepage)
-                break
 
+def extend_line(splitlines, index, length):
+    """Extend the adornment line at index to length by repeating its first character."""
+    chartoadd = splitlines[index][:1]
+    if chartoadd and len(splitlines[index]) < length:
+        splitlines[index] = chartoadd * (length - len(splitlines[index])) + splitlines[index]
 
-            #don't log info
-            elif error.level > 1:
-                logger.error('%s contains a problem on line %s: %s',sourcepage.title, error.line - 1, error.message)
-                splitlines = sourcepage.rstcontent.splitlines()
-                for linenumber in xrange(error.line - 5, error.line + 5):
-                    try:
-                        logger.warning('%s - %s', linenumber, splitlines[linenumber])
-                    except IndexError:
-                        # hit the end of the page
-                        pass
 
-    return sourcepage
+def fix_title_overline(splitlines, line):
+    """Fix 'Title overline too short'."""
+    extend_line(splitlines, line - 1, len(splitlines[line]))
+
+
+def fix_title_underline(splitlines, line):
+    """Fix 'Title underline too short'."""
+    extend_line(splitlines, line - 1, len(splitlines[line - 2]))
 
-def generate_rst_from_repository(repository):
 
-    generated_sources = []
+def fix_title_mismatch(splitlines, line):
+    """Fix 'Title overline & underline mismatch'."""
+    extend_line(splitlines, line + 1, len(splitlines[line - 1]))
+
+
+def fix_bullet_list(splitlines, line):
+    """Fix 'Bullet list ends without a blank line' by joining the line with the last item."""
+    splitlines[line - 2] = '%s %s' % (splitlines[line - 2], splitlines[line - 1])
+    del splitlines[line - 1]
+
+
+# (part of the lint message, fixer)
+LINTFIXERS = [
+    ('Title overline too short', fix_title_overline),
+    ('Title underline too short', fix_title_underline),
+    ('Title overline & underline mismatch', fix_title_mismatch),
+    ('Bullet list ends without a blank line; unexpected unindent', fix_bullet_list),
+]
+# fixer: (first, last) index of the lines it reads or changes, relative to the error line
+LINTFIXRANGES = {
+    fix_title_overline: (-1, 0),
+    fix_title_underline: (-2, -1),
+    fix_title_mismatch: (-1, 1),
+    fix_bullet_list: (-2, -1),
+}
+
+
+def split_cached_pages(repository, cachedir=None):
+    """
+    Fill in the content of the cached pages of a repository.
+
+    Return the list of pages that still need to be generated.
+    """
+    if not cachedir:
+        return list(repository.sources)
+
+    pending = []
     for sourcepage in repository.sources:
-        sourcepage = generate_rst(sourcepage)
-        if sourcepage.rstcontent:
-            sourcepage = cleanup_content(sourcepage, repository.remove_emails, repository.codify_paths, repository.clean_code_tags)
-            sourcepage = lint_content(sourcepage)
-            generated_sources.append(sourcepage)
+        found, rstcontent = load_page(cachedir, cache_key(sourcepage, repository))
+        if found:
+            sourcepage.rstcontent = rstcontent
+        else:
+            pending.append(sourcepage)
+    logger.info("Using %s cached pages for %s, %s pages to generate.",
+                len(repository.sources) - len(pending), repository.name, len(pending))
+    return pending
+
+
+def annotate_pages(sourcepages, outputdir):
+    """Batch build the pan annotations of all pan pages in outputdir."""
+    panfiles = [sourcepage.path for sourcepage in sourcepages if sourcepage.path.endswith('.pan')]
+    return annotate_pan_files(panfiles, outputdir)
+
+
+def generate_page(sourcepage, repository, annotations=None, cachedir=None, perlrst=None):
+    """Generate, clean up and lint a single page of a repository and store it in the cache."""
+    return finish_page(generate_rst(sourcepage, annotations, perlrst), repository, cachedir)
+
+
+def finish_page(sourcepage, repository, cachedir=None):
+    """
+    Clean up and lint the generated content of a page and store it in the cache.
+
+    A page whose generation failed is not cached, so it is generated again next time.
+    """
+    if sourcepage.rstcontent:
+        sourcepage = cleanup_content(sourcepage, repository.remove_emails, repository.codify_paths, repository.clean_code_tags)
+        sourcepage = lint_content(sourcepage)
+    if cachedir and not sourcepage.failed:
+        store_page(cachedir, cache_key(sourcepage, repository), sourcepage.rstcontent)
+    return sourcepage
 
-    repository.sources = generated_sources
+
+def generate_rst_from_repository(repository, cachedir=None, pod2rst_processes=0):
+    """
+    Generate rst for all sources of a repository, annotating all pan files in batch first.
+
+    Only the pages with content and those whose generation failed are kept in the sources.
+    With a cachedir, pages of unchanged sources are taken from the cache.
+    With pod2rst_processes, all perl sources are converted in batch by that many pod2rst converters,
+    otherwise by concurrent pod2rst processes, each page is finished as soon as its conversion is.
+    """
+    pending = split_cached_pages(repository, cachedir)
+    tempdir = tempfile.mkdtemp()
+    annotations = annotate_pages(pending, tempdir)
+    perlrst = None
+    if pod2rst_processes:
+        perlrst = rst_from_perl_batch(pending, pod2rst_processes)
+    else:
+        perlpages = dict([(sourcepage.path, sourcepage) for sourcepage in pending
+                          if not sourcepage.path.endswith('.pan')])
+
+        def converted(podfile, rst):
+            """Finish a page as soon as its perl source is converted."""
+            finish_page(set_rst(perlpages[podfile], rst), repository, cachedir)
+
+        rst_from_perl_concurrent([(sourcepage.path, sourcepage.title) for sourcepage in pending
+                                  if sourcepage.path in perlpages], converted)
+        pending = [sourcepage for sourcepage in pending if sourcepage.path not in perlpages]
+    for sourcepage in pending:
+        generate_page(sourcepage, repository, annotations, cachedir, perlrst=perlrst)
+    shutil.rmtree(tempdir)
+
+    repository.sources = [sourcepage for sourcepage in repository.sources
+                          if sourcepage.rstcontent or sourcepage.failed]
     return repository
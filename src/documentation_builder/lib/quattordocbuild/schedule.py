@@ -0,0 +1,97 @@
+"""
+Duration aware scheduling of repositories.
+
+The durations of the stages of every repository are recorded in a state file
+after each run, so the next run can start the longest repositories first
+(longest processing time first) and estimate when it will be done.
+A repository without history is estimated at the average recorded duration,
+no sources are listed for it: discovery only works after maven ran anyway.
+"""
+
+import os
+import json
+import heapq
+import tempfile
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger()
+
+DURATIONSFILE = 'durations.json'
+# estimated seconds per repository if there is no history at all
+DEFAULT_SECONDS = 60.0
+
+
+def durations_file(statedir):
+    """Return the location of the durations file in statedir."""
+    return os.path.join(statedir, DURATIONSFILE)
+
+
+def load_durations(statedir):
+    """
+    Return the recorded durations per repository name.
+
+    Every entry is a dictionary with the seconds per stage, the total seconds and the number of sources.
+    """
+    if not statedir or not os.path.exists(durations_file(statedir)):
+        return {}
+    try:
+        with open(durations_file(statedir)) as fih:
+            return json.load(fih)
+    except (IOError, ValueError):
+        logger.warning("Ignoring unreadable durations file %s.", durations_file(statedir))
+        return {}
+
+
+def save_durations(statedir, timings):
+    """
+    Record the durations of this run in statedir.
+
+    timings has the seconds per stage and the number of sources ('sources') per repository name.
+    Repositories which weren't built in this run keep their recorded durations.
+    """
+    durations = load_durations(statedir)
+    for name, stages in timings.iteritems():
+        stages = dict(stages)
+        sources = stages.pop('sources', None)
+        durations[name] = {'stages': stages, 'total': sum(stages.values()), 'sources': sources}
+
+    if not os.path.exists(statedir):
+        os.makedirs(statedir)
+    handle, tempname = tempfile.mkstemp(dir=statedir)
+    with os.fdopen(handle, 'w') as fih:
+        json.dump(durations, fih, indent=2, sort_keys=True)
+    os.rename(tempname, durations_file(statedir))
+    return durations
+
+
+def average_duration(durations):
+    """Return the average seconds per repository over the recorded durations."""
+    if not durations:
+        return DEFAULT_SECONDS
+    return sum([entry['total'] for entry in durations.values()]) / len(durations)
+
+
+def estimate_costs(repository_map, durations):
+    """Return the estimated seconds per repository name, from history or the average recorded duration."""
+    costs = {}
+    average = average_duration(durations)
+    for repository in repository_map:
+        if repository.name in durations:
+            costs[repository.name] = durations[repository.name]['total']
+        else:
+            logger.debug("No history for %s, estimating %.0fs.", repository.name, average)
+            costs[repository.name] = average
+    return costs
+
+
+def order_longest_first(repository_map, costs):
+    """Return the repositories sorted by decreasing cost, repositories with the same cost keep their order."""
+    return sorted(repository_map, key=lambda repository: -costs.get(repository.name, 0))
+
+
+def estimate_makespan(costs, workers):
+    """Return the estimated seconds to process all costs longest first with workers in parallel."""
+    loads = [0] * max(workers, 1)
+    for cost in sorted(costs, reverse=True):
+        heapq.heappush(loads, heapq.heappop(loads) + cost)
+    return max(loads)
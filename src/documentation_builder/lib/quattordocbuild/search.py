@@ -0,0 +1,186 @@
+"""
+Full-text search index of the documentation site.
+
+The index is a directory next to the pages with
+ - meta.json: the index parameters (number of pages, shard prefix length and field boosts)
+ - pages.json: the path and title of every page, the id of a page is its position in this list
+ - a shard <prefix>.json per term prefix, mapping every term starting with prefix
+   to a list of [page id, score] pairs, highest score first
+
+Terms are the lowercase alphanumeric tokens of a text, without stop words, reduced
+by a light suffix stemmer. search.js, copied to the index directory, implements the
+same tokenizer, stemmer and ranking, so a static site only loads the shards of the query terms.
+"""
+
+import os
+import re
+import json
+import math
+import shutil
+import tempfile
+from vsc.utils import fancylogger
+from panhandler import pan_keywords
+
+logger = fancylogger.getLogger()
+
+SEARCHDIR = '_search'
+SEARCHJS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'js', 'search.js')
+INDEXVERSION = 1
+# length of the term prefix that selects the shard of a term
+SHARD_PREFIX = 2
+# score of a term in a field, per occurrence
+BOOSTS = {'title': 10, 'type': 8, 'function': 8, 'field': 4, 'variable': 4, 'body': 1}
+TOKENREGEX = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset(['an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'if', 'in', 'is', 'it', 'of',
+                       'on', 'or', 'that', 'the', 'this', 'to', 'with'])
+# plural and verb suffixes removed by the stemmer, the first matching one of each group is used
+STEMSUFFIXES = [
+    [('sses', 'ss'), ('ies', 'y'), ('ss', 'ss'), ('us', 'us'), ('s', '')],
+    [('ing', ''), ('ed', '')],
+    [('e', '')],
+]
+MIN_STEM = 3
+# stems of the tokens seen so far, the vocabulary of the docs is small
+STEMS = {}
+
+
+def stem(term):
+    """Reduce a term to its stem, e.g. configures, configured and configuring all become configur."""
+    if term.isdigit():
+        return term
+    for suffixes in STEMSUFFIXES:
+        for suffix, replacement in suffixes:
+            if term.endswith(suffix):
+                if len(term) - len(suffix) + len(replacement) >= MIN_STEM:
+                    term = term[:len(term) - len(suffix)] + replacement
+                break
+    return term
+
+
+def terms(text):
+    """Return the terms of a text, in order."""
+    result = []
+    for token in TOKENREGEX.findall(text.lower()):
+        term = STEMS.get(token)
+        if term is None:
+            if len(token) > 1 and token not in STOPWORDS:
+                term = stem(token)
+            else:
+                term = ''
+            STEMS[token] = term
+        if term:
+            result.append(term)
+    return result
+
+
+def page_scores(title, content):
+    """Return the score of every term of a page, with the boosts of the title and pan names."""
+    scores = {}
+    fields = [('title', [title]), ('body', [content])]
+    fields.extend(pan_keywords(content).items())
+    for field, texts in fields:
+        for text in texts:
+            for term in terms(text):
+                scores[term] = scores.get(term, 0) + BOOSTS[field]
+    return scores
+
+
+def new_index():
+    """Return an empty index."""
+    return {'pages': [], 'postings': {}}
+
+
+def add_page(index, path, title, content):
+    """Add a page with its path relative to the docs, title and content to the index."""
+    pageid = len(index['pages'])
+    index['pages'].append([path, title])
+    for term, score in page_scores(title, content).iteritems():
+        index['postings'].setdefault(term, []).append([pageid, score])
+
+
+def shard_name(term):
+    """Return the name of the shard of a term."""
+    return term[:SHARD_PREFIX]
+
+
+def dump_json(data, path):
+    """Write data as compact JSON."""
+    with open(path, 'w') as fih:
+        json.dump(data, fih, separators=(',', ':'), sort_keys=True)
+
+
+def write_index(index, location):
+    """
+    Write the index to the directory location, replacing the previous index.
+
+    The index is written next to location first, so a site never serves a partial index.
+    """
+    shards = {}
+    for term, postings in index['postings'].iteritems():
+        postings.sort(key=lambda posting: (-posting[1], posting[0]))
+        shards.setdefault(shard_name(term), {})[term] = postings
+
+    parent = os.path.dirname(os.path.abspath(location))
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    tempdir = tempfile.mkdtemp(dir=parent, prefix='.search')
+    meta = {
+        'version': INDEXVERSION,
+        'pages': len(index['pages']),
+        'shard_prefix': SHARD_PREFIX,
+        'boosts': BOOSTS,
+        'shards': sorted(shards),
+    }
+    dump_json(meta, os.path.join(tempdir, 'meta.json'))
+    dump_json(index['pages'], os.path.join(tempdir, 'pages.json'))
+    for name, shard in shards.iteritems():
+        dump_json(shard, os.path.join(tempdir, '%s.json' % name))
+    shutil.copy(SEARCHJS, tempdir)
+    os.chmod(tempdir, 0o755)
+
+    if os.path.exists(location):
+        old = tempfile.mkdtemp(dir=parent, prefix='.search')
+        os.rename(location, os.path.join(old, 'index'))
+        os.rename(tempdir, location)
+        shutil.rmtree(old)
+    else:
+        os.rename(tempdir, location)
+    logger.info("Wrote search index of %s pages with %s terms in %s shards to %s.", len(index['pages']),
+                len(index['postings']), len(shards), location)
+
+
+def search(location, query, limit=10):
+    """
+    Search the index in location, like search.js does.
+
+    Pages have to contain all terms of the query, they are ranked by the sum of
+    log(1 + score) * log(1 + pages / pages with the term) over the query terms.
+    Return a list of (path, title, rank) of the best pages.
+    """
+    with open(os.path.join(location, 'meta.json')) as fih:
+        meta = json.load(fih)
+    shards = {}
+    ranks = None
+    for term in set(terms(query)):
+        name = shard_name(term)
+        if name not in shards:
+            shardfile = os.path.join(location, '%s.json' % name)
+            shards[name] = {}
+            if os.path.exists(shardfile):
+                with open(shardfile) as fih:
+                    shards[name] = json.load(fih)
+        postings = shards[name].get(term, [])
+        idf = math.log(1.0 + float(meta['pages']) / max(1, len(postings)))
+        termranks = dict([(pageid, math.log(1.0 + score) * idf) for pageid, score in postings])
+        if ranks is None:
+            ranks = termranks
+        else:
+            ranks = dict([(pageid, rank + termranks[pageid]) for pageid, rank in ranks.iteritems()
+                          if pageid in termranks])
+    if not ranks:
+        return []
+
+    with open(os.path.join(location, 'pages.json')) as fih:
+        pages = json.load(fih)
+    best = sorted(ranks.iteritems(), key=lambda item: (-item[1], item[0]))[:limit]
+    return [(pages[pageid][0], pages[pageid][1], rank) for pageid, rank in best]
@@ -0,0 +1,154 @@
+"""
+Split a documentation build over several shards, possibly on different hosts.
+
+Every repository is assigned to a single shard i/N (counting from 1) by a stable hash
+of its name, only that shard prepares (compiles) it and generates its pages.
+The pages of large repositories (see Repo.shard_pages) are spread over all shards instead,
+by a stable hash of the repository name and the path of the source within the repository.
+A shard writes its raw pages and a manifest to its own output location,
+the site-wide steps (interlinks, search index) are done when merging the shards.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger()
+
+SHARDDIR = 'shard'
+SHARDMANIFEST = 'manifest.json'
+SHARDPAGES = 'pages'
+SHARDVERSION = 1
+
+
+def parse_shard(spec):
+    """Parse a shard like 2/4, return (index, count) or None if it is invalid."""
+    try:
+        index, count = [int(part) for part in spec.split('/')]
+    except ValueError:
+        logger.error("Invalid shard %s, expected index/count like 1/4.", spec)
+        return None
+    if not 1 <= index <= count:
+        logger.error("Invalid shard %s, the index has to be between 1 and %s.", spec, count)
+        return None
+    return index, count
+
+
+def shard_of(repository, source, count):
+    """Return the shard (counting from 1) of the page of source, a path relative to its repository."""
+    digest = hashlib.sha1(('%s/%s' % (repository, source)).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % count + 1
+
+
+def shard_repositories(repository_map, shard):
+    """Return the repositories of repository_map that are built in shard (index, count)."""
+    if shard is None:
+        return repository_map
+    index, count = shard
+    selected = [repository for repository in repository_map
+                if repository.shard_pages or shard_of(repository.name, '', count) == index]
+    logger.info("Shard %s/%s builds %s of the %s repositories: %s.", index, count, len(selected),
+                len(repository_map), ', '.join([repository.name for repository in selected]))
+    return selected
+
+
+def select_shard(repository, shard):
+    """Keep only the sources of repository in shard (index, count), return the repository."""
+    if shard is None or not repository.shard_pages:
+        return repository
+    index, count = shard
+    total = len(repository.sources)
+    repository.sources = [sourcepage for sourcepage in repository.sources
+                          if shard_of(repository.name, os.path.relpath(sourcepage.path, repository.path),
+                                      count) == index]
+    logger.info("Shard %s/%s builds %s of the %s pages of %s.", index, count, len(repository.sources), total,
+                repository.name)
+    return repository
+
+
+def write_shard(manifests, location, shard, failures=0):
+    """
+    Write the pages of manifests and the shard manifest to location, replacing a previous shard output.
+
+    The manifests of the pages refer to their spooled content, in the shard manifest they refer
+    to the pages in location instead, which are named by the hash of their content: pages
+    with the same filename are all kept, so the merge can detect the collisions.
+    Return the path of the shard manifest.
+    """
+    index, count = shard
+    shardlocation = os.path.join(location, SHARDDIR)
+    tempdir = tempfile.mkdtemp(dir=location, prefix='.shard')
+    os.makedirs(os.path.join(tempdir, SHARDPAGES))
+    pages = []
+    for manifest in manifests:
+        page = dict(manifest)
+        page['spool'] = os.path.join(SHARDPAGES, '%s.rst' % manifest['hash'])
+        shutil.copyfile(manifest['spool'], os.path.join(tempdir, page['spool']))
+        pages.append(page)
+    with open(os.path.join(tempdir, SHARDMANIFEST), 'w') as fih:
+        json.dump({'version': SHARDVERSION, 'index': index, 'count': count, 'failures': failures,
+                   'pages': pages}, fih, indent=2, sort_keys=True)
+    os.chmod(tempdir, 0o755)
+
+    if os.path.exists(shardlocation):
+        shutil.rmtree(shardlocation)
+    os.rename(tempdir, shardlocation)
+    logger.info("Wrote %s pages of shard %s/%s to %s.", len(pages), index, count, shardlocation)
+    return os.path.join(shardlocation, SHARDMANIFEST)
+
+
+def read_shards(locations):
+    """
+    Read the shard manifests in the output locations of all shards of a build.
+
+    Return a list of shard manifests ordered by index, with the spool of every page as an absolute path,
+    or None if shards are missing, duplicated or from different builds.
+    """
+    if not locations:
+        logger.error("No shard output locations given.")
+        return None
+    shards = {}
+    counts = set()
+    for location in locations:
+        shardlocation = os.path.join(location, SHARDDIR)
+        path = os.path.join(shardlocation, SHARDMANIFEST)
+        if not os.path.exists(path):
+            logger.error("No shard output in %s.", location)
+            return None
+        with open(path) as fih:
+            shard = json.load(fih)
+        if shard.get('version') != SHARDVERSION:
+            logger.error("Shard output in %s has an unsupported version.", location)
+            return None
+        if shard['index'] in shards:
+            logger.error("Shard %s/%s is in %s and %s.", shard['index'], shard['count'],
+                         shards[shard['index']]['location'], location)
+            return None
+        for page in shard['pages']:
+            page['spool'] = os.path.join(shardlocation, page['spool'])
+        shard['location'] = location
+        shards[shard['index']] = shard
+        counts.add(shard['count'])
+
+    if len(counts) != 1:
+        logger.error("The shards are from builds with different shard counts %s.", sorted(counts))
+        return None
+    count = counts.pop()
+    missing = [str(index) for index in xrange(1, count + 1) if index not in shards]
+    if missing:
+        logger.error("Shards %s of %s are missing.", ', '.join(missing), count)
+        return None
+    return [shards[index] for index in sorted(shards)]
+
+
+def find_collisions(shards):
+    """Return the pages of different sources that end up in the same file, as (sitesection, filename, sources)."""
+    sources = {}
+    for shard in shards:
+        for page in shard['pages']:
+            sources.setdefault((page['sitesection'], page['filename']), set()).add(page['source'])
+    return [(sitesection, filename, sorted(paths)) for (sitesection, filename), paths in sorted(sources.items())
+            if len(paths) > 1]
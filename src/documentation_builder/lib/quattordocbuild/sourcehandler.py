@@ -10,21 +10,119 @@ files, where when there is a duplicate between '.pod' and
 import os
 import re
 import shutil
+import tempfile
+from lxml import etree
 from vsc.utils import fancylogger
-from vsc.utils.run import asyncloop
 from repo import Sourcepage
+from tracing import traced
+from engine import run_tool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 logger = fancylogger.getLogger()
+MAVENNAMESPACE = "http://maven.apache.org/POM/4.0.0"
+STAGEMODES = ['copy', 'hardlink', 'symlink']
+REACTORREGEX = re.compile(r'^\[INFO\] (.+?) \.+ ?(FAILURE|SKIPPED)\b', re.MULTILINE)
 
 
+@traced('maven_clean_compile', lambda location: {'location': location})
 def maven_clean_compile(location):
     """Execute mvn clean and mvn compile in the given location."""
     logger.info("Doing maven clean compile in %s.", location)
-    errc, output = asyncloop(["mvn", "clean", "compile"], startpath=location)
+    errc, output = run_tool('maven', ["mvn", "clean", "compile"], startpath=location)
     logger.debug(output)
     return errc
 
 
+@traced('maven_reactor_compile', lambda repositories, *args, **kwargs: {'repositories': len(repositories)})
+def maven_reactor_compile(repositories, threads='1C', offline=False):
+    """
+    Execute mvn clean and mvn compile for all repositories in a single reactor build.
+
+    An aggregator pom with all source paths of the repositories with mvncompile set
+    is generated and built multi-threaded, optionally in offline mode.
+    Return the set of names of the repositories which failed to build,
+    or None if failures could not be mapped to repositories.
+    """
+    paths = {}
+    for repository in repositories:
+        if repository.mvncompile:
+            for path in repository.sourcepaths:
+                paths[path] = repository.name
+    if not paths:
+        return set()
+
+    tempdir = tempfile.mkdtemp()
+    pomfile = make_aggregator_pom(sorted(paths), tempdir)
+    mvncommand = ["mvn", "--fail-at-end", "-T", threads, "-f", pomfile, "clean", "compile"]
+    if offline:
+        mvncommand.insert(1, "--offline")
+    logger.info("Doing maven clean compile for %s source paths in one reactor build.", len(paths))
+    errc, output = run_tool('maven', mvncommand)
+    logger.debug(output)
+    shutil.rmtree(tempdir)
+    if errc == 0:
+        return set()
+
+    failed_modules = [match.group(1) for match in REACTORREGEX.finditer(output)]
+    logger.debug("Failed or skipped maven modules: %s", failed_modules)
+    failed = set()
+    for path, name in paths.iteritems():
+        for module in maven_module_names(path):
+            if [fmod for fmod in failed_modules if fmod == module or fmod.startswith('%s ' % module)]:
+                logger.error("Something went wrong running maven in %s (module %s).", path, module)
+                failed.add(name)
+                break
+
+    if not failed:
+        logger.warning("Maven reactor build failed, but the failure could not be mapped to a repository.")
+        return None
+    return failed
+
+
+def make_aggregator_pom(paths, location):
+    """Write an aggregator pom.xml in location with the given paths as modules and return its path."""
+    nsmap = {None: MAVENNAMESPACE}
+    project = etree.Element("{%s}project" % MAVENNAMESPACE, nsmap=nsmap)
+    for tag, text in [('modelVersion', '4.0.0'), ('groupId', 'org.quattor.documentation'),
+                      ('artifactId', 'documentation-reactor'), ('version', '1'), ('packaging', 'pom')]:
+        etree.SubElement(project, "{%s}%s" % (MAVENNAMESPACE, tag)).text = text
+    modules = etree.SubElement(project, "{%s}modules" % MAVENNAMESPACE)
+    for path in paths:
+        etree.SubElement(modules, "{%s}module" % MAVENNAMESPACE).text = os.path.relpath(path, location)
+
+    pomfile = os.path.join(location, 'pom.xml')
+    etree.ElementTree(project).write(pomfile, xml_declaration=True, encoding='UTF-8', pretty_print=True)
+    return pomfile
+
+
+def maven_module_names(path):
+    """Return the names maven reports for the project in path and all of its modules."""
+    pomfile = os.path.join(path, 'pom.xml')
+    if not os.path.exists(pomfile):
+        return []
+    try:
+        root = etree.parse(pomfile).getroot()
+    except etree.XMLSyntaxError:
+        logger.warning("Could not parse %s.", pomfile)
+        return []
+
+    names = []
+    label = [name for name in root.xpath('./*[local-name()="name"]/text()') if '${' not in name]
+    label = label or root.xpath('./*[local-name()="artifactId"]/text()')
+    if label:
+        names.append(label[0].strip())
+    for module in root.xpath('./*[local-name()="modules"]/*[local-name()="module"]/text()'):
+        names.extend(maven_module_names(os.path.join(path, module.strip())))
+    return names
+
+
 def is_wanted_dir(path, wanted_dirs):
     """Check if the directory matches required criteria."""
     logger.debug("testing dir: %s", path)
@@ -88,65 +186,213 @@ def make_title_from_source(source, repository):
     logger.debug("title 6: %s", title)
     return title
 
-def handle_duplicates(filename, path, fulllist):
-    """Handle duplicates, pod takes preference over pm."""
-    if "doc/pod" in path:
-        duplicate = path.replace('doc/pod', 'lib/perl')
-        if filename.endswith('.pod'):
-            duplicate = duplicate.replace(".pod", ".pm")
-            if duplicate in fulllist:
-                fulllist[fulllist.index(duplicate)] = path
-                return fulllist
-
-    if "lib/perl" in path:
-        duplicate = path.replace('lib/perl', 'doc/pod')
-        if filename.endswith('.pm'):
-            duplicate = duplicate.replace(".pm", ".pod")
-            if duplicate not in fulllist:
-                fulllist.append(path)
-                return fulllist
-            else:
-                return fulllist
-    fulllist.append(path)
-    return fulllist
+
+def source_key(filename, path):
+    """
+    Return the key of a source file.
+
+    A pod file in doc/pod and the pm file in lib/perl it documents share the same key.
+    """
+    if filename.endswith('.pod') and 'doc/pod' in path:
+        return "%s.pm" % os.path.splitext(path.replace('doc/pod', 'lib/perl'))[0]
+    return path
+
+
+def add_source(sources, filename, path):
+    """Add a source file to a dictionary of sources by key, pod takes preference over pm."""
+    key = source_key(filename, path)
+    if key not in sources or filename.endswith('.pod'):
+        sources[key] = path
+    return sources
 
 
 def list_source_files(repository):
     """
-    Return a list of source_files in a location.
+    Return a sorted list of source_files in a location.
 
     Try to filter out:
      - Unwanted locations
      - Unwanted files
      - Duplicates, pod takes precedence over pm.
     """
-    finallist = []
+    sources = {}
     for sourcepath in repository.sourcepaths:
         logger.info("Looking for source files in %s.", sourcepath)
-        for path, _, files in os.walk(sourcepath):
+        skipped = []
+        for path, files in walk_wanted_dirs(sourcepath, repository.wanted_dirs, skipped):
             if not is_wanted_dir(path, repository.wanted_dirs):
                 continue
 
             for sfile in files:
                 if is_wanted_file(path, sfile, repository.wanted_extensions):
-                    fullpath = os.path.join(path, sfile)
-                    finallist = handle_duplicates(sfile, fullpath, finallist)
-    return finallist
+                    add_source(sources, sfile, os.path.join(path, sfile))
+        logger.info("Skipped %s directories in %s.", len(skipped), sourcepath)
+    return sorted(sources.values())
+
+
+def list_dir(path):
+    """Return the sorted names of the subdirectories and files in path, symlinked directories are left out."""
+    dirs, files = [], []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            fullpath = os.path.join(path, name)
+            if os.path.isdir(fullpath):
+                if not os.path.islink(fullpath):
+                    dirs.append(name)
+            else:
+                files.append(name)
+    return sorted(dirs), sorted(files)
+
+
+def walk_wanted_dirs(sourcepath, wanted_dirs, skipped=None):
+    """
+    Walk sourcepath and yield (path, files) for every directory that could contain wanted dirs.
+
+    Wanted dirs are matched per path component: once a directory starts or continues a wanted dir
+    (e.g. target/ for target/doc/pod), only subdirectories that continue it are walked, until a
+    wanted dir is complete and its whole tree is walked. Hidden directories are never walked.
+    The skipped directories are appended to skipped, if it is given.
+    """
+    wanted = [[comp for comp in wanted_dir.split('/') if comp] for wanted_dir in wanted_dirs]
+    # (path, True if a wanted dir is complete, (index in wanted, number of matched components) pairs)
+    todo = [(sourcepath, [] in wanted, frozenset())]
+    while todo:
+        path, complete, partial = todo.pop()
+        try:
+            dirs, files = list_dir(path)
+        except OSError as err:
+            logger.debug("Can't list %s: %s", path, err)
+            continue
+        yield path, files
+
+        subdirs = []
+        for name in dirs:
+            subpath = os.path.join(path, name)
+            subpartial = frozenset([(index, matched + 1) for index, matched in partial
+                                    if wanted[index][matched] == name] +
+                                   [(index, 1) for index, comps in enumerate(wanted) if comps and comps[0] == name])
+            subcomplete = complete or any(matched == len(wanted[index]) for index, matched in subpartial)
+            if name.startswith('.') or not (subcomplete or subpartial or not partial):
+                logger.debug("Skipping %s.", subpath)
+                if skipped is not None:
+                    skipped.append(subpath)
+                continue
+            subpartial = frozenset([pair for pair in subpartial if pair[1] < len(wanted[pair[0]])])
+            subdirs.append((subpath, subcomplete, subpartial))
+        # walk in sorted order
+        todo.extend(reversed(subdirs))
 
 def movefiles(repository):
+    """Stage the files of repository.movefiles, the content of pan directories ends up in their parent."""
     logger.debug('Moving files.')
     for source, destination, ignorepatterns in repository.movefiles:
         source = os.path.join(repository.path, source)
         destination = os.path.join(repository.path, destination)
-        shutil.copytree(source, destination, ignore=shutil.ignore_patterns(*ignorepatterns))
-
-        for root, dirs, files in os.walk(destination):
-            if root.endswith('/pan'):
-                for sfile in files:
-                    shutil.move(os.path.join(root,sfile), os.path.join(root, '..', sfile))
-                for sdir in dirs:
-                    shutil.move(os.path.join(root,sdir), os.path.join(root, '..', sdir))
-                shutil.rmtree(root)
+        stage_files(source, destination, ignorepatterns, repository.movefiles_mode)
+
+
+def staged_files(source, ignorepatterns):
+    """
+    Return a dictionary with the files to stage from source, by path relative to the destination.
+
+    Files and directories matching ignorepatterns are left out, pan directories are left out of the path.
+    """
+    ignore = shutil.ignore_patterns(*ignorepatterns)
+    staged = {}
+    for root, dirs, files in os.walk(source):
+        ignored = ignore(root, dirs + files)
+        dirs[:] = sorted([sdir for sdir in dirs if sdir not in ignored])
+        reldir = [comp for comp in os.path.relpath(root, source).split(os.sep) if comp not in ['.', 'pan']]
+        for sfile in sorted(files):
+            if sfile in ignored:
+                continue
+            target = os.path.join(*(reldir + [sfile]))
+            if target in staged:
+                logger.warning("Both %s and %s are staged as %s, using the last one.", staged[target],
+                               os.path.join(root, sfile), target)
+            staged[target] = os.path.join(root, sfile)
+    return staged
+
+
+def is_staged(source, destination, mode):
+    """Check if destination is an up to date staged version of source."""
+    if os.path.islink(destination):
+        return mode == 'symlink' and os.readlink(destination) == os.path.abspath(source)
+    if mode == 'symlink':
+        return False
+    sstat = os.stat(source)
+    dstat = os.stat(destination)
+    if (sstat.st_dev, sstat.st_ino) == (dstat.st_dev, dstat.st_ino):
+        return True
+    # copies keep the modification time of the source
+    return sstat.st_size == dstat.st_size and int(sstat.st_mtime) == int(dstat.st_mtime)
+
+
+def stage_file(source, destination, mode):
+    """
+    Stage a file as a hardlink, symlink or copy, depending on mode.
+
+    Hardlinks fall back to a copy, e.g. across filesystems.
+    Return True if destination was (re)created, False if it was already up to date.
+    """
+    if os.path.lexists(destination):
+        if is_staged(source, destination, mode):
+            return False
+        os.remove(destination)
+
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(source), destination)
+    elif mode == 'hardlink':
+        try:
+            os.link(source, destination)
+        except OSError as err:
+            logger.debug("Can't hardlink %s (%s), copying it.", source, err)
+            shutil.copy2(source, destination)
+    else:
+        shutil.copy2(source, destination)
+    return True
+
+
+def stage_files(source, destination, ignorepatterns, mode='hardlink'):
+    """
+    Stage the files from source in destination, see staged_files.
+
+    Destination may already exist: up to date files are kept and stale files are removed.
+    Return a tuple with the number of (re)created and removed files.
+    """
+    if mode not in STAGEMODES:
+        raise ValueError("Unknown staging mode %s, use one of %s." % (mode, ', '.join(STAGEMODES)))
+
+    staged = staged_files(source, ignorepatterns)
+    created = 0
+    for target, sfile in sorted(staged.items()):
+        path = os.path.join(destination, target)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if stage_file(sfile, path, mode):
+            created += 1
+
+    removed = 0
+    for root, dirs, files in os.walk(destination, topdown=False):
+        for sfile in files + [sdir for sdir in dirs if os.path.islink(os.path.join(root, sdir))]:
+            path = os.path.join(root, sfile)
+            if os.path.relpath(path, destination) not in staged:
+                os.remove(path)
+                removed += 1
+        if root != destination and not os.listdir(root):
+            os.rmdir(root)
+
+    logger.info("Staged %s files from %s in %s: %s (re)created, %s stale files removed.",
+                len(staged), source, destination, created, removed)
+    return created, removed
+
 
 def get_source_files(repository):
     """Run maven compile and get all source files."""
@@ -0,0 +1,183 @@
+"""
+Per-stage timing and resource instrumentation.
+
+When tracing is enabled, every traced call is recorded as a span with its wall time,
+the CPU time of this process and of its child processes (e.g. mvn, panc-annotations,
+pod2rst) as reported by getrusage, and the maximum RSS of the child processes
+reaped by an engine during the span, as reported by wait4.
+Every process appends its spans as Chrome trace events to its own JSON lines file,
+which are merged into a single Chrome trace file at the end of the run.
+"""
+
+import os
+import json
+import time
+import glob
+import resource
+import threading
+from functools import wraps
+from vsc.utils import fancylogger
+
+logger = fancylogger.getLogger()
+
+# tracing state of this process, inherited by the workers
+TRACE = {'dir': None}
+# context added to every span, e.g. the repository being built
+CONTEXT = {}
+# the open spans of every thread, with the maximum RSS of the child processes reaped in them
+OPEN = threading.local()
+
+
+def enable_tracing(tracedir):
+    """Record spans in tracedir, None disables tracing."""
+    TRACE['dir'] = tracedir
+    CONTEXT.clear()
+
+
+def set_context(**kwargs):
+    """Set the context added to the spans of this process, None values are removed."""
+    for key, value in kwargs.iteritems():
+        if value is None:
+            CONTEXT.pop(key, None)
+        else:
+            CONTEXT[key] = value
+
+
+def rusage_seconds(usage):
+    """Return the user and system CPU time of a resource usage."""
+    return usage.ru_utime + usage.ru_stime
+
+
+def open_spans():
+    """Return the open spans of this thread."""
+    if not hasattr(OPEN, 'spans'):
+        OPEN.spans = []
+    return OPEN.spans
+
+
+def add_child_usage(usage):
+    """Add the resource usage of a reaped child process to the open spans of this thread."""
+    for span in open_spans():
+        span['child_maxrss'] = max(span['child_maxrss'], usage.ru_maxrss)
+
+
+def record_span(name, start, selfusage, childusage, child_maxrss, args):
+    """Append a span to the trace file of this process."""
+    endselfusage = resource.getrusage(resource.RUSAGE_SELF)
+    endchildusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    spanargs = dict(args)
+    spanargs.update({
+        'cpu': rusage_seconds(endselfusage) - rusage_seconds(selfusage),
+        'child_cpu': rusage_seconds(endchildusage) - rusage_seconds(childusage),
+        # maximum over the child processes reaped during the span, in kilobytes
+        'child_maxrss': child_maxrss,
+    })
+    write_span(name, start, spanargs)
+
+
+def record_process(name, start, usage, args):
+    """
+    Append a span of a child process that ran since start, with its resource usage as reported by wait4.
+
+    Processes run concurrently by an engine get a span each, their callbacks run outside of it.
+    """
+    if TRACE['dir'] is None:
+        return
+    spanargs = dict(args)
+    spanargs.update({'cpu': 0.0, 'child_cpu': rusage_seconds(usage), 'child_maxrss': usage.ru_maxrss})
+    write_span(name, start, spanargs)
+
+
+def write_span(name, start, args):
+    """Append a span ending now to the trace file of this process."""
+    spanargs = dict(CONTEXT)
+    spanargs.update(args)
+    event = {
+        'name': name,
+        'ph': 'X',
+        'ts': int(start * 1e6),
+        'dur': int((time.time() - start) * 1e6),
+        'pid': os.getpid(),
+        'tid': threading.current_thread().ident,
+        'args': spanargs,
+    }
+    with open(os.path.join(TRACE['dir'], 'trace-%s.jsonl' % os.getpid()), 'a') as fih:
+        fih.write("%s\n" % json.dumps(event))
+
+
+def traced(name, describe=None):
+    """
+    Decorator recording every call of a function as a span when tracing is enabled.
+
+    describe is called with the arguments of the function and returns a dictionary added to the span.
+    """
+    def decorator(func):
+        """Wrap func."""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            """Run func in a span."""
+            if TRACE['dir'] is None:
+                return func(*args, **kwargs)
+            spanargs = {}
+            if describe is not None:
+                spanargs = describe(*args, **kwargs)
+            selfusage = resource.getrusage(resource.RUSAGE_SELF)
+            childusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            span = {'child_maxrss': 0}
+            open_spans().append(span)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                open_spans().remove(span)
+                record_span(name, start, selfusage, childusage, span['child_maxrss'], spanargs)
+        return wrapper
+    return decorator
+
+
+def read_spans(tracedir):
+    """Return all spans recorded in tracedir, ordered by start time."""
+    spans = []
+    for tracefile in glob.glob(os.path.join(tracedir, 'trace-*.jsonl')):
+        with open(tracefile) as fih:
+            for line in fih:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Ignoring broken span in %s.", tracefile)
+    return sorted(spans, key=lambda span: span['ts'])
+
+
+def write_chrome_trace(spans, tracefile):
+    """Write the spans as a Chrome trace file (chrome://tracing, Perfetto)."""
+    with open(tracefile, 'w') as fih:
+        json.dump({'traceEvents': spans, 'displayTimeUnit': 'ms'}, fih)
+
+
+def slowest(spans, key, count):
+    """Return the count (value, seconds) pairs with the largest total span time per value of args key."""
+    totals = {}
+    for span in spans:
+        value = span['args'].get(key)
+        if value is not None:
+            totals[value] = totals.get(value, 0) + span['dur'] / 1e6
+    return sorted(totals.items(), key=lambda item: -item[1])[:count]
+
+
+def summarize(spans, count=5):
+    """Return a short summary of the spans: time per stage and the slowest repositories and pages."""
+    stages = {}
+    for span in spans:
+        stage = stages.setdefault(span['name'], [0, 0.0, 0.0])
+        stage[0] += 1
+        stage[1] += span['dur'] / 1e6
+        stage[2] += span['args'].get('child_cpu', 0)
+
+    lines = ["Time per stage:"]
+    for name, (calls, seconds, childcpu) in sorted(stages.items(), key=lambda item: -item[1][1]):
+        lines.append("  %s: %.2fs in %s calls (%.2fs child cpu)" % (name, seconds, calls, childcpu))
+    lines.append("Slowest repositories:")
+    lines.extend(["  %s: %.2fs" % item for item in slowest(spans, 'repository', count)])
+    lines.append("Slowest pages:")
+    lines.extend(["  %s: %.2fs" % item for item in slowest(spans, 'page', count)])
+    return '\n'.join(lines)
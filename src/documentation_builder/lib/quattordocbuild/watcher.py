@@ -0,0 +1,362 @@
+"""
+Watch mode: rebuild only the pages of changed sources.
+
+After an initial build, the source paths of all repositories are watched,
+with inotify if pyinotify is available and by polling otherwise.
+Changed sources are regenerated (including cleanup and lint) and only their
+pages are rewritten, new sources get a page and pages of removed sources are removed.
+
+Maven is not run again: a changed file in the source trees of a maven module (e.g. src/main/perl)
+is copied to its compiled counterparts in target/, without the maven filtering,
+and the pages of those are regenerated.
+"""
+
+import os
+import time
+import shutil
+from vsc.utils import fancylogger
+from config import build_repository_map
+from sourcehandler import get_source_files, list_source_files, walk_wanted_dirs, is_wanted_dir, is_wanted_file
+from sourcehandler import make_title_from_source, source_key, stage_files
+from repo import Sourcepage
+from rsthandler import generate_page
+from builder import RESULTS, build_site_structure, compile_interlinks, page_filename, write_page
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+logger = fancylogger.getLogger()
+
+# seconds to wait for more events after a change, editors often write a file in several steps
+SETTLE_TIME = 0.1
+# source trees of a maven module and the trees in target/ maven compiles them to
+SOURCETREES = [
+    ('src/main/perl', ['target/lib/perl', 'target/doc/pod']),
+    ('src/main/pan', ['target/pan']),
+]
+
+
+class PollingWatcher(object):
+    """Detect changed files by comparing their modification time and size."""
+
+    def __init__(self, listfiles, interval=0.5):
+        """Initialize the watcher, listfiles returns the files to watch."""
+        self.listfiles = listfiles
+        self.interval = interval
+        self.state = self.snapshot()
+
+    def snapshot(self):
+        """Return the modification time and size of every watched file."""
+        state = {}
+        for path in self.listfiles():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state[path] = (stat.st_mtime, stat.st_size)
+        return state
+
+    def changes(self, timeout=None):
+        """Wait for changes, return the set of changed, added and removed files (empty after timeout)."""
+        start = time.time()
+        while True:
+            state = self.snapshot()
+            changed = set([path for path in set(state) | set(self.state) if state.get(path) != self.state.get(path)])
+            self.state = state
+            if changed or (timeout is not None and time.time() - start >= timeout):
+                return changed
+            time.sleep(self.interval)
+
+    def close(self):
+        """Stop watching."""
+        pass
+
+
+class InotifyWatcher(object):
+    """Detect changed files with inotify."""
+
+    def __init__(self, paths):
+        """Initialize the watcher, all paths are watched recursively, except hidden directories."""
+        self.pending = set()
+        self.watchmanager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.watchmanager, self.process_event)
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM |
+                pyinotify.IN_DELETE | pyinotify.IN_CREATE)
+        for path in paths:
+            self.watchmanager.add_watch(path, mask, rec=True, auto_add=True,
+                                        exclude_filter=lambda watched: '/.' in watched)
+
+    def process_event(self, event):
+        """Remember the file of an event."""
+        if not event.dir:
+            self.pending.add(event.pathname)
+
+    def collect(self, timeout):
+        """Process the events arriving within timeout seconds, return True if there were any."""
+        if not self.notifier.check_events(timeout=None if timeout is None else int(timeout * 1000)):
+            return False
+        self.notifier.read_events()
+        self.notifier.process_events()
+        return True
+
+    def changes(self, timeout=None):
+        """Wait for changes, return the set of changed, added and removed files (empty after timeout)."""
+        self.pending = set()
+        if self.collect(timeout):
+            while self.collect(SETTLE_TIME):
+                pass
+        return self.pending
+
+    def close(self):
+        """Stop watching."""
+        self.notifier.stop()
+
+
+def make_watcher(repository_map, interval=0.5):
+    """Return a watcher for the source paths of the repositories."""
+    paths = [path for repository in repository_map for path in repository.sourcepaths if os.path.isdir(path)]
+    if pyinotify is not None:
+        logger.info("Watching %s with inotify.", ', '.join(paths))
+        return InotifyWatcher(paths)
+
+    def listfiles():
+        """Return the source files of all repositories and the files in their source trees."""
+        return [path for repository in repository_map
+                for path in list_source_files(repository) + list_tree_files(repository)]
+    logger.info("pyinotify is not available, polling %s every %ss.", ', '.join(paths), interval)
+    return PollingWatcher(listfiles, interval)
+
+
+def list_tree_files(repository):
+    """Return the files in the source trees of the maven modules of repository."""
+    sourcetrees = [sourcetree for sourcetree, _ in SOURCETREES]
+    files = []
+    for sourcepath in repository.sourcepaths:
+        for path, names in walk_wanted_dirs(sourcepath, sourcetrees):
+            if is_wanted_dir(path, sourcetrees) and '/target/' not in path:
+                files.extend([os.path.join(path, name) for name in names])
+    return files
+
+
+def compiled_counterparts(path):
+    """
+    Return the counterparts in target/ of a file in a source tree of a maven module.
+
+    These are the counterparts that exist, or for a new file the one in the first target tree of its module.
+    """
+    for sourcetree, targettrees in SOURCETREES:
+        marker = '/%s/' % sourcetree
+        if marker not in path:
+            continue
+        module, relpath = path.split(marker, 1)
+        if '/target/' in os.path.join(module, ''):
+            return []
+        counterparts = [os.path.join(module, targettree, relpath) for targettree in targettrees]
+        existing = [counterpart for counterpart in counterparts if os.path.exists(counterpart)]
+        if existing:
+            return existing
+        return [os.path.join(module, targettree, relpath) for targettree in targettrees
+                if os.path.isdir(os.path.join(module, targettree))][:1]
+    return []
+
+
+def compile_changes(changed):
+    """
+    Copy the changed files of source trees to their counterparts in target/, remove those of removed files.
+
+    Return the set of updated counterparts.
+    """
+    updated = set()
+    for path in changed:
+        for counterpart in compiled_counterparts(path):
+            if os.path.exists(path):
+                if not os.path.isdir(os.path.dirname(counterpart)):
+                    os.makedirs(os.path.dirname(counterpart))
+                logger.debug("Copying %s to %s.", path, counterpart)
+                shutil.copy2(path, counterpart)
+            elif os.path.exists(counterpart):
+                logger.debug("Removing %s.", counterpart)
+                os.remove(counterpart)
+            else:
+                continue
+            updated.add(counterpart)
+    return updated
+
+
+def index_sources(repository):
+    """Discover the sources of a repository, return them as a dictionary by path."""
+    repository.sources = []
+    if get_source_files(repository) is None:
+        return None
+    return dict([(sourcepage.path, sourcepage) for sourcepage in repository.sources])
+
+
+def is_in_repository(path, repository):
+    """Check if path is in one of the source paths of repository."""
+    return any([path.startswith(os.path.join(sourcepath, '')) for sourcepath in repository.sourcepaths])
+
+
+def staged_path(path, source, destination):
+    """Return where movefiles stages path of source in destination, pan directories are left out."""
+    comps = [comp for comp in os.path.relpath(path, source).split(os.sep) if comp not in ['.', 'pan']]
+    return os.path.join(destination, *comps)
+
+
+def stage_changes(repository, paths):
+    """
+    Stage the movefiles of repository again if some of the changed paths are in them.
+
+    Return the changed paths with their staged counterparts.
+    """
+    staged = list(paths)
+    for source, destination, ignorepatterns in repository.movefiles:
+        source = os.path.join(repository.path, source)
+        destination = os.path.join(repository.path, destination)
+        moved = [path for path in paths if path.startswith(os.path.join(source, ''))]
+        if moved:
+            stage_files(source, destination, ignorepatterns, repository.movefiles_mode)
+            staged.extend([staged_path(path, source, destination) for path in moved])
+    return staged
+
+
+def is_source(path, repository):
+    """Check if path is an existing source file of repository."""
+    directory, filename = os.path.split(path)
+    return (os.path.isfile(path) and '/.' not in path and is_wanted_dir(directory, repository.wanted_dirs) and
+            is_wanted_file(directory, filename, repository.wanted_extensions))
+
+
+def new_sourcepage(path, repository):
+    """Return the sourcepage of a source of repository."""
+    return Sourcepage(make_title_from_source(path, repository), path, repository.pan_path_prefix,
+                      repository.pan_guess_basename)
+
+
+def discover_changes(repository, paths, current):
+    """
+    Update current, the sources of repository by path, for the changed paths only.
+
+    A pod file in doc/pod takes preference over the pm file it documents, like in list_source_files.
+    Return the sourcepages to regenerate and the removed sourcepages.
+    """
+    regenerate = []
+    removed = []
+    keys = dict([(source_key(os.path.basename(path), path), path) for path in current])
+    for path in sorted(set(paths)):
+        filename = os.path.basename(path)
+        key = source_key(filename, path)
+        if not is_source(path, repository):
+            if path in current:
+                removed.append(current.pop(path))
+                keys.pop(key, None)
+                # the pm file documented by a removed pod file is a source again
+                if key != path and is_source(key, repository):
+                    current[key] = new_sourcepage(key, repository)
+                    keys[key] = key
+                    regenerate.append(current[key])
+            continue
+        other = keys.get(key)
+        if other is not None and other != path:
+            if not filename.endswith('.pod'):
+                continue
+            removed.append(current.pop(other))
+        if path not in current:
+            current[path] = new_sourcepage(path, repository)
+        keys[key] = path
+        regenerate.append(current[path])
+    return regenerate, removed
+
+
+def rebuild(changed, repository_map, sources, sitepages, docslocation, cache_location=None, interlinks=None):
+    """
+    Rebuild the pages of the changed files.
+
+    sources maps every repository name to its sources by path and sitepages maps every sitesection
+    to the set of its pagenames, both are updated. Only the changed paths are discovered again.
+    interlinks caches the compiled interlinks between calls, they are only compiled again
+    when pages are added or removed. Return the number of written and removed pages.
+    """
+    if interlinks is None:
+        interlinks = {}
+    regenerate = []
+    removed = []
+    for repository in repository_map:
+        paths = [path for path in changed if is_in_repository(path, repository)]
+        if not paths:
+            continue
+        current = sources.setdefault(repository.name, {})
+        found, gone = discover_changes(repository, stage_changes(repository, paths), current)
+        regenerate.extend([(repository, sourcepage) for sourcepage in found])
+        removed.extend([(repository, sourcepage) for sourcepage in gone])
+
+    for repository, sourcepage in regenerate:
+        logger.info("Regenerating %s.", sourcepage.path)
+        sourcepage.rstcontent = None
+        generate_page(sourcepage, repository, None, cache_location)
+        if sourcepage.failed:
+            logger.error("Generating %s failed, keeping its previous page.", sourcepage.path)
+        elif not sourcepage.rstcontent:
+            removed.append((repository, sourcepage))
+    regenerate = [(repository, sourcepage) for repository, sourcepage in regenerate if sourcepage.rstcontent]
+
+    pages = sum([len(names) for names in sitepages.values()])
+    for repository, sourcepage in removed:
+        pagename = page_filename(sourcepage.title)
+        sitepages.get(repository.sitesection, set()).discard(pagename)
+        pagefile = os.path.join(docslocation, repository.sitesection, pagename)
+        if os.path.exists(pagefile):
+            logger.info("Removing %s.", pagefile)
+            os.remove(pagefile)
+    for repository, sourcepage in regenerate:
+        sitepages.setdefault(repository.sitesection, set()).add(page_filename(sourcepage.title))
+
+    # pages which are not regenerated only get links to new pages on the next full build
+    if 'regex' not in interlinks or removed or sum([len(names) for names in sitepages.values()]) != pages:
+        interlinks['regex'], interlinks['targets'] = compile_interlinks(sitepages)
+    for repository, sourcepage in regenerate:
+        write_page(sourcepage.rstcontent, repository.sitesection, page_filename(sourcepage.title), docslocation,
+                   interlinks['regex'], interlinks['targets'])
+
+    return len(regenerate), len(removed)
+
+
+def watch_documentation(repository_location, output_location, cache_location=None, interval=0.5):
+    """
+    Watch the repositories after the initial build and rebuild the pages of changed sources until interrupted.
+
+    The pages of the initial build are taken from builder.RESULTS. Maven is not run again,
+    changed files in the source trees of the modules are copied to target/ instead, see compile_changes.
+    """
+    repository_map = build_repository_map(repository_location)
+    if not repository_map:
+        return False
+    sources = {}
+    for repository in repository_map:
+        repository.mvncompile = False
+        sources[repository.name] = index_sources(repository) or {}
+    sitepages = dict([(sitesection, set(pages)) for sitesection, pages in build_site_structure(RESULTS).items()])
+    interlinks = {}
+    docslocation = os.path.join(output_location, "docs")
+
+    watcher = make_watcher(repository_map, interval)
+    logger.info("Watching for changes, press Ctrl-C to stop.")
+    updated = set()
+    try:
+        while True:
+            # the counterparts updated by the previous rebuild are already regenerated
+            changed = watcher.changes() - updated
+            if not changed:
+                continue
+            start = time.time()
+            updated = compile_changes(changed)
+            written, removed = rebuild(changed | updated, repository_map, sources, sitepages, docslocation,
+                                       cache_location, interlinks)
+            if written or removed:
+                logger.info("Wrote %s and removed %s pages in %.2fs.", written, removed, time.time() - start)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching.")
+    finally:
+        watcher.close()
+    return True
@@ -17,7 +17,8 @@ if __name__ == '__main__':
         author_email='wouter.depypere@ugent.be',
         packages=find_packages('lib'),
         package_dir={'': 'lib'},
-        scripts=['bin/quattor-documentation-builder', 'bin/build-quattor-documentation.sh'],
+        scripts=['bin/quattor-documentation-builder', 'bin/quattor-documentation-merge',
+                 'bin/build-quattor-documentation.sh'],
         install_requires=[
             'vsc-utils',
             'vsc-base',
@@ -2,12 +2,49 @@
 
 import sys
 import os
+import re
+import json
 import shutil
 from tempfile import mkdtemp
 from unittest import TestCase, main, TestLoader
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
 from quattordocbuild import builder
 from quattordocbuild import repo
+from quattordocbuild import cache
+from quattordocbuild import sourcehandler
+from quattordocbuild import search
+from quattordocbuild import rsthandler
+from quattordocbuild.journal import Journal
+
+# sources fake_build_page fails on
+BROKENPAGES = []
+# sources the tool fails on in fake_build_page, which leaves their page empty
+TOOLFAILURES = []
+# sources fake_build_page kills its worker on
+DYINGPAGES = []
+
+
+def fake_build_page(sourcepage, repository, annotations, cache_location, spooldir, pod2rst_processes=0):
+    """Build a page without running the external tools."""
+    if sourcepage.path in BROKENPAGES:
+        raise ValueError('broken page')
+    if sourcepage.path in DYINGPAGES:
+        os._exit(1)
+    if sourcepage.path in TOOLFAILURES:
+        rsthandler.set_rst(sourcepage, None)
+    else:
+        sourcepage.rstcontent = u'%s\n' % sourcepage.title
+    return builder.spool_page(sourcepage, repository.sitesection, spooldir)
+
+
+def fake_annotate_pages(sourcepages, outputdir):
+    """Return no pan annotations."""
+    return {}
+
+
+def broken_annotate_pages(sourcepages, outputdir):
+    """Fail to build pan annotations."""
+    raise OSError('panc-annotations')
 
 
 class BuilderTest(TestCase):
@@ -16,9 +53,14 @@ class BuilderTest(TestCase):
     def setUp(self):
         """Set up temp dir for tests."""
         self.tmpdir = mkdtemp()
+        self.build_page = builder.build_page
+        self.annotate_pages = builder.annotate_pages
 
     def tearDown(self):
-        """Remove temp dir."""
+        """Remove temp dir and restore the patched functions."""
+        builder.build_page = self.build_page
+        builder.annotate_pages = self.annotate_pages
+        del builder.RESULTS[:]
         shutil.rmtree(self.tmpdir)
 
     def test_which(self):
@@ -34,18 +76,16 @@ class BuilderTest(TestCase):
         self.assertTrue(builder.check_input(self.tmpdir, self.tmpdir))
         os.makedirs(os.path.join(self.tmpdir, "test"))
         self.assertTrue(builder.check_input(self.tmpdir, os.path.join(self.tmpdir, "test")))
+        # A non-empty output location is only accepted when building in place
+        self.assertFalse(builder.check_input(self.tmpdir, self.tmpdir))
+        self.assertTrue(builder.check_input(self.tmpdir, self.tmpdir, True))
 
     def test_check_commands(self):
         """Test check_commands function."""
         self.assertTrue(builder.check_commands(True))
 
-    def test_build_site_structure(self):
-        """Test build_site_structure function."""
-        expected_response = {'CCM': {'Fetch_Download.rst': '# NAME\n\nEDG::WP4::CC'},
-                             'components': {'aii_freeipa_schema.rst': 'Hello2',
-                                            'fmonagent.rst': 'Hello',
-                                            'profile_functions.rst': u'\n### Functions\n'}}
-
+    def spool_test_pages(self, spooldir):
+        """Spool some test pages and return their manifests."""
         file1 = repo.Sourcepage('Fetch\::Download', '/tmp/qdoc/src/CCM/target/doc/pod/EDG/WP4/CCM/Fetch/Download.pod', False, False)
         file1.rstcontent = '# NAME\n\nEDG::WP4::CC'
         file2 = repo.Sourcepage('profile\::functions', '/tmp/doc/src/configuration-modules-core/ncm-profile/target/pan/components/profile/functions.pan', False, False)
@@ -53,13 +93,206 @@ class BuilderTest(TestCase):
         file3 = repo.Sourcepage('fmonagent', '/tmp/doc/src/configuration-modules-core/ncm-fmonagent/target/doc/pod/NCM/Component/fmonagent.pod', False, False)
         file3.rstcontent = 'Hello'
         file4 = repo.Sourcepage('aii\::freeipa - schema', '/tmp/doc/src/configuration-modules-core/ncm-freeipa/target/pan/quattor/aii/freeipa/schema.pan', False, False)
-        file4.rstcontent = 'Hello2'
+        file4.rstcontent = 'Hello2 `fmonagent`.'
+
+        manifests = [builder.spool_page(file1, 'CCM', spooldir)]
+        for sourcepage in [file2, file3, file4]:
+            manifests.append(builder.spool_page(sourcepage, 'components', spooldir))
+        return manifests
+
+    def test_spool_page(self):
+        """Test spool_page function."""
+        sourcepage = repo.Sourcepage('test\::page - schema', '/tmp/test.pan', False, False)
+        self.assertIsNone(builder.spool_page(sourcepage, 'components', self.tmpdir))
+
+        sourcepage.rstcontent = u'caf\xe9\n'
+        manifest = builder.spool_page(sourcepage, 'components', self.tmpdir)
+        self.assertEquals(manifest['filename'], 'test_page_schema.rst')
+        self.assertEquals(manifest['sitesection'], 'components')
+        self.assertEquals(manifest['size'], 6)
+        with open(manifest['spool'], 'rb') as fih:
+            self.assertEquals(fih.read(), 'caf\xc3\xa9\n')
+
+    def test_build_site_structure(self):
+        """Test build_site_structure function."""
+        expected_response = {'CCM': ['Fetch_Download.rst'],
+                             'components': ['aii_freeipa_schema.rst', 'fmonagent.rst', 'profile_functions.rst']}
+
+        manifests = self.spool_test_pages(self.tmpdir)
+        sitepages = builder.build_site_structure(manifests)
+        self.assertEquals(dict((subdir, sorted(pages)) for subdir, pages in sitepages.items()), expected_response)
+        self.assertEquals(sitepages['components']['fmonagent.rst'], manifests[2])
+
+        # Duplicates keep the first page
+        duplicate = dict(manifests[2], title='other')
+        self.assertEquals(builder.build_site_structure(manifests + [duplicate]), sitepages)
+
+    def create_cached_repository(self):
+        """Create a template-library-core repository of which all pages are cached."""
+        repodir = os.path.join(self.tmpdir, 'template-library-core')
+        cachedir = os.path.join(self.tmpdir, 'cache')
+        for subdir in ['pan', 'quattor']:
+            os.makedirs(os.path.join(repodir, subdir))
+            with open(os.path.join(repodir, subdir, 'functions.pan'), 'w') as fih:
+                fih.write("declaration template %s/functions;\n" % subdir)
+
+        testrepo = repo.Repo('template-library-core', repodir)
+        for source in sourcehandler.list_source_files(testrepo):
+            title = sourcehandler.make_title_from_source(source, testrepo)
+            sourcepage = repo.Sourcepage(title, source, None, False)
+            content = None
+            if 'quattor' in source:
+                content = u'%s\n' % title
+            cache.store_page(cachedir, cache.cache_key(sourcepage, testrepo), content)
+        return repo.Repo('template-library-core', repodir), cachedir
+
+    def test_prepare_repository(self):
+        """Test prepare_repository function."""
+        testrepo, cachedir = self.create_cached_repository()
+        workdir = os.path.join(self.tmpdir, 'work')
+        spooldir = os.path.join(self.tmpdir, 'spool')
+        settings, cached, pending = builder.prepare_repository((testrepo, cachedir, workdir, spooldir, None))
+        self.assertEquals(settings.name, 'template-library-core')
+        self.assertEquals(settings.sources, [])
+        self.assertEquals([manifest['filename'] for manifest in cached], ['functions.rst'])
+        self.assertEquals(pending, [])
+
+    def test_build_in_pool(self):
+        """Test build_in_pool function."""
+        testrepo, cachedir = self.create_cached_repository()
+        timings = {}
+        manifests = builder.build_in_pool([testrepo], self.tmpdir, cachedir, timings=timings)
+        self.assertEquals([manifest['title'] for manifest in manifests], ['functions'])
+        self.assertEquals(sorted(timings['template-library-core'].keys()), ['pages', 'prepare', 'sources'])
+        self.assertEquals(timings['template-library-core']['sources'], 1)
+        with open(manifests[0]['spool']) as fih:
+            self.assertEquals(fih.read(), 'functions\n')
+
+    def test_build_in_pool_journal(self):
+        """Test build_in_pool with a journal, failures and resuming."""
+        builder.build_page = fake_build_page
+        builder.annotate_pages = fake_annotate_pages
+        testrepo, _ = self.create_cached_repository()
+        broken = os.path.join(testrepo.path, 'pan', 'functions.pan')
+        BROKENPAGES.append(broken)
+        location = os.path.join(self.tmpdir, 'journal')
+        journal = Journal(location)
+        try:
+            manifests = builder.build_in_pool([testrepo], journal.spooldir, journal=journal)
+        finally:
+            BROKENPAGES.remove(broken)
+        self.assertEquals(len(manifests), 1)
+        self.assertEquals(journal.failures, [('template-library-core', broken, 'ValueError: broken page'),
+                                             ('template-library-core', None, 'some of its pages failed')])
+        journal.close()
+
+        # Only the failed page is built again
+        journal = Journal(location, resume=True)
+        self.assertEquals(journal.completed(), [])
+        self.assertEquals(journal.manifests('template-library-core'), manifests)
+        resumed = builder.build_in_pool([testrepo], journal.spooldir, journal=journal)
+        self.assertEquals(len(resumed), 2)
+        self.assertTrue(manifests[0] in resumed)
+        self.assertEquals([manifest['source'] for manifest in resumed if manifest not in manifests], [broken])
+        self.assertEquals(journal.failures, [])
+        self.assertEquals(journal.completed(), ['template-library-core'])
+        journal.remove()
 
-        repo1 = repo.Repo('CCM', 'notimportant')
-        repo1.sources = [file1, ]
-        repo2 = repo.Repo('configuration-modules-core', 'notimportant')
-        repo2.sources = [file2, file3, file4]
-        self.assertEquals(builder.build_site_structure([repo1, repo2]), expected_response)
+        # A repository failing to prepare is reported
+        builder.annotate_pages = broken_annotate_pages
+        journal = Journal()
+        self.assertEquals(builder.build_in_pool([testrepo], self.tmpdir, journal=journal), [])
+        self.assertEquals(journal.failures, [('template-library-core', None, 'OSError: panc-annotations')])
+
+    def test_build_in_pool_tool_failure(self):
+        """Test build_in_pool with a page whose tool failed."""
+        builder.build_page = fake_build_page
+        builder.annotate_pages = fake_annotate_pages
+        testrepo, _ = self.create_cached_repository()
+        failing = os.path.join(testrepo.path, 'pan', 'functions.pan')
+        TOOLFAILURES.append(failing)
+        location = os.path.join(self.tmpdir, 'journal')
+        journal = Journal(location)
+        try:
+            manifests = builder.build_in_pool([testrepo], journal.spooldir, journal=journal)
+        finally:
+            TOOLFAILURES.remove(failing)
+        # The empty page is a failure, not a page without content
+        self.assertEquals(len(manifests), 1)
+        self.assertEquals(journal.failures,
+                          [('template-library-core', failing,
+                            'PageFailed: the tool generating %s failed or timed out' % failing),
+                           ('template-library-core', None, 'some of its pages failed')])
+        journal.close()
+
+        # so it is generated again when resuming
+        journal = Journal(location, resume=True)
+        self.assertEquals(journal.completed(), [])
+        resumed = builder.build_in_pool([testrepo], journal.spooldir, journal=journal)
+        self.assertEquals([manifest['source'] for manifest in resumed if manifest not in manifests], [failing])
+        self.assertEquals(journal.completed(), ['template-library-core'])
+        journal.remove()
+
+    def test_build_in_pool_worker_died(self):
+        """Test build_in_pool with a worker dying while it generates a page."""
+        builder.build_page = fake_build_page
+        builder.annotate_pages = fake_annotate_pages
+        testrepo, _ = self.create_cached_repository()
+        dying = os.path.join(testrepo.path, 'pan', 'functions.pan')
+        DYINGPAGES.append(dying)
+        journal = Journal()
+        try:
+            manifests = builder.build_in_pool([testrepo], self.tmpdir, journal=journal)
+        finally:
+            DYINGPAGES.remove(dying)
+        self.assertEquals(len(manifests), 1)
+        self.assertEquals([(name, path) for name, path, _ in journal.failures],
+                          [('template-library-core', dying), ('template-library-core', None)])
+        self.assertTrue(re.match(r'its worker \d+ died$', journal.failures[0][2]))
+
+    def test_build_in_pool_shard(self):
+        """Test build_in_pool with shards."""
+        builder.build_page = fake_build_page
+        builder.annotate_pages = fake_annotate_pages
+        testrepo, _ = self.create_cached_repository()
+        allsources = sorted(sourcehandler.list_source_files(testrepo))
+        # The pages of a repository built in a single shard are not split
+        manifests = builder.build_in_pool([testrepo], self.tmpdir, shard=(2, 3))
+        self.assertEquals(sorted([manifest['source'] for manifest in manifests]), allsources)
+
+        sources = []
+        for index in [1, 2, 3]:
+            testrepo = repo.Repo(testrepo.name, testrepo.path)
+            testrepo.shard_pages = True
+            manifests = builder.build_in_pool([testrepo], self.tmpdir, shard=(index, 3))
+            sources.extend([manifest['source'] for manifest in manifests])
+        self.assertEquals(sorted(sources), allsources)
+
+    def test_run_unit(self):
+        """Test run_unit function."""
+        name, result, _, error = builder.run_unit(('test', len, ('abc',)))
+        self.assertEquals((name, result, error), ('test', 3, None))
+        name, result, _, error = builder.run_unit(('test', len, (None,)))
+        self.assertEquals((name, result), ('test', None))
+        self.assertTrue(error.startswith('TypeError: '))
+
+    def test_resume_repositories(self):
+        """Test resume_repositories function."""
+        journal = Journal()
+        journal.page_done('CAF', '/src/CAF/a.pod', {'title': 'a'})
+        journal.page_done('CAF', '/src/CAF/b.pod', None)
+        journal.repository_done('CAF')
+        journal.page_done('CCM', '/src/CCM/c.pod', {'title': 'c'})
+        repos = [repo.Repo(name, self.tmpdir) for name in ['CAF', 'CCM']]
+        self.assertEquals([repository.name for repository in builder.resume_repositories(repos, journal)], ['CCM'])
+        self.assertEquals(builder.RESULTS, [{'title': 'a'}])
+
+    def test_compile_repositories(self):
+        """Test compile_repositories function."""
+        self.assertEquals(builder.compile_repositories([], '1C', True), [])
+
+        testrepo = repo.Repo('template-library-core', self.tmpdir)
+        self.assertEquals(builder.compile_repositories([testrepo], '1C', True), [testrepo])
 
     def test_make_interlinks(self):
         """Test make_interlinks function."""
@@ -107,19 +340,126 @@ to [NCM::Component::FreeIPA::Client](https://metacpan.org/pod/NCM::Component::Fr
                      'comps': {'icinga.rst': 'ref to `icinga` and `ncm-icinga`.'}}
         self.assertEquals(builder.make_interlinks(test_data), test_data)
 
+    def test_trie_regex(self):
+        """Test trie_regex function."""
+        texts = ['`ncm-foo`', 'ncm-foo', 'ncm-foobar', '`bar.baz`']
+        regex = re.compile('^(%s)$' % builder.trie_regex(texts))
+        for text in texts:
+            self.assertEquals(regex.match(text).group(1), text)
+        for text in ['ncm-fo', '`bar_baz`', 'ncm-foob', '']:
+            self.assertIsNone(regex.match(text))
+
+    def test_compile_interlinks(self):
+        """Test compile_interlinks function."""
+        self.assertEquals(builder.compile_interlinks({}), (None, {}))
+        linkregex, targets = builder.compile_interlinks({'components': ['fmonagent.rst']})
+        self.assertEquals(targets['ncm-fmonagent'], ('fmonagent', '../components/fmonagent.rst'))
+        self.assertEquals(len(targets), 5)
+        self.assertEquals(builder.interlink_content('see ncm-fmonagent, ', 'icinga.rst', linkregex, targets),
+                          'see [fmonagent](../components/fmonagent.rst), ')
+        self.assertEquals(builder.interlink_content('see ncm-fmonagent, ', 'fmonagent.rst', linkregex, targets),
+                          'see ncm-fmonagent, ')
+
+        # Link texts separated by a single space are all linked
+        linkregex, targets = builder.compile_interlinks({'components': ['foo.rst', 'bar.rst']})
+        self.assertEquals(builder.interlink_content('Use ncm-foo ncm-bar. See `foo` `bar`,', 'icinga.rst',
+                                                    linkregex, targets),
+                          'Use [foo](../components/foo.rst) [bar](../components/bar.rst). '
+                          'See [foo](../components/foo.rst) [bar](../components/bar.rst),')
+
     def test_write_site(self):
         """Test write_site function."""
-        testinput = {'CCM': {'fetch::download.rst': '# NAME\n\nEDG::WP4::CC'},
-                     'components': {'fmonagent.rst': 'Hello',
-                                    'profile::functions.rst': u'\n### Functions\n'}}
+        sitepages = builder.build_site_structure(self.spool_test_pages(os.path.join(self.tmpdir, "spool")))
 
         sitedir = os.path.join(self.tmpdir, "docs")
-        builder.write_site(testinput, self.tmpdir, "docs")
+        builder.write_site(sitepages, self.tmpdir, "docs")
         self.assertTrue(os.path.exists(os.path.join(sitedir, 'components')))
-        self.assertTrue(os.path.exists(os.path.join(sitedir, 'components/profile::functions.rst')))
+        self.assertTrue(os.path.exists(os.path.join(sitedir, 'components/profile_functions.rst')))
         self.assertTrue(os.path.exists(os.path.join(sitedir, 'components/fmonagent.rst')))
         self.assertTrue(os.path.exists(os.path.join(sitedir, 'CCM')))
-        self.assertTrue(os.path.exists(os.path.join(sitedir, 'CCM/fetch::download.rst')))
+        self.assertTrue(os.path.exists(os.path.join(sitedir, 'CCM/Fetch_Download.rst')))
+
+        # Pages are interlinked while writing
+        with open(os.path.join(sitedir, 'components/aii_freeipa_schema.rst')) as fih:
+            self.assertEquals(fih.read(), 'Hello2 [fmonagent](../components/fmonagent.rst).')
+
+    def test_write_site_search_index(self):
+        """Test write_site with a search index."""
+        sitepages = builder.build_site_structure(self.spool_test_pages(os.path.join(self.tmpdir, "spool")))
+        builder.write_site(sitepages, self.tmpdir, "docs", search_index=True)
+        results = search.search(os.path.join(self.tmpdir, 'docs', search.SEARCHDIR), 'download')
+        self.assertEquals(results[0][:2], ('CCM/Fetch_Download.rst', 'Fetch::Download'))
+
+    def test_merge_shards(self):
+        """Test merge_shards function."""
+        manifests = self.spool_test_pages(os.path.join(self.tmpdir, "spool"))
+        locations = []
+        for index in [1, 2]:
+            locations.append(os.path.join(self.tmpdir, 'shard%s' % index))
+            os.makedirs(locations[-1])
+            builder.write_shard(manifests[index - 1::2], locations[-1], (index, 2))
+        for name in ['full', 'merged', 'missing']:
+            os.makedirs(os.path.join(self.tmpdir, name))
+        builder.write_site(builder.build_site_structure(manifests), os.path.join(self.tmpdir, 'full'), 'docs')
+
+        merged = os.path.join(self.tmpdir, 'merged')
+        self.assertTrue(builder.merge_shards(locations, merged, search_index=True))
+        for subdir, pagename in [('CCM', 'Fetch_Download.rst'), ('components', 'fmonagent.rst')]:
+            with open(os.path.join(self.tmpdir, 'full', 'docs', subdir, pagename)) as fih:
+                expected = fih.read()
+            with open(os.path.join(merged, 'docs', subdir, pagename)) as fih:
+                self.assertEquals(fih.read(), expected)
+        with open(os.path.join(merged, builder.CHANGESFILE)) as fih:
+            self.assertEquals(len(json.load(fih)['added']), 4)
+        self.assertTrue(os.path.exists(os.path.join(merged, 'docs', search.SEARCHDIR)))
+        # The output has to be empty unless merging in place
+        self.assertFalse(builder.merge_shards(locations, merged))
+        self.assertTrue(builder.merge_shards(locations, merged, in_place=True))
+        self.assertFalse(builder.merge_shards(locations[:1], os.path.join(self.tmpdir, 'missing')))
+
+        # Pages of different sources with the same filename are not merged
+        collision = dict(manifests[0], source='/tmp/other/Download.pod')
+        builder.write_shard(manifests[1::2] + [collision], locations[1], (2, 2))
+        self.assertFalse(builder.merge_shards(locations, merged, in_place=True))
+
+        # Pages of shards with failures are merged, but stale pages are kept
+        builder.write_shard(manifests[1:2], locations[1], (2, 2), failures=1)
+        self.assertFalse(builder.merge_shards(locations, merged, in_place=True))
+        self.assertTrue(os.path.exists(os.path.join(merged, 'docs', 'components', 'fmonagent.rst')))
+
+    def test_write_site_in_place(self):
+        """Test write_site on an existing site."""
+        sitepages = builder.build_site_structure(self.spool_test_pages(os.path.join(self.tmpdir, "spool")))
+        changes = builder.write_site(sitepages, self.tmpdir, "docs")
+        self.assertEquals(len(changes['added']), 4)
+        self.assertTrue('docs/CCM/Fetch_Download.rst' in changes['added'])
+
+        # Nothing is rewritten when nothing changed
+        page = os.path.join(self.tmpdir, 'docs/components/fmonagent.rst')
+        os.utime(page, (1000000000, 1000000000))
+        changes = builder.write_site(sitepages, self.tmpdir, "docs")
+        self.assertEquals(changes, {'added': [], 'changed': [], 'removed': [], 'unchanged': 4})
+        self.assertEquals(os.stat(page).st_mtime, 1000000000)
+
+        # Changed pages are rewritten, stale pages are removed
+        with open(sitepages['components']['fmonagent.rst']['spool'], 'w') as fih:
+            fih.write('Changed')
+        del sitepages['CCM']
+        changes = builder.write_site(sitepages, self.tmpdir, "docs")
+        self.assertEquals(changes, {'added': [], 'changed': ['docs/components/fmonagent.rst'],
+                                    'removed': ['docs/CCM/Fetch_Download.rst'], 'unchanged': 2})
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'docs/CCM')))
+
+        # Stale pages are kept when asked
+        del sitepages['components']['fmonagent.rst']
+        kept = builder.write_site(sitepages, self.tmpdir, "docs", remove_stale=False)
+        self.assertEquals(kept['removed'], [])
+        self.assertTrue(os.path.exists(page))
+
+        changesfile = os.path.join(self.tmpdir, '.changes.json')
+        builder.write_changes(changes, changesfile)
+        with open(changesfile) as fih:
+            self.assertEquals(json.load(fih)['changed'], ['docs/components/fmonagent.rst'])
 
     def suite(self):
         """Return all the testcases in this module."""
@@ -0,0 +1,90 @@
+"""Test module for cache.py."""
+
+import sys
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, main, TestLoader
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import cache
+from quattordocbuild import repo
+
+
+class CacheTest(TestCase):
+    """Test class for cache.py."""
+
+    def setUp(self):
+        """Set up temp dir for tests."""
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        """Remove temp dir."""
+        shutil.rmtree(self.tmpdir)
+
+    def test_hash_file(self):
+        """Test hash_file function."""
+        testfile = os.path.join(self.tmpdir, "test.pod")
+        with open(testfile, 'w') as fih:
+            fih.write("test\n")
+        self.assertEquals(cache.hash_file(testfile),
+                          'f2ca1bb6c7e907d06dafe4687e579fce76b37e4e93b7605022da52e6ccc26fd2')
+
+    def test_tool_versions(self):
+        """Test tool_versions function."""
+        versions = cache.tool_versions()
+        for name in cache.TOOLS + cache.PERLMODULES + cache.CODEFILES:
+            self.assertTrue(name in versions)
+        self.assertTrue(versions['jinja/pan.j2'])
+        self.assertTrue(versions['perl/pod2rst-batch.pl'])
+
+    def test_perl_module_version(self):
+        """Test perl_module_version function."""
+        self.assertTrue(cache.perl_module_version('strict').endswith('/strict.pm'))
+        self.assertIsNone(cache.perl_module_version('No::Such::Module'))
+
+    def test_cache_key(self):
+        """Test cache_key function."""
+        testfile = os.path.join(self.tmpdir, "test.pod")
+        with open(testfile, 'w') as fih:
+            fih.write("test\n")
+        testrepo = repo.Repo('CAF', self.tmpdir)
+        sourcepage = repo.Sourcepage('test', testfile, None, False)
+
+        key = cache.cache_key(sourcepage, testrepo)
+        self.assertEquals(key, cache.cache_key(sourcepage, testrepo))
+
+        # Repository settings are part of the key
+        testrepo.codify_paths = False
+        self.assertNotEqual(key, cache.cache_key(sourcepage, testrepo))
+        testrepo.codify_paths = True
+
+        # So is the content of the source
+        with open(testfile, 'w') as fih:
+            fih.write("changed\n")
+        self.assertNotEqual(key, cache.cache_key(sourcepage, testrepo))
+
+    def test_load_store_page(self):
+        """Test load_page and store_page functions."""
+        key = 'ab' + '0' * 62
+        self.assertEquals(cache.load_page(self.tmpdir, key), (False, None))
+
+        cache.store_page(self.tmpdir, key, u'title\n=====\n')
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'ab', '%s.json' % key)))
+        self.assertEquals(cache.load_page(self.tmpdir, key), (True, u'title\n=====\n'))
+
+        # Pages without content are cached as well
+        cache.store_page(self.tmpdir, key, None)
+        self.assertEquals(cache.load_page(self.tmpdir, key), (True, None))
+
+        # Broken entries are ignored
+        with open(cache.cache_file(self.tmpdir, key), 'w') as fih:
+            fih.write("{broken")
+        self.assertEquals(cache.load_page(self.tmpdir, key), (False, None))
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(CacheTest)
+
+
+if __name__ == '__main__':
+    main()
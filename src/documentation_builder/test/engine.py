@@ -0,0 +1,141 @@
+"""Test module for engine.py."""
+
+import sys
+import os
+import time
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, main, TestLoader
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import engine
+from quattordocbuild import limits
+from quattordocbuild import tracing
+
+
+@tracing.traced('callback')
+def traced_callback(errc, output):
+    """Traced test callback."""
+    return errc
+
+
+class EngineTest(TestCase):
+    """Test class for engine.py."""
+
+    def tearDown(self):
+        """Remove the configured limits."""
+        limits.SLOTS.clear()
+
+    def test_engine(self):
+        """Test the Engine class."""
+        results = {}
+        running = engine.Engine('pod2rst', 2)
+        for number in xrange(5):
+            running.submit(['sh', '-c', 'echo %s; echo error >&2' % number],
+                           lambda errc, output, number=number: results.__setitem__(number, (errc, output)))
+        # more output than fits in a pipe
+        running.submit(['head', '-c', '300000', '/dev/zero'],
+                       lambda errc, output: results.__setitem__('large', (errc, len(output))))
+        running.submit(['false'], lambda errc, output: results.__setitem__('false', (errc, output)))
+        running.run()
+        for number in xrange(5):
+            self.assertEquals(results[number], (0, '%s\nerror\n' % number))
+        self.assertEquals(results['large'], (0, 300000))
+        self.assertEquals(results['false'], (1, ''))
+
+        running.submit(['nonexistent_command'], lambda errc, output: None)
+        self.assertRaises(OSError, running.run)
+
+    def test_engine_span(self):
+        """Test tracing commands as spans of their own."""
+        tracedir = mkdtemp()
+        tracing.enable_tracing(tracedir)
+        try:
+            running = engine.Engine('pod2rst', 2)
+            for number in xrange(2):
+                running.submit(['sh', '-c', 'sleep 0.1; echo %s' % number], traced_callback,
+                               span=('command', {'page': str(number)}))
+            running.run()
+            spans = tracing.read_spans(tracedir)
+        finally:
+            tracing.enable_tracing(None)
+            shutil.rmtree(tracedir)
+        commands = [span for span in spans if span['name'] == 'command']
+        self.assertEquals(sorted([span['args']['page'] for span in commands]), ['0', '1'])
+        self.assertTrue(all([span['args']['child_maxrss'] > 0 for span in commands]))
+        self.assertTrue(all([span['dur'] >= 1e5 for span in commands]))
+        # The callbacks run after the span of their command
+        callbacks = [span for span in spans if span['name'] == 'callback']
+        self.assertEquals(len(callbacks), 2)
+        for command, callback in zip(sorted(commands, key=lambda span: span['ts'] + span['dur']), callbacks):
+            self.assertTrue(callback['ts'] >= command['ts'] + command['dur'])
+
+    def test_engine_concurrency(self):
+        """Test that commands run concurrently, within the slots of the tool class."""
+        limits.configure_limits({'pod2rst': {'concurrency': 2}})
+        finished = []
+        running = engine.Engine('pod2rst', 4)
+        for _ in xrange(4):
+            running.submit(['sleep', '0.3'], lambda errc, output: finished.append(time.time()))
+        start = time.time()
+        running.run()
+        self.assertEquals(len(finished), 4)
+        self.assertTrue(0.5 < time.time() - start < 1.1)
+        semaphore = limits.SLOTS['pod2rst']['semaphore']
+        self.assertTrue(semaphore.acquire(False))
+        self.assertTrue(semaphore.acquire(False))
+        semaphore.release()
+        semaphore.release()
+
+    def test_engine_callback_error(self):
+        """Test that running commands are killed when a callback fails."""
+        limits.configure_limits({'pod2rst': {'concurrency': 2}})
+
+        def fail(errc, output):
+            """Raise an error."""
+            raise ValueError('test')
+
+        running = engine.Engine('pod2rst')
+        running.submit(['true'], fail)
+        running.submit(['sleep', '10'], fail)
+        start = time.time()
+        self.assertRaises(ValueError, running.run)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEquals(running.running, {})
+        semaphore = limits.SLOTS['pod2rst']['semaphore']
+        self.assertTrue(semaphore.acquire(False))
+        self.assertTrue(semaphore.acquire(False))
+        semaphore.release()
+        semaphore.release()
+
+    def test_run_tool(self):
+        """Test run_tool function."""
+        self.assertEquals(engine.run_tool('pod2rst', ['echo', 'test']), (0, 'test\n'))
+        self.assertEquals(engine.run_tool('maven', ['pwd'], startpath='/'), (0, '/\n'))
+
+        limits.configure_limits({'pod2rst': {'timeout': 0.1}})
+        start = time.time()
+        errc, _ = engine.run_tool('pod2rst', ['sleep', '10'])
+        self.assertEquals(errc, engine.RUNRUN_TIMEOUT_EXITCODE)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_run_tool_timeout_grandchild(self):
+        """Test that a timeout kills the processes started by the command as well."""
+        limits.configure_limits({'pod2rst': {'timeout': 0.5}})
+        start = time.time()
+        self.assertEquals(engine.run_tool('pod2rst', ['sh', '-c', 'sleep 8; echo x']),
+                          (engine.RUNRUN_TIMEOUT_EXITCODE, ''))
+        self.assertTrue(time.time() - start < 3)
+
+        # a grandchild which left the process group and keeps the output open
+        start = time.time()
+        errc, _ = engine.run_tool('pod2rst', ['sh', '-c', 'setsid sleep 8 & sleep 8'])
+        self.assertEquals(errc, engine.RUNRUN_TIMEOUT_EXITCODE)
+        self.assertTrue(time.time() - start < 3)
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(EngineTest)
+
+
+if __name__ == '__main__':
+    main()
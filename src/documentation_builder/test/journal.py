@@ -0,0 +1,90 @@
+"""Test module for journal.py."""
+
+import sys
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, main, TestLoader
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import journal
+
+
+class JournalTest(TestCase):
+    """Test class for journal.py."""
+
+    def setUp(self):
+        """Set up temp dir for tests."""
+        self.tmpdir = mkdtemp()
+        self.location = os.path.join(self.tmpdir, journal.JOURNALDIR)
+
+    def tearDown(self):
+        """Remove temp dir."""
+        shutil.rmtree(self.tmpdir)
+
+    def spool(self, testjournal, name):
+        """Spool a page, return its manifest."""
+        spoolfile = os.path.join(testjournal.spooldir, name)
+        with open(spoolfile, 'w') as fih:
+            fih.write(name)
+        return {'title': name, 'spool': spoolfile}
+
+    def test_journal(self):
+        """Test recording and replaying a journal."""
+        testjournal = journal.Journal(self.location)
+        first = self.spool(testjournal, 'first')
+        second = self.spool(testjournal, 'second')
+        testjournal.page_done('CAF', '/src/CAF/first.pod', first)
+        testjournal.page_done('CAF', '/src/CAF/empty.pod', None)
+        testjournal.repository_done('CAF')
+        testjournal.page_done('CCM', '/src/CCM/second.pod', second)
+        testjournal.page_failed('CCM', '/src/CCM/third.pod', 'ValueError: test')
+        testjournal.repository_failed('CCM', 'some of its pages failed')
+        self.assertEquals(testjournal.failures, [('CCM', '/src/CCM/third.pod', 'ValueError: test'),
+                                                 ('CCM', None, 'some of its pages failed')])
+        self.assertTrue("CCM /src/CCM/third.pod: ValueError: test" in testjournal.summary())
+        testjournal.close()
+        # an interrupted build may leave an incomplete entry
+        with open(os.path.join(self.location, journal.JOURNALFILE), 'a') as fih:
+            fih.write('{"unit": "page", "repos')
+
+        resumed = journal.Journal(self.location, resume=True)
+        self.assertEquals(resumed.completed(), ['CAF'])
+        self.assertEquals(resumed.manifests('CAF'), [first])
+        self.assertEquals(resumed.done_pages('CAF'), {'/src/CAF/first.pod': first, '/src/CAF/empty.pod': None})
+        self.assertEquals(resumed.done_pages('CCM'), {'/src/CCM/second.pod': second})
+        self.assertEquals(resumed.failures, [])
+
+        # Repositories with missing spooled pages are built again
+        resumed.close()
+        os.remove(first['spool'])
+        resumed = journal.Journal(self.location, resume=True)
+        self.assertEquals(resumed.completed(), [])
+        self.assertEquals(resumed.done_pages('CAF'), {'/src/CAF/empty.pod': None})
+
+        resumed.remove()
+        self.assertFalse(os.path.exists(self.location))
+
+    def test_fresh_journal(self):
+        """Test a new journal replaces an old one."""
+        testjournal = journal.Journal(self.location)
+        testjournal.repository_done('CAF')
+        testjournal.close()
+        self.assertEquals(journal.Journal(self.location).completed(), [])
+        self.assertEquals(journal.Journal(self.location, resume=True).completed(), [])
+
+    def test_journal_without_location(self):
+        """Test a journal which only keeps the failures."""
+        testjournal = journal.Journal()
+        self.assertIsNone(testjournal.spooldir)
+        testjournal.repository_failed('CAF', 'test')
+        self.assertEquals(testjournal.failures, [('CAF', None, 'test')])
+        testjournal.remove()
+        self.assertEquals(os.listdir(self.tmpdir), [])
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(JournalTest)
+
+
+if __name__ == '__main__':
+    main()
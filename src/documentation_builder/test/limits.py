@@ -0,0 +1,68 @@
+"""Test module for limits.py."""
+
+import sys
+import os
+from unittest import TestCase, main, TestLoader
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import limits
+
+
+class LimitsTest(TestCase):
+    """Test class for limits.py."""
+
+    def tearDown(self):
+        """Remove the configured limits."""
+        limits.SLOTS.clear()
+
+    def test_parse_limits(self):
+        """Test parse_limits function."""
+        self.assertEquals(limits.parse_limits(None), {})
+        self.assertEquals(limits.parse_limits(['maven:concurrency=2', 'maven:timeout=none', 'panc:timeout=60']),
+                          {'maven': {'concurrency': 2, 'timeout': None}, 'panc': {'timeout': 60.0}})
+        for spec in ['maven', 'maven:concurrency', 'java:concurrency=1', 'maven:threads=1', 'maven:concurrency=x',
+                     'maven:concurrency=none', 'pod2rst:memory=0']:
+            self.assertIsNone(limits.parse_limits([spec]), spec)
+
+    def test_tool_limits(self):
+        """Test tool_limits function."""
+        self.assertEquals(limits.tool_limits('pod2rst')['slots'], limits.DEFAULT_LIMITS['pod2rst']['concurrency'])
+        overrides = {'panc': {'concurrency': 8, 'memory': 512, 'memory_budget': 2048}}
+        self.assertEquals(limits.tool_limits('panc', overrides)['slots'], 4)
+        # A budget smaller than a single job still allows one
+        overrides['panc']['memory_budget'] = 100
+        self.assertEquals(limits.tool_limits('panc', overrides)['slots'], 1)
+
+    def test_tool_slot(self):
+        """Test configure_limits, acquire_slot, release_slot and tool_slot."""
+        with limits.tool_slot('maven'):
+            pass
+
+        limits.configure_limits({'maven': {'concurrency': 1}})
+        semaphore = limits.SLOTS['maven']['semaphore']
+        with limits.tool_slot('maven'):
+            self.assertFalse(semaphore.acquire(False))
+        self.assertTrue(semaphore.acquire(False))
+        semaphore.release()
+
+        self.assertTrue(limits.acquire_slot('maven', block=False))
+        self.assertFalse(limits.acquire_slot('maven', block=False))
+        limits.release_slot('maven')
+        self.assertTrue(semaphore.acquire(False))
+        semaphore.release()
+
+        # The slot is released on errors
+        try:
+            with limits.tool_slot('maven'):
+                raise ValueError('test')
+        except ValueError:
+            pass
+        self.assertTrue(semaphore.acquire(False))
+        semaphore.release()
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(LimitsTest)
+
+
+if __name__ == '__main__':
+    main()
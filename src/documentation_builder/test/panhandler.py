@@ -38,6 +38,43 @@ class PanHandlerTest(TestCase):
         # Verify the content
         self.assertTrue(filecmp.cmp("test/testdata/pan_annotated_output.xml", outputfile))
 
+    def test_build_annotations_batch(self):
+        """Test build_annotations_batch function."""
+        testfiles = ["pan_annotated_schema.pan", "pan_schema_variables.pan", "nonexistent.pan"]
+        annotations = panh.build_annotations_batch(testfiles, "test/testdata/", self.tmpdir)
+        self.assertEquals(sorted(annotations.keys()), testfiles[:2])
+        self.assertTrue(filecmp.cmp("test/testdata/pan_annotated_output.xml", annotations[testfiles[0]]))
+
+    def test_annotate_pan_files(self):
+        """Test annotate_pan_files function."""
+        self.assertEquals(panh.annotate_pan_files([], self.tmpdir), {})
+
+        testdir = os.path.join(self.tmpdir, "testdata")
+        outputdir = os.path.join(self.tmpdir, "output")
+        testfile1 = os.path.join(testdir, "one/pan_annotated_schema.pan")
+        testfile2 = os.path.join(testdir, "two/pan_schema_variables.pan")
+        for testfile in [testfile1, testfile2]:
+            os.makedirs(os.path.dirname(testfile))
+            shutil.copy(os.path.join("test/testdata", os.path.basename(testfile)), testfile)
+        os.makedirs(outputdir)
+
+        annotations = panh.annotate_pan_files([testfile1, testfile2], outputdir)
+        self.assertEquals(annotations[testfile1],
+                          os.path.join(outputdir, "one/pan_annotated_schema.pan.annotation.xml"))
+        self.assertEquals(len(annotations), 2)
+
+    def test_get_content_from_annotations(self):
+        """Test get_content_from_annotations function."""
+        self.assertEquals(panh.get_content_from_annotations("test/testdata/pan_empty_annotated_output.xml"), {})
+        content = panh.get_content_from_annotations("test/testdata/pan_annotated_output.xml")
+        self.assertEquals(content['variables'], [])
+        self.assertEquals([ptype['name'] for ptype in content['types']], ['testtype'])
+        self.assertEquals([function['name'] for function in content['functions']], ['add'])
+
+        # A batch built annotation file is used instead of running panc-annotations
+        self.assertEquals(panh.get_content_from_pan("nonexistent.pan", "test/testdata/pan_annotated_output.xml"),
+                          content)
+
     def test_validate_annotations(self):
         """Test validate_annotations function."""
         # Test we skip empty files
@@ -154,6 +191,44 @@ class PanHandlerTest(TestCase):
         expectedoutput = {'args': ['testargument', 'testargument2'], 'name': 'testfunction', 'desc': 'testdesc'}
         self.assertEquals(panh.parse_function(el1), expectedoutput)
 
+    def test_parse_variable(self):
+        """Test parse_variable function."""
+        el1 = self.create_element("%svariable" % panh.namespace, "")
+        el1.attrib['name'] = "testvariable"
+        self.assertEquals(panh.parse_variable(el1), {'name': 'testvariable'})
+
+        el2 = self.create_element("%sdefault" % panh.namespace, "")
+        el2.attrib['text'] = "testdefault"
+        el1.append(el2)
+        self.assertEquals(panh.parse_variable(el1), {'name': 'testvariable', 'default': 'testdefault'})
+
+    def test_iter_annotations(self):
+        """Test iter_annotations function."""
+        records = list(panh.iter_annotations("test/testdata/pan_annotated_output.xml"))
+        self.assertEquals([(record.kind, record.name) for record in records], [('types', 'testtype'),
+                                                                              ('functions', 'add')])
+        self.assertEquals([field.name for field in records[0].fields], ['debug', 'ca_dir', 'def'])
+        self.assertEquals(records[0].fields[0].as_dict(), {'name': 'debug', 'desc': 'Test long.', 'required': 'true',
+                                                           'type': 'long', 'range': '0..1', 'default': '0'})
+        self.assertEquals(records[1].args, ['first number to add', 'second number to add'])
+        self.assertFalse(hasattr(records[0], '__dict__'))
+        self.assertEquals(list(panh.iter_annotations("test/testdata/pan_empty_annotated_output.xml")), [])
+
+    def test_escape_default(self):
+        """Test escape_default function."""
+        self.assertEquals(panh.escape_default('test'), 'test')
+        self.assertEquals(panh.escape_default('`test`'), '\\`test\\`')
+        self.assertEquals(panh.escape_default('test_value_'), 'test\\_value\\_')
+
+    def test_pan_keywords(self):
+        """Test pan_keywords function."""
+        content = panh.get_content_from_annotations("test/testdata/pan_annotated_output.xml")
+        content['variables'] = [{'name': 'TEST_VARIABLE'}]
+        rst = panh.render_template(content, "components/test/", "test::schema")
+        self.assertEquals(panh.pan_keywords(rst), {'type': ['testtype'], 'field': ['debug', 'ca_dir', 'def'],
+                                                   'function': ['add'], 'variable': ['TEST_VARIABLE']})
+        self.assertEquals(panh.pan_keywords("Types\n-----\n\nno list\n"), {})
+
     def test_render_template(self):
         """Test render_template function."""
         content = panh.get_content_from_pan("test/testdata/pan_annotated_schema.pan")
@@ -183,6 +258,16 @@ class PanHandlerTest(TestCase):
         expectedoutput = u'#############\ntest::schemae\n#############\n\nTypes\n-----\n\n - **component-testtesttype**\n    - *component-test/testtype/ca*\n        - Optional\n        - Type: string\n'
         self.assertEquals(output, expectedoutput)
 
+    def test_get_jinja_environment(self):
+        """Test get_jinja_environment function."""
+        jenv = panh.get_jinja_environment()
+        self.assertTrue(jenv is panh.get_jinja_environment())
+        self.assertTrue(jenv.get_template('pan.j2') is jenv.get_template('pan.j2'))
+
+        # Test rendering with the shared environment
+        content = {'functions': [{'args': [], 'name': 'add'}]}
+        self.assertEquals(panh.render_template(content, "", "t"), u'#\nt\n#\n\nFunctions\n---------\n\n - add\n')
+
     def test_get_content_from_pan(self):
         """Test get_content_from_pan function."""
         # Test with empty pan input file.
@@ -0,0 +1,108 @@
+"""Test module for perlhandler.py."""
+
+import sys
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, main, TestLoader
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import perlhandler
+from quattordocbuild import limits
+
+# Converter speaking the pod2rst-batch.pl protocol, without needing Pod::POM::View::Restructured
+FAKECONVERTER = """
+import os
+import sys
+import time
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    infile, title = line.rstrip('\\n').split('\\t', 1)
+    if infile.endswith('crash.pod'):
+        sys.exit(1)
+    if infile.endswith('hang.pod'):
+        time.sleep(60)
+    if not os.path.exists(infile):
+        sys.stdout.write('1 0\\n')
+    else:
+        output = '%s\\n%s' % (title, open(infile).read())
+        sys.stdout.write('0 %s\\n%s' % (len(output), output))
+    sys.stdout.flush()
+"""
+
+
+class PerlHandlerTest(TestCase):
+    """Test class for perlhandler.py."""
+
+    def setUp(self):
+        """Set up temp dir and a fake converter for tests."""
+        self.tmpdir = mkdtemp()
+        fakeconverter = os.path.join(self.tmpdir, 'fakeconverter.py')
+        with open(fakeconverter, 'w') as fih:
+            fih.write(FAKECONVERTER)
+        self.command = [sys.executable, fakeconverter]
+        self.podfile = os.path.join(self.tmpdir, 'test.pod')
+        with open(self.podfile, 'w') as fih:
+            fih.write("=head1 NAME\n")
+
+    def tearDown(self):
+        """Remove temp dir and the configured limits."""
+        perlhandler.CONVERTERS.clear()
+        limits.SLOTS.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_pod2rst(self):
+        """Test Pod2rst class."""
+        converter = perlhandler.Pod2rst(self.command)
+        self.assertEquals(converter.convert(self.podfile, 'title'), 'title\n=head1 NAME\n')
+        process = converter.process
+        self.assertIsNone(converter.convert('nonexistent.pod', 'title'))
+        # The same process is used for all conversions
+        self.assertEquals(converter.convert(self.podfile, 'other'), 'other\n=head1 NAME\n')
+        self.assertTrue(converter.process is process)
+
+        # A crashed converter is restarted
+        self.assertIsNone(converter.convert('crash.pod', 'title'))
+        self.assertEquals(converter.convert(self.podfile, 'title'), 'title\n=head1 NAME\n')
+        converter.close()
+        self.assertIsNone(converter.process)
+
+    def test_pod2rst_timeout(self):
+        """Test a Pod2rst conversion that takes too long."""
+        limits.configure_limits({'pod2rst': {'timeout': 0.2}})
+        converter = perlhandler.Pod2rst(self.command)
+        self.assertIsNone(converter.convert('hang.pod', 'title'))
+        self.assertEquals(converter.convert(self.podfile, 'title'), 'title\n=head1 NAME\n')
+        converter.close()
+
+    def test_get_converter(self):
+        """Test get_converter function."""
+        converter = perlhandler.get_converter()
+        self.assertTrue(converter is perlhandler.get_converter())
+        self.assertEquals(converter.command, ['perl', perlhandler.POD2RST_BATCH])
+
+    def test_convert_perl_files(self):
+        """Test convert_perl_files function."""
+        pairs = [(self.podfile, 'title%s' % index) for index in range(3)]
+        pairs.append(('nonexistent.pod', 'title'))
+        perlhandler.CONVERTERS['converter'] = perlhandler.Pod2rst(self.command)
+        self.assertEquals(perlhandler.convert_perl_files(pairs[2:]),
+                          {self.podfile: 'title2\n=head1 NAME\n', 'nonexistent.pod': None})
+
+        # Several converters in parallel
+        podfiles = []
+        for index in range(10):
+            podfiles.append(os.path.join(self.tmpdir, 'test%s.pod' % index))
+            shutil.copy(self.podfile, podfiles[-1])
+        results = perlhandler.convert_perl_files([(podfile, 'title') for podfile in podfiles], 3, self.command)
+        self.assertEquals(sorted(results.keys()), sorted(podfiles))
+        self.assertEquals(set(results.values()), set(['title\n=head1 NAME\n']))
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(PerlHandlerTest)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,13 @@ import os
 import shutil
 import filecmp
 from tempfile import mkdtemp
+import restructuredtext_lint
 from unittest import TestCase, main, TestLoader
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
 from quattordocbuild import rsthandler as rsth
 from quattordocbuild import repo
+from quattordocbuild import cache
 
 class RstHandlerTest(TestCase):
     """Test class for rsthandler."""
@@ -54,6 +56,24 @@ class RstHandlerTest(TestCase):
         output = rsth.generate_rst([tfil1, tfil2])
         self.assertEquals(len(output), 2)
 
+    def test_set_rst(self):
+        """Test set_rst and perl_rst functions."""
+        sourcepage = repo.Sourcepage('title', '/src/CAF/target/doc/pod/CAF/Test.pod', None, False)
+        # A source without documentation is not a failure
+        self.assertEquals(rsth.perl_rst(sourcepage.path, 0, "\n"), "\n")
+        rsth.set_rst(sourcepage, rsth.perl_rst(sourcepage.path, 0, "\n"))
+        self.assertEquals((sourcepage.rstcontent, sourcepage.failed), (None, False))
+        # A failed or timed out pod2rst is
+        rsth.set_rst(sourcepage, rsth.perl_rst(sourcepage.path, 123, "partial\n"))
+        self.assertEquals((sourcepage.rstcontent, sourcepage.failed), (None, True))
+        rsth.set_rst(sourcepage, "line\n" * 7)
+        self.assertEquals((sourcepage.rstcontent, sourcepage.failed), ("line\n" * 7, False))
+
+    def test_rst_from_perl_batch(self):
+        """Test rst_from_perl_batch function."""
+        sourcepages = [repo.Sourcepage('title', 'test.pan', None, False)]
+        self.assertEquals(rsth.rst_from_perl_batch(sourcepages, 2), {})
+
     def test_remove_emails(self):
         """Test remove_emails function."""
         mailtext = "Hello: mail@mailtest.mail mister."
@@ -82,6 +102,97 @@ class RstHandlerTest(TestCase):
         testpage.rstcontent = "/path/to/test/on test@test.com"
         self.assertEquals(rsth.cleanup_content([testpage, ]), [verify, ])
 
+    def test_clean_code_tags(self):
+        """Test clean_code_tags function."""
+        self.assertEquals(rsth.clean_code_tags("a\\ ``code``\\ b"), "a``code``b")
+        self.assertEquals(rsth.clean_code_tags("\\ \\ ``code``\\ \\ "), "``code``")
+
+    def test_cleanup_content_flags(self):
+        """Test that cleanup_content only runs the enabled cleaners."""
+        content = " /path/to/test/on mail@mailtest.mail \\ ``code``\\ "
+        testpage = repo.Sourcepage('test', '/tmp/testfile', False, False)
+        testpage.rstcontent = content
+        self.assertEquals(rsth.cleanup_content(testpage, True, True, True).rstcontent,
+                          " `/path/to/test/on`  ``code``")
+        testpage.rstcontent = content
+        self.assertEquals(rsth.cleanup_content(testpage, False, True, False).rstcontent,
+                          " `/path/to/test/on` mail@mailtest.mail \\ ``code``\\ ")
+        testpage.rstcontent = content
+        self.assertEquals(rsth.cleanup_content(testpage, False, False, False).rstcontent, content)
+
+        # pan pages are left alone
+        panpage = repo.Sourcepage('test', '/tmp/testfile.pan', False, False)
+        panpage.rstcontent = content
+        self.assertEquals(rsth.cleanup_content(panpage, True, True, True).rstcontent, content)
+
+    def test_lint_content(self):
+        """Test lint_content function."""
+        testpage = repo.Sourcepage('test', '/tmp/testfile', False, False)
+        testpage.rstcontent = "=====\nTitle long\n=====\n\nSub title\n====\n\nFirst section\n====\n\n- a\n- b\nc\n\ntext\n"
+        verify = ("==========\nTitle long\n==========\n\nSub title\n=========\n\nFirst section\n=============\n\n"
+                  "- a\n- b c\n\ntext")
+        self.assertEquals(rsth.lint_content(testpage).rstcontent, verify)
+        self.assertEquals(restructuredtext_lint.lint(verify), [])
+
+        # Several errors are fixed at once
+        testpage.rstcontent = ''.join("Section title %s\n====\n\n" % index for index in range(20))
+        lint = restructuredtext_lint.lint
+        calls = []
+
+        def counting_lint(*args):
+            calls.append(args)
+            return lint(*args)
+        restructuredtext_lint.lint = counting_lint
+        try:
+            rsth.lint_content(testpage)
+        finally:
+            restructuredtext_lint.lint = lint
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(restructuredtext_lint.lint(testpage.rstcontent), [])
+
+    def test_apply_fixes(self):
+        """Test apply_fixes function."""
+        rst = "Title\n==\n\nOther title\n===\n"
+        fixes = [(2, rsth.fix_title_underline), (5, rsth.fix_title_underline)]
+        self.assertEquals(rsth.apply_fixes(rst, fixes), "Title\n=====\n\nOther title\n===========")
+        # overlapping fixes are left for the next run
+        fixes = [(2, rsth.fix_title_underline), (2, rsth.fix_title_underline)]
+        self.assertEquals(rsth.apply_fixes(rst, fixes), "Title\n=====\n\nOther title\n===")
+
+    def test_generate_rst_from_repository(self):
+        """Test generate_rst_from_repository with cached pages."""
+        cachedir = os.path.join(self.tmpdir, "cache")
+        testfile = os.path.join(self.tmpdir, "pod_test_input.pod")
+        shutil.copy("test/testdata/pod_test_input.pod", testfile)
+        testrepo = repo.Repo('CAF', self.tmpdir)
+        testrepo.sources = [repo.Sourcepage('title', testfile, None, False)]
+
+        # A cached page is reused without running pod2rst
+        cache.store_page(cachedir, cache.cache_key(testrepo.sources[0], testrepo), u'cached\n')
+        testrepo = rsth.generate_rst_from_repository(testrepo, cachedir)
+        self.assertEquals([page.rstcontent for page in testrepo.sources], [u'cached\n'])
+
+        # Cached pages without content are dropped
+        cache.store_page(cachedir, cache.cache_key(testrepo.sources[0], testrepo), None)
+        self.assertEquals(rsth.generate_rst_from_repository(testrepo, cachedir).sources, [])
+
+    def test_finish_page(self):
+        """Test finish_page function."""
+        cachedir = os.path.join(self.tmpdir, "cache")
+        testrepo = repo.Repo('CAF', self.tmpdir)
+        testfile = os.path.join(self.tmpdir, "pod_test_input.pod")
+        shutil.copy("test/testdata/pod_test_input.pod", testfile)
+        sourcepage = repo.Sourcepage('title', testfile, None, False)
+        key = cache.cache_key(sourcepage, testrepo)
+
+        # A page whose tool failed is not cached
+        rsth.finish_page(rsth.set_rst(sourcepage, None), testrepo, cachedir)
+        self.assertEquals(cache.load_page(cachedir, key), (False, None))
+
+        # A page without content is
+        rsth.finish_page(rsth.set_rst(sourcepage, "\n"), testrepo, cachedir)
+        self.assertEquals(cache.load_page(cachedir, key), (True, None))
+
     def suite(self):
         """Return all the testcases in this module."""
         return TestLoader().loadTestsFromTestCase(RstHandlerTest)
@@ -0,0 +1,73 @@
+"""Test module for schedule.py."""
+
+import sys
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, main, TestLoader
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import schedule
+from quattordocbuild import repo
+
+
+class ScheduleTest(TestCase):
+    """Test class for schedule.py."""
+
+    def setUp(self):
+        """Set up temp dir for tests."""
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        """Remove temp dir."""
+        shutil.rmtree(self.tmpdir)
+
+    def test_load_save_durations(self):
+        """Test load_durations and save_durations functions."""
+        statedir = os.path.join(self.tmpdir, 'state')
+        self.assertEquals(schedule.load_durations(None), {})
+        self.assertEquals(schedule.load_durations(statedir), {})
+
+        schedule.save_durations(statedir, {'CAF': {'prepare': 1.0, 'pages': 2.0, 'sources': 3}})
+        schedule.save_durations(statedir, {'CCM': {'prepare': 1.0, 'pages': 0.5, 'sources': 1}})
+        self.assertEquals(schedule.load_durations(statedir), {
+            'CAF': {'stages': {'prepare': 1.0, 'pages': 2.0}, 'total': 3.0, 'sources': 3},
+            'CCM': {'stages': {'prepare': 1.0, 'pages': 0.5}, 'total': 1.5, 'sources': 1},
+        })
+
+        # A broken state file is ignored
+        with open(schedule.durations_file(statedir), 'w') as fih:
+            fih.write("{broken")
+        self.assertEquals(schedule.load_durations(statedir), {})
+
+    def test_estimate_costs(self):
+        """Test estimate_costs function."""
+        caf = repo.Repo('CAF', self.tmpdir)
+        ccm = repo.Repo('CCM', self.tmpdir)
+
+        # Without history, every repository gets the same cost, so the order is kept
+        self.assertEquals(schedule.estimate_costs([caf, ccm], {}),
+                          {'CAF': schedule.DEFAULT_SECONDS, 'CCM': schedule.DEFAULT_SECONDS})
+
+        durations = {'CCM': {'stages': {}, 'total': 10.0, 'sources': 4},
+                     'ncm-ncd': {'stages': {}, 'total': 4.0, 'sources': 1}}
+        self.assertEquals(schedule.estimate_costs([caf, ccm], durations), {'CAF': 7.0, 'CCM': 10.0})
+
+    def test_order_longest_first(self):
+        """Test order_longest_first function."""
+        repos = [repo.Repo(name, self.tmpdir) for name in ['CAF', 'CCM', 'ncm-ncd']]
+        ordered = schedule.order_longest_first(repos, {'CAF': 1, 'CCM': 5, 'ncm-ncd': 1})
+        self.assertEquals([repository.name for repository in ordered], ['CCM', 'CAF', 'ncm-ncd'])
+
+    def test_estimate_makespan(self):
+        """Test estimate_makespan function."""
+        self.assertEquals(schedule.estimate_makespan([], 4), 0)
+        self.assertEquals(schedule.estimate_makespan([3, 1, 2], 1), 6)
+        self.assertEquals(schedule.estimate_makespan([5, 4, 3, 2], 2), 7)
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(ScheduleTest)
+
+
+if __name__ == '__main__':
+    main()
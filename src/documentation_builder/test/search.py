@@ -0,0 +1,103 @@
+"""Test module for search.py."""
+
+import sys
+import os
+import json
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, main, TestLoader
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import search
+
+PANPAGE = """#####
+title
+#####
+
+Types
+-----
+
+ - **/software/components/ccm/component_ccm**
+    - *component_ccm/fetch_timeout*
+        - Description: Fetch timeout in seconds.
+        - Required
+        - Type: long
+
+Functions
+---------
+
+ - ccm_configure
+"""
+
+
+class SearchTest(TestCase):
+    """Test class for search.py."""
+
+    def setUp(self):
+        """Set up temp dir for tests."""
+        self.tmpdir = mkdtemp()
+        self.location = os.path.join(self.tmpdir, 'docs', search.SEARCHDIR)
+
+    def tearDown(self):
+        """Remove temp dir."""
+        shutil.rmtree(self.tmpdir)
+
+    def test_stem(self):
+        """Test stem function."""
+        for word in ['configure', 'configures', 'configured', 'configuring']:
+            self.assertEquals(search.stem(word), 'configur')
+        self.assertEquals(search.stem('properties'), 'property')
+        self.assertEquals(search.stem('classes'), 'class')
+        self.assertEquals(search.stem('status'), 'status')
+        self.assertEquals(search.stem('use'), 'use')
+        self.assertEquals(search.stem('2016'), '2016')
+
+    def test_terms(self):
+        """Test terms function."""
+        self.assertEquals(search.terms("The CAF::Reporter of ncm-ccm, see x."), ['caf', 'reporter', 'ncm', 'ccm', 'see'])
+
+    def test_page_scores(self):
+        """Test page_scores function."""
+        scores = search.page_scores('ccm', PANPAGE)
+        boosts = search.BOOSTS
+        self.assertEquals(scores['ccm'], boosts['title'] + 4 * boosts['body'] + boosts['type'] + boosts['function'])
+        self.assertEquals(scores['timeout'], 2 * boosts['body'] + boosts['field'])
+        self.assertEquals(scores['second'], boosts['body'])
+
+    def test_write_index(self):
+        """Test write_index and search functions."""
+        index = search.new_index()
+        search.add_page(index, 'components/ccm.rst', 'ccm', PANPAGE)
+        search.add_page(index, 'CCM/Fetch.rst', 'CCM::Fetch', 'Fetch the profile, with a timeout.')
+        search.add_page(index, 'CAF/Reporter.rst', 'CAF::Reporter', 'Report messages.')
+        search.write_index(index, self.location)
+        with open(os.path.join(self.location, 'meta.json')) as fih:
+            meta = json.load(fih)
+        self.assertEquals(meta['pages'], 3)
+        self.assertTrue('fe' in meta['shards'])
+        self.assertTrue(os.path.exists(os.path.join(self.location, 'fe.json')))
+        self.assertTrue(os.path.exists(os.path.join(self.location, 'search.js')))
+
+        results = search.search(self.location, 'fetch timeout')
+        self.assertEquals([path for path, _, _ in results], ['components/ccm.rst', 'CCM/Fetch.rst'])
+        self.assertEquals(results[1][1], 'CCM::Fetch')
+        # All terms have to match
+        self.assertEquals([path for path, _, _ in search.search(self.location, 'reporting messages')],
+                          ['CAF/Reporter.rst'])
+        self.assertEquals(search.search(self.location, 'reporter timeout'), [])
+        self.assertEquals(search.search(self.location, 'nonexistent'), [])
+        self.assertEquals(search.search(self.location, 'the'), [])
+
+        # A new index replaces the old one
+        index = search.new_index()
+        search.add_page(index, 'CAF/Reporter.rst', 'CAF::Reporter', 'Report messages.')
+        search.write_index(index, self.location)
+        self.assertFalse(os.path.exists(os.path.join(self.location, 'fe.json')))
+        self.assertEquals(os.listdir(os.path.dirname(self.location)), [search.SEARCHDIR])
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(SearchTest)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Test module for shard.py."""
+
+import sys
+import os
+import json
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, main, TestLoader
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import shard
+from quattordocbuild import repo
+
+
+class ShardTest(TestCase):
+    """Test class for shard.py."""
+
+    def setUp(self):
+        """Set up temp dir for tests."""
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        """Remove temp dir."""
+        shutil.rmtree(self.tmpdir)
+
+    def spool(self, name, content):
+        """Spool a page and return its manifest."""
+        path = os.path.join(self.tmpdir, '%s.spool' % name)
+        with open(path, 'w') as fih:
+            fih.write(content)
+        return {'sitesection': 'CAF', 'title': name, 'filename': '%s.rst' % name, 'spool': path,
+                'source': '/src/CAF/%s.pod' % name, 'hash': 'hash%s' % name, 'size': len(content)}
+
+    def test_parse_shard(self):
+        """Test parse_shard function."""
+        self.assertEquals(shard.parse_shard('1/4'), (1, 4))
+        self.assertEquals(shard.parse_shard('4/4'), (4, 4))
+        for spec in ['0/4', '5/4', '1', '1/x', '1/2/3', '']:
+            self.assertIsNone(shard.parse_shard(spec), spec)
+
+    def test_shard_of(self):
+        """Test shard_of function."""
+        # The shard of a page never changes, whatever the host
+        self.assertEquals(shard.shard_of('CAF', 'target/doc/pod/CAF/Mod1.pod', 4), 2)
+        counts = [0] * 4
+        for number in xrange(1000):
+            counts[shard.shard_of('CAF', 'target/doc/pod/Mod%s.pod' % number, 4) - 1] += 1
+        self.assertTrue(min(counts) > 200, counts)
+
+    def test_select_shard(self):
+        """Test select_shard function."""
+        repository = repo.Repo('CAF', '/src/CAF')
+        sources = [repo.Sourcepage('Mod%s' % number, '/src/CAF/target/doc/pod/Mod%s.pod' % number, None, False)
+                   for number in xrange(20)]
+        repository.sources = list(sources)
+        self.assertEquals(shard.select_shard(repository, None).sources, sources)
+        # A repository built in a single shard keeps all its pages
+        self.assertEquals(shard.select_shard(repository, (1, 3)).sources, sources)
+        repository.shard_pages = True
+        selected = []
+        for index in [1, 2, 3]:
+            repository.sources = list(sources)
+            selected.extend(shard.select_shard(repository, (index, 3)).sources)
+        self.assertEquals(sorted(selected), sorted(sources))
+
+    def test_shard_repositories(self):
+        """Test shard_repositories function."""
+        repository_map = [repo.Repo(name, '/src/%s' % name) for name in
+                          ['CAF', 'CCM', 'ncm-ncd', 'maven-tools', 'configuration-modules-core']]
+        self.assertEquals(shard.shard_repositories(repository_map, None), repository_map)
+        selected = [shard.shard_repositories(repository_map, (index, 2)) for index in [1, 2]]
+        # Every repository is built by a single shard, except the ones whose pages are split
+        self.assertEquals(sorted([repository.name for repositories in selected for repository in repositories]),
+                          ['CAF', 'CCM', 'configuration-modules-core', 'configuration-modules-core',
+                           'maven-tools', 'ncm-ncd'])
+        self.assertEquals(shard.shard_repositories(repository_map, (1, 2)),
+                          shard.shard_repositories(repository_map, (1, 2)))
+
+    def test_write_shard(self):
+        """Test write_shard, read_shards and find_collisions functions."""
+        locations = [os.path.join(self.tmpdir, 'shard%s' % index) for index in [1, 2]]
+        for location in locations:
+            os.makedirs(location)
+        path = shard.write_shard([self.spool('Mod1', 'one'), self.spool('Mod2', 'two')], locations[0], (1, 2))
+        with open(path) as fih:
+            self.assertEquals(len(json.load(fih)['pages']), 2)
+        self.assertIsNone(shard.read_shards(locations))
+        self.assertIsNone(shard.read_shards([]))
+        # A shard written again replaces its previous output
+        shard.write_shard([self.spool('Mod1', 'one')], locations[0], (1, 2))
+        self.assertEquals(os.listdir(locations[0]), [shard.SHARDDIR])
+        shard.write_shard([self.spool('Mod3', 'three')], locations[1], (2, 2), failures=1)
+
+        shards = shard.read_shards(reversed(locations))
+        self.assertEquals([(item['index'], item['failures']) for item in shards], [(1, 0), (2, 1)])
+        with open(shards[1]['pages'][0]['spool']) as fih:
+            self.assertEquals(fih.read(), 'three')
+        self.assertEquals(shard.find_collisions(shards), [])
+        self.assertIsNone(shard.read_shards([locations[0], locations[0]]))
+
+        collision = self.spool('Mod1', 'other')
+        collision['source'] = '/src/CAF/other/Mod1.pod'
+        shard.write_shard([collision], locations[1], (2, 2))
+        self.assertEquals(shard.find_collisions(shard.read_shards(locations)),
+                          [('CAF', 'Mod1.rst', ['/src/CAF/Mod1.pod', '/src/CAF/other/Mod1.pod'])])
+
+        shard.write_shard([], locations[1], (2, 3))
+        self.assertIsNone(shard.read_shards(locations))
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(ShardTest)
+
+
+if __name__ == '__main__':
+    main()
@@ -37,6 +37,69 @@ class SourcehandlerTest(TestCase):
 
         self.assertEqual(sourcehandler.maven_clean_compile(repoloc), 0)
 
+    def write_pom(self, path, name, modules=None):
+        """Write a basic pom.xml with name and modules in path."""
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(path, "pom.xml"), "w") as fih:
+            fih.write('<project xmlns="http://maven.apache.org/POM/4.0.0"><modelVersion>4.0.0</modelVersion>')
+            fih.write('<groupId>test</groupId><artifactId>%s</artifactId><version>1</version>' % name)
+            if modules:
+                fih.write('<packaging>pom</packaging><modules>')
+                for module in modules:
+                    fih.write('<module>%s</module>' % module)
+                fih.write('</modules>')
+            fih.write('</project>')
+
+    def test_make_aggregator_pom(self):
+        """Test make_aggregator_pom function."""
+        pomfile = sourcehandler.make_aggregator_pom(['/tmp/repo1', os.path.join(self.tmpdir, 'repo2')], self.tmpdir)
+        self.assertEquals(pomfile, os.path.join(self.tmpdir, 'pom.xml'))
+        with open(pomfile) as fih:
+            content = fih.read()
+        self.assertTrue('<packaging>pom</packaging>' in content)
+        self.assertTrue('<module>%s</module>' % os.path.relpath('/tmp/repo1', self.tmpdir) in content)
+        self.assertTrue('<module>repo2</module>' in content)
+
+    def test_maven_module_names(self):
+        """Test maven_module_names function."""
+        self.assertEquals(sourcehandler.maven_module_names(self.tmpdir), [])
+        self.write_pom(self.tmpdir, 'parent', ['ncm-one', 'ncm-two'])
+        self.write_pom(os.path.join(self.tmpdir, 'ncm-one'), 'one')
+        self.write_pom(os.path.join(self.tmpdir, 'ncm-two'), 'two')
+        self.assertEquals(sourcehandler.maven_module_names(self.tmpdir), ['parent', 'one', 'two'])
+
+    def test_reactor_regex(self):
+        """Test the regex used to find failed modules in a reactor summary."""
+        output = "\n".join([
+            "[INFO] Reactor Summary:",
+            "[INFO] one ................................................ SUCCESS [  1.139 s]",
+            "[INFO] two 1.2.0-SNAPSHOT ................................. FAILURE [  0.510 s]",
+            "[INFO] three .............................................. SKIPPED",
+            "[INFO] BUILD FAILURE",
+        ])
+        self.assertEquals([match.group(1) for match in sourcehandler.REACTORREGEX.finditer(output)],
+                          ['two 1.2.0-SNAPSHOT', 'three'])
+
+    def test_maven_reactor_compile(self):
+        """Test maven_reactor_compile function."""
+        testrepo = repo.Repo('CCM', os.path.join(self.tmpdir, 'CCM'))
+        self.assertEquals(sourcehandler.maven_reactor_compile([]), set())
+
+        # A working repository
+        self.write_pom(testrepo.path, 'ccm')
+        self.assertEquals(sourcehandler.maven_reactor_compile([testrepo], offline=True), set())
+
+        # A broken one is reported
+        brokenrepo = repo.Repo('CAF', os.path.join(self.tmpdir, 'CAF'))
+        self.write_pom(brokenrepo.path, 'caf', ['missing'])
+        os.makedirs(os.path.join(brokenrepo.path, 'missing'))
+        with open(os.path.join(brokenrepo.path, 'missing', 'pom.xml'), 'w') as fih:
+            fih.write('<project><modelVersion>4.0.0</modelVersion><artifactId>missing</artifactId>')
+            fih.write('<version>1</version><dependencies><dependency><groupId>nonexisting</groupId>')
+            fih.write('<artifactId>nonexisting</artifactId><version>0</version></dependency></dependencies></project>')
+        self.assertEquals(sourcehandler.maven_reactor_compile([testrepo, brokenrepo], offline=True), set(['CAF']))
+
     def test_is_wanted_file(self):
         """Test is_wanted_file function."""
         # Test valid extensions
@@ -63,21 +126,6 @@ class SourcehandlerTest(TestCase):
         # Test for a correct path
         self.assertTrue(sourcehandler.is_wanted_dir('/tmp/target/doc/pod', ['doc/pod']))
 
-    def test_handle_duplicates(self):
-        """Test handle_duplicates function."""
-        testperlfile = 'test/lib/perl/test.pm'
-        testpodfile = 'test/doc/pod/test.pod'
-
-        # Add a correct item to an empty list
-        self.assertEquals(sourcehandler.handle_duplicates('test.pm', testperlfile, []),
-                          ['test/lib/perl/test.pm'])
-
-        # Add a pod file when a pm file is in the list, get a list with only the pod file back
-        self.assertEquals(sourcehandler.handle_duplicates('test.pod', testpodfile, [testperlfile]), [testpodfile])
-
-        # Add a pm file when a pod file is in the list, get a list with only the pod file back
-        self.assertEquals(sourcehandler.handle_duplicates('test.pm', testperlfile, [testpodfile]), [testpodfile])
-
     def test_list_source_files(self):
         """Test list_source_files function."""
         # Test a bogus dir
@@ -95,6 +143,92 @@ class SourcehandlerTest(TestCase):
         testrepo = repo.Repo('CAF', self.tmpdir)
         self.assertEquals(sourcehandler.list_source_files(testrepo), [os.path.join(fulltestdir, testfile)])
 
+        # The pod file takes precedence over the pm file, the result is sorted
+        perldir = os.path.join(self.tmpdir, 'target/lib/perl')
+        os.makedirs(perldir)
+        for name in ['test.pm', 'other.pm']:
+            with open(os.path.join(perldir, name), 'w') as fih:
+                fih.write("test\n")
+        self.assertEquals(sourcehandler.list_source_files(testrepo),
+                          [os.path.join(fulltestdir, testfile), os.path.join(perldir, 'other.pm')])
+
+    def test_walk_wanted_dirs(self):
+        """Test walk_wanted_dirs function."""
+        for subdir in ['ncm-a/target/doc/pod/NCM', 'ncm-a/target/classes', 'ncm-a/src/main', '.git/objects',
+                       'ncm-a/target/lib/perl']:
+            os.makedirs(os.path.join(self.tmpdir, subdir))
+        with open(os.path.join(self.tmpdir, 'ncm-a/target/doc/pod/NCM/test.pod'), 'w') as fih:
+            fih.write("test\n")
+
+        skipped = []
+        walked = dict(sourcehandler.walk_wanted_dirs(self.tmpdir, ['target/doc/pod'], skipped))
+        self.assertEquals(walked[os.path.join(self.tmpdir, 'ncm-a/target/doc/pod/NCM')], ['test.pod'])
+        self.assertTrue(os.path.join(self.tmpdir, 'ncm-a/src/main') in walked)
+        self.assertEquals(sorted(skipped), [os.path.join(self.tmpdir, subdir) for subdir in
+                                            ['.git', 'ncm-a/target/classes', 'ncm-a/target/lib']])
+
+        # An empty wanted dir matches everything
+        skipped = []
+        walked = dict(sourcehandler.walk_wanted_dirs(self.tmpdir, [''], skipped))
+        self.assertTrue(os.path.join(self.tmpdir, 'ncm-a/target/classes') in walked)
+        self.assertEquals(skipped, [os.path.join(self.tmpdir, '.git')])
+
+    def make_metaconfig(self):
+        """Create a metaconfig like source tree, return its location."""
+        source = os.path.join(self.tmpdir, 'metaconfig')
+        for name in ['service/pan/schema.pan', 'service/pan/config.pan', 'service/main.tt',
+                     'service/tests/profiles/test.pan']:
+            path = os.path.join(source, name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fih:
+                fih.write("%s\n" % name)
+        return source
+
+    def test_staged_files(self):
+        """Test staged_files function."""
+        source = self.make_metaconfig()
+        self.assertEquals(sourcehandler.staged_files(source, ['*.tt', '*tests*']), {
+            'service/schema.pan': os.path.join(source, 'service/pan/schema.pan'),
+            'service/config.pan': os.path.join(source, 'service/pan/config.pan'),
+        })
+
+    def test_stage_files(self):
+        """Test stage_files function."""
+        source = self.make_metaconfig()
+        schema = os.path.join(source, 'service/pan/schema.pan')
+        for mode in sourcehandler.STAGEMODES:
+            destination = os.path.join(self.tmpdir, 'target', mode)
+            self.assertEquals(sourcehandler.stage_files(source, destination, ['*.tt', '*tests*'], mode), (2, 0))
+            staged = os.path.join(destination, 'service/schema.pan')
+            self.assertEquals(open(staged).read(), "service/pan/schema.pan\n")
+            self.assertEquals(os.path.islink(staged), mode == 'symlink')
+            self.assertEquals(os.path.samefile(schema, staged), mode != 'copy')
+
+            # Rerunning over an existing destination keeps the staged files and removes stale ones
+            with open(os.path.join(destination, 'service/stale.pan'), 'w') as fih:
+                fih.write("stale\n")
+            self.assertEquals(sourcehandler.stage_files(source, destination, ['*.tt', '*tests*'], mode), (0, 1))
+            self.assertEquals(sorted(os.listdir(os.path.join(destination, 'service'))), ['config.pan', 'schema.pan'])
+
+        self.assertRaises(ValueError, sourcehandler.stage_files, source, destination, [], 'move')
+
+    def test_source_key(self):
+        """Test source_key function."""
+        self.assertEquals(sourcehandler.source_key('test.pod', 'test/doc/pod/test.pod'), 'test/lib/perl/test.pm')
+        self.assertEquals(sourcehandler.source_key('test.pm', 'test/lib/perl/test.pm'), 'test/lib/perl/test.pm')
+        self.assertEquals(sourcehandler.source_key('test.pan', 'test/pan/test.pan'), 'test/pan/test.pan')
+
+    def test_add_source(self):
+        """Test add_source function."""
+        testperlfile = 'test/lib/perl/test.pm'
+        testpodfile = 'test/doc/pod/test.pod'
+        expected = {testperlfile: testpodfile}
+        self.assertEquals(sourcehandler.add_source({}, 'test.pm', testperlfile), {testperlfile: testperlfile})
+        # pod takes preference over pm, regardless of the order they are found in
+        self.assertEquals(sourcehandler.add_source({testperlfile: testperlfile}, 'test.pod', testpodfile), expected)
+        self.assertEquals(sourcehandler.add_source({testperlfile: testpodfile}, 'test.pm', testperlfile), expected)
+
     def test_get_source_files(self):
         """Test get_source_files function."""
         testrepo = repo.Repo('CCM', self.tmpdir)
@@ -0,0 +1,98 @@
+"""Test module for tracing.py."""
+
+import sys
+import os
+import json
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, main, TestLoader
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import tracing
+from quattordocbuild.engine import run_tool
+from quattordocbuild.limits import configure_limits
+
+
+@tracing.traced('double', lambda value: {'page': 'page%s' % value})
+def double(value):
+    """Traced test function."""
+    run_tool('pod2rst', ['true'])
+    return value * 2
+
+
+@tracing.traced('nothing')
+def nothing():
+    """Traced test function without child processes."""
+    return None
+
+
+class TracingTest(TestCase):
+    """Test class for tracing.py."""
+
+    def setUp(self):
+        """Set up temp dir and tool limits for tests."""
+        self.tmpdir = mkdtemp()
+        configure_limits()
+
+    def tearDown(self):
+        """Remove temp dir and disable tracing."""
+        tracing.enable_tracing(None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_traced(self):
+        """Test traced decorator."""
+        # Nothing is recorded when tracing is disabled
+        self.assertEquals(double(1), 2)
+        self.assertEquals(os.listdir(self.tmpdir), [])
+
+        tracing.enable_tracing(self.tmpdir)
+        tracing.set_context(repository='CAF')
+        self.assertEquals(double(2), 4)
+        self.assertEquals(double.__name__, 'double')
+        spans = tracing.read_spans(self.tmpdir)
+        self.assertEquals(len(spans), 1)
+        self.assertEquals(spans[0]['name'], 'double')
+        self.assertEquals(spans[0]['pid'], os.getpid())
+        self.assertEquals(spans[0]['args']['repository'], 'CAF')
+        self.assertEquals(spans[0]['args']['page'], 'page2')
+        for key in ['cpu', 'child_cpu', 'child_maxrss']:
+            self.assertTrue(key in spans[0]['args'])
+        self.assertTrue(spans[0]['args']['child_maxrss'] > 0)
+
+        # Context can be removed
+        tracing.set_context(repository=None)
+        double(3)
+        self.assertFalse('repository' in tracing.read_spans(self.tmpdir)[1]['args'])
+
+        # The maximum RSS is of the child processes reaped in the span only
+        nothing()
+        self.assertEquals(tracing.read_spans(self.tmpdir)[2]['args']['child_maxrss'], 0)
+
+    def test_write_chrome_trace(self):
+        """Test write_chrome_trace function."""
+        tracefile = os.path.join(self.tmpdir, 'trace.json')
+        spans = [{'name': 'lint_content', 'ph': 'X', 'ts': 0, 'dur': 10, 'pid': 1, 'tid': 1, 'args': {}}]
+        tracing.write_chrome_trace(spans, tracefile)
+        with open(tracefile) as fih:
+            self.assertEquals(json.load(fih)['traceEvents'], spans)
+
+    def test_summarize(self):
+        """Test summarize and slowest functions."""
+        spans = [
+            {'name': 'lint_content', 'dur': 2e6, 'args': {'repository': 'CAF', 'page': 'a.pod'}},
+            {'name': 'lint_content', 'dur': 1e6, 'args': {'repository': 'CCM', 'page': 'b.pod'}},
+            {'name': 'rst_from_perl', 'dur': 2e6, 'args': {'repository': 'CCM', 'page': 'b.pod', 'child_cpu': 1.5}},
+        ]
+        self.assertEquals(tracing.slowest(spans, 'repository', 5), [('CCM', 3.0), ('CAF', 2.0)])
+        self.assertEquals(tracing.slowest(spans, 'page', 1), [('b.pod', 3.0)])
+        summary = tracing.summarize(spans)
+        self.assertTrue("lint_content: 3.00s in 2 calls (0.00s child cpu)" in summary)
+        self.assertTrue("rst_from_perl: 2.00s in 1 calls (1.50s child cpu)" in summary)
+        self.assertTrue("Slowest repositories:\n  CCM: 3.00s\n  CAF: 2.00s" in summary)
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(TracingTest)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""Test module for watcher.py."""
+
+import sys
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, main, TestLoader, skipIf
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib')))  # noqa
+from quattordocbuild import watcher
+from quattordocbuild import repo
+
+
+def fake_generate_page(sourcepage, repository, annotations=None, cachedir=None, perlrst=None):
+    """Generate a page from the content of its source, without pod2rst."""
+    with open(sourcepage.path) as fih:
+        content = fih.read()
+    sourcepage.rstcontent = content.decode('utf-8') if content.strip() else None
+    return sourcepage
+
+
+class WatcherTest(TestCase):
+    """Test class for watcher.py."""
+
+    def setUp(self):
+        """Set up temp dir for tests."""
+        self.tmpdir = mkdtemp()
+        self.generate_page = watcher.generate_page
+        self.poddir = os.path.join(self.tmpdir, 'CAF', 'target', 'doc', 'pod', 'CAF')
+        os.makedirs(self.poddir)
+
+    def tearDown(self):
+        """Remove temp dir and restore generate_page."""
+        watcher.generate_page = self.generate_page
+        shutil.rmtree(self.tmpdir)
+
+    def write_pod(self, name, content):
+        """Write a pod file, return its path."""
+        path = os.path.join(self.poddir, name)
+        with open(path, 'w') as fih:
+            fih.write(content)
+        return path
+
+    def test_polling_watcher(self):
+        """Test PollingWatcher class."""
+        first = self.write_pod('First.pod', 'first\n')
+        files = [first]
+        pollwatcher = watcher.PollingWatcher(lambda: files, 0.01)
+        self.assertEquals(pollwatcher.changes(0), set())
+
+        self.write_pod('First.pod', 'first changed\n')
+        self.assertEquals(pollwatcher.changes(1), set([first]))
+        files.append(self.write_pod('Second.pod', 'second\n'))
+        self.assertEquals(pollwatcher.changes(1), set([files[1]]))
+        os.remove(first)
+        self.assertEquals(pollwatcher.changes(1), set([first]))
+
+    @skipIf(watcher.pyinotify is None, "pyinotify is not available")
+    def test_inotify_watcher(self):
+        """Test InotifyWatcher class."""
+        inotifywatcher = watcher.InotifyWatcher([self.tmpdir])
+        try:
+            self.assertEquals(inotifywatcher.changes(0), set())
+            first = self.write_pod('First.pod', 'first\n')
+            self.assertEquals(inotifywatcher.changes(1), set([first]))
+        finally:
+            inotifywatcher.close()
+
+    def test_rebuild(self):
+        """Test rebuild function."""
+        watcher.generate_page = fake_generate_page
+        first = self.write_pod('First.pod', 'first\n')
+        testrepo = repo.Repo('CAF', os.path.join(self.tmpdir, 'CAF'))
+        testrepo.mvncompile = False
+        docs = os.path.join(self.tmpdir, 'docs')
+        sources = {'CAF': watcher.index_sources(testrepo)}
+        sitepages = {'CAF': set(['CAF_First.rst'])}
+        interlinks = {}
+
+        # Nothing happens for files outside the repositories
+        self.assertEquals(watcher.rebuild(set(['/elsewhere/test.pod']), [testrepo], sources, sitepages, docs,
+                                          interlinks=interlinks), (0, 0))
+
+        # A changed and a new source are (re)generated
+        self.write_pod('First.pod', 'first changed, see `CAF_Second`.\n')
+        second = self.write_pod('Second.pod', 'second\n')
+        self.assertEquals(watcher.rebuild(set([first, second]), [testrepo], sources, sitepages, docs,
+                                          interlinks=interlinks), (2, 0))
+        with open(os.path.join(docs, 'CAF', 'CAF_First.rst')) as fih:
+            self.assertEquals(fih.read(), 'first changed, see [CAF_Second](../CAF/CAF_Second.rst).\n')
+        self.assertEquals(sitepages['CAF'], set(['CAF_First.rst', 'CAF_Second.rst']))
+
+        # The interlinks are only compiled again when pages are added or removed
+        linkregex = interlinks['regex']
+        self.write_pod('First.pod', 'first changed again.\n')
+        self.assertEquals(watcher.rebuild(set([first]), [testrepo], sources, sitepages, docs,
+                                          interlinks=interlinks), (1, 0))
+        self.assertTrue(interlinks['regex'] is linkregex)
+
+        # The page of a removed source is removed
+        os.remove(second)
+        self.assertEquals(watcher.rebuild(set([second]), [testrepo], sources, sitepages, docs,
+                                          interlinks=interlinks), (0, 1))
+        self.assertEquals(os.listdir(os.path.join(docs, 'CAF')), ['CAF_First.rst'])
+        self.assertEquals(sitepages['CAF'], set(['CAF_First.rst']))
+        self.assertFalse(interlinks['regex'] is linkregex)
+
+        # A pod file takes preference over the pm file it documents
+        libdir = os.path.join(testrepo.path, 'target', 'lib', 'perl', 'CAF')
+        os.makedirs(libdir)
+        third = os.path.join(libdir, 'Third.pm')
+        with open(third, 'w') as fih:
+            fih.write('third pm\n')
+        self.assertEquals(watcher.rebuild(set([third]), [testrepo], sources, sitepages, docs), (1, 0))
+        thirdpod = self.write_pod('Third.pod', 'third pod\n')
+        self.assertEquals(watcher.rebuild(set([thirdpod]), [testrepo], sources, sitepages, docs), (1, 1))
+        self.assertEquals(sorted(sources['CAF']), [first, thirdpod])
+        os.remove(thirdpod)
+        self.assertEquals(watcher.rebuild(set([thirdpod]), [testrepo], sources, sitepages, docs), (1, 1))
+        self.assertEquals(sorted(sources['CAF']), [first, third])
+
+    def test_compile_changes(self):
+        """Test list_tree_files, compiled_counterparts and compile_changes functions."""
+        testrepo = repo.Repo('CAF', os.path.join(self.tmpdir, 'CAF'))
+        srcdir = os.path.join(testrepo.path, 'src', 'main', 'perl', 'CAF')
+        os.makedirs(srcdir)
+        libdir = os.path.join(testrepo.path, 'target', 'lib', 'perl', 'CAF')
+        os.makedirs(libdir)
+        first = os.path.join(srcdir, 'First.pod')
+        second = os.path.join(srcdir, 'Second.pm')
+        for path in [first, second]:
+            with open(path, 'w') as fih:
+                fih.write('source\n')
+        compiled = self.write_pod('First.pod', 'compiled\n')
+        self.assertEquals(sorted(watcher.list_tree_files(testrepo)), [first, second])
+
+        # Existing counterparts are updated, a new file goes to the first target tree of its module
+        self.assertEquals(watcher.compiled_counterparts(first), [compiled])
+        self.assertEquals(watcher.compiled_counterparts(second), [os.path.join(libdir, 'Second.pm')])
+        self.assertEquals(watcher.compiled_counterparts(compiled), [])
+        updated = watcher.compile_changes(set([first, second, os.path.join(self.tmpdir, 'other.pod')]))
+        self.assertEquals(updated, set([compiled, os.path.join(libdir, 'Second.pm')]))
+        with open(compiled) as fih:
+            self.assertEquals(fih.read(), 'source\n')
+
+        # The counterparts of removed files are removed
+        os.remove(first)
+        self.assertEquals(watcher.compile_changes(set([first])), set([compiled]))
+        self.assertFalse(os.path.exists(compiled))
+        self.assertEquals(watcher.compile_changes(set([first])), set())
+
+    def test_stage_changes(self):
+        """Test stage_changes and staged_path functions."""
+        testrepo = repo.Repo('configuration-modules-core', os.path.join(self.tmpdir, 'core'))
+        testrepo.movefiles_mode = 'copy'
+        source = os.path.join(testrepo.path, 'ncm-metaconfig', 'src', 'main', 'metaconfig', 'ssh', 'pan')
+        os.makedirs(source)
+        schema = os.path.join(source, 'schema.pan')
+        with open(schema, 'w') as fih:
+            fih.write('declaration template metaconfig/ssh/schema;\n')
+        staged = os.path.join(testrepo.path, 'ncm-metaconfig', 'target', 'pan', 'metaconfig', 'metaconfig', 'ssh',
+                              'schema.pan')
+        other = os.path.join(testrepo.path, 'ncm-foo', 'target', 'pan', 'components', 'foo', 'schema.pan')
+        self.assertEquals(watcher.stage_changes(testrepo, [schema, other]), [schema, other, staged])
+        self.assertTrue(os.path.exists(staged))
+        # Paths outside the movefiles are not staged
+        self.assertEquals(watcher.stage_changes(testrepo, [other]), [other])
+
+    def suite(self):
+        """Return all the testcases in this module."""
+        return TestLoader().loadTestsFromTestCase(WatcherTest)
+
+
+if __name__ == '__main__':
+    main()